@@ -0,0 +1,54 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    db.createTable.bind(db, 'sample_devices', {
+      id: { type: 'int', primaryKey: true, autoIncrement: true },
+      device_id: 'string',
+      assignment_id: 'string',
+      status: 'string',
+      updated_at: 'datetime',
+      sample_id: {
+        type: 'int',
+        foreignKey: {
+          name: 'sample_devices_sample_id_fk',
+          table: 'samples',
+          rules: {
+            onDelete: 'CASCADE',
+            onUpdate: 'RESTRICT'
+          },
+          mapping: {
+            sample_id: 'id'
+          }
+        }
+      }
+    }),
+    db.runSql.bind(db, 'CREATE UNIQUE INDEX sample_devices_sample_id_device_id_idx ON sample_devices (sample_id, device_id)')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.dropTable.bind(db, 'sample_devices')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
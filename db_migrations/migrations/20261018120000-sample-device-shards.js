@@ -0,0 +1,38 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    db.addColumn.bind(db, 'sample_devices', 'shard', { type: 'string', notNull: true, defaultValue: '' }),
+    db.runSql.bind(db, 'DROP INDEX sample_devices_sample_id_device_id_idx'),
+    db.runSql.bind(db, 'CREATE UNIQUE INDEX sample_devices_sample_id_device_id_shard_idx ON sample_devices (sample_id, device_id, shard)')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.runSql.bind(db, 'DROP INDEX sample_devices_sample_id_device_id_shard_idx'),
+    db.runSql.bind(db, "DELETE FROM sample_devices WHERE shard <> ''"),
+    db.removeColumn.bind(db, 'sample_devices', 'shard'),
+    db.runSql.bind(db, 'CREATE UNIQUE INDEX sample_devices_sample_id_device_id_idx ON sample_devices (sample_id, device_id)')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
@@ -0,0 +1,38 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    db.addColumn.bind(db, 'samples', 'coordinates_format', { type: 'string', notNull: true, defaultValue: 'numeric' }),
+    db.runSql.bind(db, 'ALTER TABLE coordinates ADD COLUMN coordinates_real real[]'),
+    db.runSql.bind(db, 'ALTER TABLE coordinates ADD COLUMN coordinates_packed bytea')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.runSql.bind(db, 'DELETE FROM coordinates WHERE coordinates IS NULL'),
+    db.runSql.bind(db, 'ALTER TABLE coordinates DROP COLUMN coordinates_packed'),
+    db.runSql.bind(db, 'ALTER TABLE coordinates DROP COLUMN coordinates_real'),
+    db.removeColumn.bind(db, 'samples', 'coordinates_format')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
@@ -0,0 +1,59 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    db.createTable.bind(db, 'coordinate_blocks', {
+      start_time: 'datetime',
+      frames_per_second: 'int',
+      num_frames: 'int',
+      device_id: 'string',
+      assignment_id: 'string',
+      geom_id: {
+        type: 'int',
+        foreignKey: {
+          name: 'coordinate_blocks_geom_id_fk',
+          table: 'geoms',
+          rules: {
+            onDelete: 'CASCADE',
+            onUpdate: 'RESTRICT'
+          },
+          mapping: {
+            geom_id: 'id'
+          }
+        }
+      }
+    }),
+    db.addIndex.bind(db, 'coordinate_blocks', "coordinate_blocks_geom_id_idx", ["geom_id"], false),
+    db.runSql.bind(db, 'CREATE UNIQUE INDEX coordinate_blocks_device_id_geom_id_start_time_idx ON coordinate_blocks (device_id, geom_id, start_time)'),
+    // One row per frame, one array of coordinate values per row
+    db.runSql.bind(db, 'ALTER TABLE coordinate_blocks ADD COLUMN coordinates real[][]'),
+    db.runSql.bind(db, 'SELECT create_hypertable(\'coordinate_blocks\', \'start_time\')')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.runSql.bind(db, "DELETE FROM samples WHERE coordinates_format = 'blocks'"),
+    db.dropTable.bind(db, 'coordinate_blocks')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
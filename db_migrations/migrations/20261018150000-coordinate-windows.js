@@ -0,0 +1,54 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    db.createTable.bind(db, 'coordinate_windows', {
+      device_id: 'string',
+      window_start: 'datetime',
+      frames_per_second: 'int',
+      num_frames: 'int',
+      data: 'bytea',
+      sample_id: {
+        type: 'int',
+        foreignKey: {
+          name: 'coordinate_windows_sample_id_fk',
+          table: 'samples',
+          rules: {
+            onDelete: 'CASCADE',
+            onUpdate: 'RESTRICT'
+          },
+          mapping: {
+            sample_id: 'id'
+          }
+        }
+      }
+    }),
+    db.runSql.bind(db, 'ALTER TABLE coordinate_windows ADD PRIMARY KEY (sample_id, device_id, window_start)')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.dropTable.bind(db, 'coordinate_windows')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
@@ -0,0 +1,38 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    db.addColumn.bind(db, 'coordinate_windows', 'level', { type: 'int', notNull: true, defaultValue: 1 }),
+    db.runSql.bind(db, 'ALTER TABLE coordinate_windows DROP CONSTRAINT coordinate_windows_pkey'),
+    db.runSql.bind(db, 'ALTER TABLE coordinate_windows ADD PRIMARY KEY (sample_id, device_id, level, window_start)')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.runSql.bind(db, 'ALTER TABLE coordinate_windows DROP CONSTRAINT coordinate_windows_pkey'),
+    db.runSql.bind(db, 'DELETE FROM coordinate_windows WHERE level <> 1'),
+    db.removeColumn.bind(db, 'coordinate_windows', 'level'),
+    db.runSql.bind(db, 'ALTER TABLE coordinate_windows ADD PRIMARY KEY (sample_id, device_id, window_start)')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
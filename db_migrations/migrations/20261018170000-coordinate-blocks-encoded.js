@@ -0,0 +1,35 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    // 'delta' samples' blocks, delta encoded by honeycomb_tools/codec.py, coordinates is NULL for them
+    db.runSql.bind(db, 'ALTER TABLE coordinate_blocks ADD COLUMN coordinates_encoded bytea')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.runSql.bind(db, "DELETE FROM samples WHERE coordinates_format = 'delta'"),
+    db.runSql.bind(db, 'ALTER TABLE coordinate_blocks DROP COLUMN coordinates_encoded')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
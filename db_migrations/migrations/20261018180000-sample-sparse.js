@@ -0,0 +1,34 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+exports.up = function(db, callback) {
+  async.series([
+    // Sparse samples have no rows for frames without valid coordinates and no geoms without valid frames
+    db.addColumn.bind(db, 'samples', 'sparse', { type: 'boolean', notNull: true, defaultValue: false })
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.removeColumn.bind(db, 'samples', 'sparse')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
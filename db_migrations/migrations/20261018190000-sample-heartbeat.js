@@ -0,0 +1,42 @@
+'use strict';
+
+var dbm;
+var type;
+var seed;
+
+var async = require('async')
+
+/**
+  * We receive the dbmigrate dependency from dbmigrate initially.
+  * This enables us to not have to rely on NODE_PATH.
+  */
+exports.setup = function(options, seedLink) {
+  dbm = options.dbmigrate;
+  type = dbm.dataType;
+  seed = seedLink;
+};
+
+// A loader claims the sample it loads (loader_id) and keeps heartbeat_at current while loading. A 'started' sample is
+// only resumed once it's released (heartbeat_at NULL) or its heartbeat is stale, so two runs never load it at once.
+//
+// Note on geoms.uuid: it used to hold geom_render's random geom id. Loaders now store a deterministic uuid derived
+// from the geom's type, identifying and other attributes and its position among otherwise identical geoms of its
+// device, which is how resumed and appended samples find the geoms they already stored. Geoms of different devices
+// that match in all of these share one record. Existing rows keep their old uuids, no data migration is needed.
+exports.up = function(db, callback) {
+  async.series([
+    db.addColumn.bind(db, 'samples', 'loader_id', 'string'),
+    db.addColumn.bind(db, 'samples', 'heartbeat_at', 'datetime')
+  ], callback);
+};
+
+exports.down = function(db, callback) {
+  async.series([
+    db.removeColumn.bind(db, 'samples', 'heartbeat_at'),
+    db.removeColumn.bind(db, 'samples', 'loader_id')
+  ], callback);
+};
+
+exports._meta = {
+  "version": 1
+};
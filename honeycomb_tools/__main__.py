@@ -1,21 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+import json
 import logging
 import os.path
 
 import click
 import honeycomb
 import psycopg2
-from psycopg2 import pool
 
 import honeycomb_tools.config as config
+from honeycomb_tools.connections import connection_pool_size, create_connection_pool
 from honeycomb_tools.process import process_geoms_2d
+from honeycomb_tools.util import kill_child_processes
+
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
 
 
 @click.group()
 @click.pass_context
-def main(ctx):
+@click.option('--executor', type=click.Choice(['thread', 'process']), default=config.EXECUTOR, help='pool used to format coordinates, process bypasses the GIL')
+@click.option('--engine', type=click.Choice(['thread', 'asyncio']), default=config.LOADER_ENGINE, help='loader used to COPY coordinates, asyncio requires asyncpg')
+def main(ctx, executor, engine):
     ctx.ensure_object(dict)
 
+    config.EXECUTOR = executor
+    config.LOADER_ENGINE = engine
+
     if config.HONEYCOMB_CLIENT_ID is None:
         raise ValueError("HONEYCOMB_CLIENT_ID is required")
     if config.HONEYCOMB_CLIENT_SECRET is None:
@@ -32,11 +43,7 @@ def main(ctx):
     )
 
     try:
-        ctx.obj['pg'] = psycopg2.pool.ThreadedConnectionPool(1, 20, user=config.PG_USER,
-                                                             password=config.PG_PASSWORD,
-                                                             host=config.PG_HOST,
-                                                             port=config.PG_PORT,
-                                                             database=config.PG_DATABASE)
+        ctx.obj['pg'] = create_connection_pool()
         conn = ctx.obj['pg'].getconn()
         cursor = conn.cursor()
         cursor.execute('SELECT 1')
@@ -53,10 +60,8 @@ def main(ctx):
 @click.option('--day', "-d", help='day expects format to be YYYY-MM-DD', required=True)
 @click.option('--source', "-s", help='name of the source type to generate geoms for [''cuwb'']', required=True)
 def prepare_geoms_for_environment_for_day_for_source(ctx, environment_name, day, source):
-    datetime_of_day = parse_day(day)
     # prepare list of datapoints for each assignment for the time period selected
-    start = (datetime_of_day + timedelta(hours=13)).isoformat()
-    end = (datetime_of_day + timedelta(hours=22)).isoformat()
+    start, end = [t.strftime(TIME_FORMAT) for t in day_time_range(parse_day(day))]
     ctx.invoke(prepare_geoms_for_environment_for_time_range_for_source, environment_name=environment_name, start=start, end=end, source=source)
 
 
@@ -66,7 +71,8 @@ def prepare_geoms_for_environment_for_day_for_source(ctx, environment_name, day,
 @click.option('--start', help='start time of video to load expects format to be YYYY-MM-DDTHH:MM', required=True)
 @click.option('--end', help='end time of video to load expects format to be YYYY-MM-DDTHH:MM', required=True)
 @click.option('--source', "-s", help='name of the source type to generate geoms for [''cuwb'']', required=True)
-def prepare_geoms_for_environment_for_time_range_for_source(ctx, environment_name, start, end, source):
+@click.option('--append', "-a", is_flag=True, default=False, help='append the time range to the environment''s existing sample for the day instead of creating a new sample')
+def prepare_geoms_for_environment_for_time_range_for_source(ctx, environment_name, start, end, source, append):
     honeycomb_client = ctx.obj['honeycomb_client']
     pg_client = ctx.obj['pg']
 
@@ -74,13 +80,14 @@ def prepare_geoms_for_environment_for_time_range_for_source(ctx, environment_nam
     end_time = parse_time(end)
 
     if source == 'cuwb':
-        process_geoms_2d(
+        run_single(
             honeycomb_client=honeycomb_client,
             pg_client=pg_client,
             environment_name=environment_name,
             start_time=start_time,
             end_time=end_time,
-            source_type=source)
+            source_type=source,
+            append=append)
     else:
         logger.warning('Unsupported source type: %s', source)
 
@@ -97,7 +104,7 @@ def prepare_geoms_for_inference_id_for_source(ctx, inference_id, source):
     pg_client = ctx.obj['pg']
 
     if source == 'pose':
-        process_geoms_2d(
+        run_single(
             honeycomb_client=honeycomb_client,
             pg_client=pg_client,
             inference_id=inference_id,
@@ -119,7 +126,7 @@ def prepare_geoms_for_environment_for_url_for_source(ctx, environment_name, pick
     pg_client = ctx.obj['pg']
 
     if source == 'tray_detection':
-        process_geoms_2d(
+        run_single(
             honeycomb_client=honeycomb_client,
             pg_client=pg_client,
             environment_name=environment_name,
@@ -132,12 +139,108 @@ def prepare_geoms_for_environment_for_url_for_source(ctx, environment_name, pick
         pg_client.closeall()
 
 
+@main.command()
+@click.pass_context
+@click.option('--manifest', "-m", type=click.Path(exists=True, dir_okay=False), help='JSON manifest, a list of {environment_name, start_day, end_day, source}, {environment_name, start, end, source}, {inference_id, source} or {environment_name, pickle_url, source} items')
+@click.option('--inference_ids', "-i", help='comma separated list of inference ids for generating pose geoms')
+@click.option('--concurrency', "-c", type=int, default=config.BATCH_CONCURRENCY, help='number of samples to process at once')
+def prepare_geoms_batch(ctx, manifest, inference_ids, concurrency):
+    honeycomb_client = ctx.obj['honeycomb_client']
+    pg_client = ctx.obj['pg']
+
+    items = []
+    if manifest is not None:
+        with open(manifest) as fp:
+            for entry in json.load(fp):
+                items.extend(expand_batch_entry(entry))
+    if inference_ids is not None:
+        items.extend(dict(inference_id=i.strip(), source_type='pose') for i in inference_ids.split(',') if len(i.strip()) > 0)
+
+    if len(items) == 0:
+        raise click.UsageError("A --manifest or --inference_ids is required")
+
+    logger.info("Processing batch of %s samples with concurrency %s...", len(items), concurrency)
+
+    # The pool opened by main is sized for a single sample
+    if connection_pool_size(concurrency=concurrency) > pg_client.maxconn:
+        pg_client.closeall()
+        pg_client = ctx.obj['pg'] = create_connection_pool(concurrency=concurrency)
+
+    def run_item(item):
+        try:
+            sample_db_id = process_geoms_2d(honeycomb_client=honeycomb_client, pg_client=pg_client, **item)
+            return ('success' if sample_db_id is not None else 'skipped'), sample_db_id
+        except Exception:
+            logger.exception("Batch item failed: %s", batch_item_label(item))
+            return 'failed', None
+
+    with ThreadPoolExecutor(max_workers=concurrency) as batch_pool:
+        results = list(batch_pool.map(run_item, items))
+
+    logger.info("Batch summary:")
+    for item, (status, sample_db_id) in zip(items, results):
+        logger.info("  %-8s SampleId - %s: %s", status, sample_db_id, batch_item_label(item))
+
+    failed = len([status for status, _ in results if status == 'failed'])
+    logger.info("Batch complete, %s succeeded, %s skipped, %s failed",
+                len([status for status, _ in results if status == 'success']),
+                len([status for status, _ in results if status == 'skipped']),
+                failed)
+
+    if pg_client is not None:
+        pg_client.closeall()
+
+    if failed > 0:
+        exit(1)
+
+
+def expand_batch_entry(entry):
+    """
+    Expand a batch manifest entry into process_geoms_2d keyword arguments, day ranges become one sample per day
+
+    :param entry -- dict
+    :return [dict]
+    """
+    source = entry['source']
+    if 'inference_id' in entry:
+        return [dict(inference_id=entry['inference_id'], source_type=source)]
+    if 'pickle_url' in entry:
+        return [dict(environment_name=entry['environment_name'], pickle_url=entry['pickle_url'], source_type=source)]
+    if 'start' in entry:
+        return [dict(environment_name=entry['environment_name'], start_time=parse_time(entry['start']), end_time=parse_time(entry['end']), source_type=source, append=entry.get('append', False))]
+
+    items = []
+    day = parse_day(entry['start_day'])
+    while day <= parse_day(entry.get('end_day', entry['start_day'])):
+        start_time, end_time = day_time_range(day)
+        items.append(dict(environment_name=entry['environment_name'], start_time=start_time, end_time=end_time, source_type=source))
+        day += timedelta(days=1)
+    return items
+
+
+def batch_item_label(item):
+    return ", ".join("%s=%s" % (key, value) for key, value in item.items())
+
+
+def run_single(**kwargs):
+    try:
+        process_geoms_2d(**kwargs)
+    except Exception:
+        logger.exception("Failed processing geoms")
+        kill_child_processes(os.getpid())
+        exit(1)
+
+
+def day_time_range(datetime_of_day):
+    return datetime_of_day + timedelta(hours=13), datetime_of_day + timedelta(hours=22)
+
+
 def parse_day(day):
     return datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc)
 
 
 def parse_time(time):
-    return datetime.strptime(time, "%Y-%m-%dT%H:%M").replace(tzinfo=timezone.utc)
+    return datetime.strptime(time, TIME_FORMAT).replace(tzinfo=timezone.utc)
 
 
 if __name__ == '__main__':
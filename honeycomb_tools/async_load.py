@@ -0,0 +1,141 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import time
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+import honeycomb_tools.config as config
+from honeycomb_tools.handle import coordinates_copy_columns, coordinates_copy_table
+from honeycomb_tools.handle_utils import PG_BINARY_COPY_HEADER, PG_BINARY_COPY_TRAILER
+
+
+#  Loader engine used with LOADER_ENGINE = 'asyncio', requires asyncpg (pip install honeycomb-geom-processor[async])
+#  Each device's COPY runs as a coroutine on its own asyncpg connection, at most ASYNC_COPY_CONCURRENCY at once
+#  Formatting stays on process_geoms_2d's format pool, chunks are pulled off each device's generator on a small thread pool
+
+
+SAMPLE_DEVICES_UPSERT_ASYNC = """
+    INSERT INTO sample_devices
+        (sample_id, device_id, shard, assignment_id, status, updated_at)
+    VALUES ($1, $2, $3, $4, $5, NOW())
+    ON CONFLICT (sample_id, device_id, shard) DO UPDATE
+        SET assignment_id = EXCLUDED.assignment_id, status = EXCLUDED.status, updated_at = EXCLUDED.updated_at
+"""
+
+
+class AsyncLoadError(Exception):
+    pass
+
+
+def load_device_coordinates_async(sample_db_id, jobs, concurrency=None, copy_format=None, table=None, metrics=None):
+    """
+    COPY each device's coordinates into the database as concurrent coroutines, blocking until all devices are loaded
+
+    Each device's COPY and its sample_devices status are written in one transaction, like pooled_put_coordinates_list
+
+    :param sample_db_id -- int
+    :param jobs -- list of {'device_id', 'assignment_id', 'coordinate_chunks', 'shard', 'coordinates_format', 'status'}, coordinate_chunks as generated by stream_device_coordinates, status recorded once the device's COPY succeeds
+    :param concurrency -- int, max concurrent COPYs (and connections), defaults to ASYNC_COPY_CONCURRENCY
+    :param copy_format -- 'text' or 'binary', defaults to COPY_FORMAT
+    :param table -- string, a staging table or defaults to each job's coordinates_format's table
+    :param metrics -- optional LoadMetrics, each device's COPY is recorded with record_device
+    """
+    if asyncpg is None:
+        raise AsyncLoadError("LOADER_ENGINE 'asyncio' requires asyncpg, install honeycomb-geom-processor[async]")
+
+    if len(jobs) == 0:
+        return
+
+    concurrency = min(concurrency or config.ASYNC_COPY_CONCURRENCY, len(jobs))
+    asyncio.run(_load_devices(sample_db_id, jobs, concurrency, copy_format or config.COPY_FORMAT, table, metrics))
+
+
+async def _load_devices(sample_db_id, jobs, concurrency, copy_format, table, metrics):
+    semaphore = asyncio.Semaphore(concurrency)
+    # Pulling a chunk blocks on the format pool, each running COPY gets a thread to wait on
+    chunk_pool = ThreadPoolExecutor(max_workers=concurrency)
+    pg_pool = await asyncpg.create_pool(min_size=1,
+                                        max_size=concurrency,
+                                        user=config.PG_USER,
+                                        password=config.PG_PASSWORD,
+                                        host=config.PG_HOST,
+                                        port=int(config.PG_PORT),
+                                        database=config.PG_DATABASE)
+    try:
+        tasks = [asyncio.ensure_future(_put_device_coordinates(pg_pool, semaphore, chunk_pool, sample_db_id, copy_format, table, metrics, **job)) for job in jobs]
+
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in pending:
+            task.cancel()
+        if len(pending) > 0:
+            await asyncio.wait(pending)
+
+        [task.result() for task in done]  # Raise exception if there is one
+    finally:
+        await pg_pool.close()
+        chunk_pool.shutdown(wait=False)
+
+
+async def _put_device_coordinates(pg_pool, semaphore, chunk_pool, sample_db_id, copy_format, table, metrics, device_id, assignment_id, coordinate_chunks, shard='', coordinates_format='numeric', status='success'):
+    async with semaphore:
+        async with pg_pool.acquire() as conn:
+            time_copy_from_started = time.perf_counter()
+            logging.info("SampleId - %s, DeviceId - %s, AssignmentId - %s: Loading coordinates into database...", sample_db_id, device_id, assignment_id)
+
+            copy_stats = {'rows': 0, 'bytes': 0}
+            try:
+                async with conn.transaction():
+                    await conn.copy_to_table(table or coordinates_copy_table(coordinates_format),
+                                             source=_copy_source(coordinate_chunks, chunk_pool, copy_format, copy_stats),
+                                             columns=coordinates_copy_columns(coordinates_format),
+                                             format=copy_format)
+                    await conn.execute(SAMPLE_DEVICES_UPSERT_ASYNC, sample_db_id, device_id, shard, assignment_id, status)
+            except Exception:
+                logging.exception("SampleId - %s, DeviceId - %s, AssignmentId - %s: Failed loading coordinate records", sample_db_id, device_id, assignment_id)
+                try:
+                    await conn.execute(SAMPLE_DEVICES_UPSERT_ASYNC, sample_db_id, device_id, shard, assignment_id, 'failed')
+                except Exception:
+                    logging.exception("Failed to update Sample Device record")
+                raise
+
+            staging_time = time.perf_counter() - time_copy_from_started
+            logging.info("SampleId - %s, DeviceId - %s, AssignmentId - %s: Coordinates staged, Staging time - %0.4f, Rows - %s (%0.1f rows/s), Bytes - %s (%0.2f MB/s)",
+                         sample_db_id, device_id, assignment_id, staging_time,
+                         copy_stats['rows'], copy_stats['rows'] / max(staging_time, 1e-9),
+                         copy_stats['bytes'], copy_stats['bytes'] / max(staging_time, 1e-9) / (1024 * 1024))
+            if metrics is not None:
+                metrics.record_device(device_id, copy_stats['rows'], copy_stats['bytes'], staging_time)
+
+
+async def _copy_source(coordinate_chunks, chunk_pool, copy_format, stats):
+    """
+    Async iterator of COPY data, pulling (data, num_rows) chunks from a blocking generator on chunk_pool
+    """
+    loop = asyncio.get_event_loop()
+    chunks = iter(coordinate_chunks)
+    done = object()
+
+    if copy_format == 'binary':
+        yield PG_BINARY_COPY_HEADER
+
+    while True:
+        chunk = await loop.run_in_executor(chunk_pool, next, chunks, done)
+        if chunk is done:
+            break
+
+        data, num_rows = chunk
+        if len(data) == 0:
+            continue
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+
+        stats['rows'] += num_rows
+        stats['bytes'] += len(data)
+        yield data
+
+    if copy_format == 'binary':
+        yield PG_BINARY_COPY_TRAILER
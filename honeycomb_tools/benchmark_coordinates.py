@@ -0,0 +1,288 @@
+import logging
+import time
+
+import click
+import numpy as np
+import psycopg2
+from psycopg2 import sql
+
+import honeycomb_tools.config as config
+from honeycomb_tools.codec import decode_block
+from honeycomb_tools.collection_store import load_collections
+from honeycomb_tools.handle import COORDINATES_FORMAT_COLUMNS, COORDINATE_BLOCKS_FORMAT_COLUMNS, copy_coordinates_chunks, format_coordinates
+from honeycomb_tools.handle_utils import unpack_coordinates
+from honeycomb_tools.process import build_coordinates_block
+
+
+#  Round trip benchmark of the coordinates storage formats ('numeric', 'real', 'packed', 'blocks', 'delta')
+#  python -m honeycomb_tools.benchmark_coordinates [--shape random|cuwb|pose] [--frames N] [--values N] [--nan-fraction F] [--quantum Q] [--load]
+#  python -m honeycomb_tools.benchmark_coordinates --collection sample.npz [--load]
+#  Shapes are synthetic stand-ins for real samples, --collection benchmarks every geom of a collection store instead
+#  Compression ratio is against the raw float32 values, throughput is frames encoded per second
+#  With --load each format is also COPY'd into a temporary table on the configured database to measure its on disk
+#  size and read back time
+
+
+COORDINATES_BENCHMARK_CREATE = """
+    CREATE TEMPORARY TABLE {table} (
+        device_id uuid,
+        assignment_id uuid,
+        geom_id bigint,
+        time timestamp,
+        coordinates numeric[],
+        coordinates_real real[],
+        coordinates_packed bytea
+    )
+"""
+
+COORDINATE_BLOCKS_BENCHMARK_CREATE = """
+    CREATE TEMPORARY TABLE {table} (
+        device_id uuid,
+        assignment_id uuid,
+        geom_id bigint,
+        start_time timestamp,
+        frames_per_second int,
+        num_frames int,
+        coordinates real[][],
+        coordinates_encoded bytea
+    )
+"""
+
+COORDINATES_BENCHMARK_SIZE = "SELECT pg_total_relation_size(%s::regclass)"
+
+COORDINATES_BENCHMARK_READ = "SELECT geom_id, {column} FROM {table}"
+
+BENCHMARK_FRAMES_PER_SECOND = 10
+
+
+def synthetic_coordinates(num_frames, num_values, nan_fraction, seed=0):
+    """
+    A coordinates block shaped like stream_device_coordinates' output, random walk positions with NaN gaps
+
+    :return dict
+    """
+    rng = np.random.RandomState(seed)
+    values = np.cumsum(rng.normal(scale=0.01, size=(num_frames, num_values)), axis=0) + rng.uniform(0, 1000, size=num_values)
+    values[rng.uniform(size=values.shape) < nan_fraction] = np.nan
+
+    return synthetic_block(values)
+
+
+def synthetic_cuwb_coordinates(num_frames, seed=0):
+    """
+    A CUWB tag shaped block, x/y/z in meters that sit still (repeating the last position) for most of the day, move in
+    short walks and go offline (all NaN) for long runs
+
+    :return dict
+    """
+    rng = np.random.RandomState(seed)
+    values = np.empty((num_frames, 3))
+    frame = 0
+    position = rng.uniform(0, 10, size=3)
+    while frame < num_frames:
+        length = min(int(rng.exponential(600)) + 1, num_frames - frame)
+        state = rng.choice(['still', 'walk', 'offline'], p=[0.6, 0.25, 0.15])
+        if state == 'walk':
+            values[frame:frame + length] = position + np.cumsum(rng.normal(scale=0.05, size=(length, 3)), axis=0)
+            position = values[frame + length - 1]
+        else:
+            values[frame:frame + length] = np.nan if state == 'offline' else np.round(position, 3)
+        frame += length
+    return synthetic_block(values)
+
+
+def synthetic_pose_coordinates(num_frames, seed=0):
+    """
+    A pose track shaped block, 17 keypoints of x/y pixels with a few pixels of jitter, present in about a third of the
+    frames and with some keypoints missing when present
+
+    :return dict
+    """
+    rng = np.random.RandomState(seed)
+    values = np.full((num_frames, 34), np.nan)
+    frame = 0
+    while frame < num_frames:
+        length = min(int(rng.exponential(300)) + 1, num_frames - frame)
+        if rng.uniform() < 0.35:
+            skeleton = rng.uniform(0, 1000, size=34)
+            drift = np.cumsum(rng.normal(scale=0.5, size=(length, 1)), axis=0)
+            values[frame:frame + length] = skeleton + drift + rng.normal(scale=1.5, size=(length, 34))
+            values[frame:frame + length][rng.uniform(size=(length, 34)) < 0.05] = np.nan
+        frame += length
+    return synthetic_block(values)
+
+
+def synthetic_block(values):
+    return {
+        'device_id': '00000000-0000-0000-0000-000000000000',
+        'assignment_id': None,
+        'geom_id': 1,
+        'frames_per_second': BENCHMARK_FRAMES_PER_SECOND,
+        'time': np.datetime64('2020-01-01T00:00:00', 'us') + (np.arange(len(values)) * (1000000 // BENCHMARK_FRAMES_PER_SECOND)).astype('timedelta64[us]'),
+        'coordinates': values
+    }
+
+
+def collection_coordinates(path):
+    """
+    A block per geom of every device of a collection store, see collection_store
+
+    :return [dict]
+    """
+    blocks = []
+    for device_id, device in load_collections(path).items():
+        for geom in device.geom_list:
+            blocks.append(build_coordinates_block(device_id=device_id,
+                                                  assignment_id=None,
+                                                  geom_db_id=len(blocks) + 1,
+                                                  coordinates=device.coordinates,
+                                                  coordinate_indices=geom.coordinate_indices,
+                                                  start_time=device.start_time,
+                                                  frames_per_second=device.frames_per_second))
+    return blocks
+
+
+def decode_text_rows(data, coordinates_format):
+    """
+    Decode the coordinates column of text COPY rows, the way a client reading them back would
+
+    :return list of np.ndarray, one per frame
+    """
+    decoded = []
+    for row in data.splitlines():
+        column = row.rsplit('\t', 1)[1]
+        if coordinates_format == 'packed':
+            decoded.append(unpack_coordinates(bytes.fromhex(column[3:])))
+        elif coordinates_format == 'delta':
+            decoded.extend(decode_block(bytes.fromhex(column[3:])))
+        elif coordinates_format == 'blocks':
+            decoded.extend(np.array([np.nan if v == 'NULL' else float(v) for v in frame.split(',')]) for frame in column[2:-2].split('},{'))
+        else:
+            decoded.append(np.array([np.nan if v == 'NULL' else float(v) for v in column[1:-1].split(',')]))
+    return decoded
+
+
+def benchmark_encoding(coordinate_blocks, coordinates_format, copy_format, quantum=0):
+    """
+    :return dict of encode seconds, frames per second encoded, bytes per frame, compression ratio against float32,
+        decode seconds and max absolute round trip error
+    """
+    num_frames = sum(len(block['time']) for block in coordinate_blocks)
+    raw_bytes = sum(np.asarray(block['coordinates']).size * 4 for block in coordinate_blocks)
+
+    started = time.perf_counter()
+    data = [format_coordinates(block, copy_format, coordinates_format, config.COORDINATE_BLOCK_SECONDS, quantum) for block in coordinate_blocks]
+    encode_seconds = time.perf_counter() - started
+
+    num_bytes = sum(len(block_data) for block_data in data)
+    result = {
+        'encode_seconds': encode_seconds,
+        'frames_per_second': num_frames / max(encode_seconds, 1e-9),
+        'bytes_per_frame': num_bytes / max(num_frames, 1),
+        'compression_ratio': raw_bytes / max(num_bytes, 1),
+        'decode_seconds': None,
+        'max_error': None
+    }
+
+    if copy_format == 'text':
+        started = time.perf_counter()
+        decoded = [np.array(decode_text_rows(block_data, coordinates_format)) for block_data in data]
+        result['decode_seconds'] = time.perf_counter() - started
+
+        errors = [np.abs(block_decoded - block['coordinates']).ravel() for block_decoded, block in zip(decoded, coordinate_blocks) if len(block_decoded) > 0]
+        errors = np.concatenate(errors) if len(errors) > 0 else np.zeros(0)
+        result['max_error'] = float(np.nanmax(errors)) if np.any(~np.isnan(errors)) else 0.0
+
+    return result, data
+
+
+def benchmark_load(conn, coordinate_blocks, coordinates_format, copy_format, data):
+    """
+    COPY data into a temporary table and read it back
+
+    :return dict of load seconds, table bytes and read seconds
+    """
+    table = 'coordinates_benchmark_%s' % coordinates_format
+    if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS:
+        create, column = COORDINATE_BLOCKS_BENCHMARK_CREATE, COORDINATE_BLOCKS_FORMAT_COLUMNS[coordinates_format]
+    else:
+        create, column = COORDINATES_BENCHMARK_CREATE, COORDINATES_FORMAT_COLUMNS[coordinates_format]
+
+    cursor = conn.cursor()
+    cursor.execute(sql.SQL(create).format(table=sql.Identifier(table)))
+
+    stats = {}
+    copy_coordinates_chunks(cursor, [(block_data, len(block['time'])) for block_data, block in zip(data, coordinate_blocks)], copy_format=copy_format, stats=stats, table=table, coordinates_format=coordinates_format)
+    if 'error' in stats:
+        raise stats['error']
+
+    cursor.execute(COORDINATES_BENCHMARK_SIZE, (table,))
+    table_bytes = cursor.fetchone()[0]
+
+    started = time.perf_counter()
+    cursor.execute(sql.SQL(COORDINATES_BENCHMARK_READ).format(table=sql.Identifier(table), column=sql.Identifier(column)))
+    cursor.fetchall()
+    read_seconds = time.perf_counter() - started
+
+    cursor.execute(sql.SQL("DROP TABLE {table}").format(table=sql.Identifier(table)))
+    cursor.close()
+
+    return {
+        'load_seconds': stats.get('seconds'),
+        'table_bytes': table_bytes,
+        'read_seconds': read_seconds
+    }
+
+
+@click.command()
+@click.option('--shape', type=click.Choice(['random', 'cuwb', 'pose']), default='random', help="Synthetic sample shape, 'cuwb' and 'pose' ignore --values and --nan-fraction")
+@click.option('--collection', type=click.Path(exists=True), default=None, help="Benchmark every geom of a collection store instead of a synthetic shape")
+@click.option('--frames', type=int, default=36000, help="Frames to encode")
+@click.option('--values', type=int, default=3, help="Coordinate values per frame, e.g. 3 for a CUWB point, 34 for a 17 keypoint pose")
+@click.option('--nan-fraction', type=float, default=0.05, help="Fraction of values that are NaN")
+@click.option('--quantum', type=float, default=config.COORDINATES_QUANTUM, help="'delta' quantization step, 0 for lossless")
+@click.option('--copy-format', type=click.Choice(['text', 'binary']), default=config.COPY_FORMAT)
+@click.option('--load/--no-load', default=False, help="Also COPY each format into a temporary table and read it back")
+def benchmark(shape, collection, frames, values, nan_fraction, quantum, copy_format, load):
+    """
+    Compare encode/decode time, COPY bytes, compression and on disk size of the coordinates storage formats
+    """
+    if collection is not None:
+        coordinate_blocks = collection_coordinates(collection)
+    elif shape == 'cuwb':
+        coordinate_blocks = [synthetic_cuwb_coordinates(frames)]
+    elif shape == 'pose':
+        coordinate_blocks = [synthetic_pose_coordinates(frames)]
+    else:
+        coordinate_blocks = [synthetic_coordinates(frames, values, nan_fraction)]
+    num_frames = sum(len(block['time']) for block in coordinate_blocks)
+
+    conn = None
+    if load:
+        conn = psycopg2.connect(user=config.PG_USER,
+                                password=config.PG_PASSWORD,
+                                host=config.PG_HOST,
+                                port=config.PG_PORT,
+                                database=config.PG_DATABASE)
+        conn.autocommit = True
+
+    try:
+        for coordinates_format in list(COORDINATES_FORMAT_COLUMNS) + list(COORDINATE_BLOCKS_FORMAT_COLUMNS):
+            result, data = benchmark_encoding(coordinate_blocks, coordinates_format, copy_format, quantum)
+            line = "%-8s encode %0.3fs (%0.0f frames/s), %0.1f bytes/frame, ratio %0.2fx" % (coordinates_format, result['encode_seconds'], result['frames_per_second'], result['bytes_per_frame'], result['compression_ratio'])
+            if result['decode_seconds'] is not None:
+                line += ", decode %0.3fs, max error %0.2e" % (result['decode_seconds'], result['max_error'])
+
+            if conn is not None:
+                load_result = benchmark_load(conn, coordinate_blocks, coordinates_format, copy_format, data)
+                line += ", load %0.3fs, table %0.1f bytes/frame, read %0.3fs" % (load_result['load_seconds'], load_result['table_bytes'] / max(num_frames, 1), load_result['read_seconds'])
+
+            click.echo(line)
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    benchmark()
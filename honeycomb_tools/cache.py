@@ -0,0 +1,125 @@
+from collections import OrderedDict
+import functools
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import honeycomb_tools.config as config
+
+
+class TTLCache:
+    """
+    Size bounded, least recently used cache whose entries expire after ttl seconds
+
+    Entries are kept in memory and, when path is given, persisted to a SQLite file so they survive across runs.
+    Persisted values must be JSON serializable.
+    """
+
+    def __init__(self, ttl, max_size, path=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)")
+            self._db.execute("DELETE FROM cache WHERE expires < ?", (time.time(),))
+            self._db.commit()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires >= now:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and row[1] >= now:
+                    value = json.loads(row[0])
+                    self._db.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    self._put_memory(key, value, row[1])
+                    return value
+
+        return default
+
+    def set(self, key, value):
+        now = time.time()
+        expires = now + self.ttl
+        with self._lock:
+            self._put_memory(key, value, expires)
+
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)", (key, json.dumps(value), expires, now))
+                self._db.execute("DELETE FROM cache WHERE expires < ?", (now,))
+                self._db.execute("DELETE FROM cache WHERE key NOT IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT ?)", (self.max_size,))
+                self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM cache")
+                self._db.commit()
+
+    def _put_memory(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+_caches = dict()
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, persist=True):
+    """
+    Shared cache for the given name, configured from INTROSPECTION_CACHE_* on first use
+
+    :param name -- string
+    :param persist -- boolean, whether to use the on-disk store (when INTROSPECTION_CACHE_PATH is set)
+    :return TTLCache
+    """
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = TTLCache(ttl=config.INTROSPECTION_CACHE_TTL,
+                                     max_size=config.INTROSPECTION_CACHE_SIZE,
+                                     path=config.INTROSPECTION_CACHE_PATH if persist else None)
+        return _caches[name]
+
+
+def cached(namespace):
+    """
+    Cache a honeycomb query function's result, keyed on its arguments (other than the honeycomb client)
+
+    None results are not cached
+
+    :param namespace -- string, unique per cached function
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(honeycomb_client, *args, **kwargs):
+            cache = get_cache('introspection')
+            key = json.dumps([namespace, args, kwargs], sort_keys=True, default=str)
+
+            value = cache.get(key)
+            if value is not None:
+                logging.debug("Introspection cache hit: %s", key)
+                return value
+
+            value = fn(honeycomb_client, *args, **kwargs)
+            if value is not None:
+                cache.set(key, value)
+            return value
+        return wrapper
+    return decorator
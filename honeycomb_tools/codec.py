@@ -0,0 +1,153 @@
+import struct
+
+import numpy as np
+
+
+#  Delta encoding of a block of coordinates (frames x values), used for 'delta' samples' coordinate_blocks rows
+#
+#  Frames with no valid value are dropped (stored as runs of kept frames), the kept frames are delta encoded along time
+#  per value, either as integer steps of a fixed quantum (lossy, error <= quantum / 2) or as the XOR of consecutive
+#  float32 bit patterns (lossless). Slow moving and stationary tracks produce runs of small or zero deltas, which are
+#  stored in the narrowest integer width that fits the block and compress well when TOASTed.
+#
+#  Block layout (little-endian):
+#    4s   magic 'HCD1'
+#    u32  num_frames
+#    u16  num_values
+#    u8   flags, bit 0 quantized, bit 1 kept frames have NaN values
+#    u8   width, bytes per delta: 1, 2 or 4 (or 8 when quantized)
+#    f32  quantum, 0 when not quantized
+#    u32  num_runs
+#    u32  runs[num_runs][2], (first frame, number of frames) of each run of kept frames
+#    u8   NaN bitmap of kept frames x values, LSB first, only when flag bit 1 is set
+#    base, the first kept frame's values, i64 quantum steps when quantized, f32 otherwise (absent with no kept frames)
+#    deltas, the remaining kept frames x values row-major, signed integers when quantized, unsigned XORs otherwise
+
+
+BLOCK_MAGIC = b'HCD1'
+BLOCK_HEADER = struct.Struct('<4sIHBBf')
+
+FLAG_QUANTIZED = 0x01
+FLAG_PARTIAL_NANS = 0x02
+
+
+def forward_fill(values, valid):
+    """
+    Replace invalid entries with the previous valid entry along axis 0, leading invalid entries become 0
+
+    :param values -- np.ndarray of frames x values
+    :param valid -- boolean np.ndarray, same shape
+    :return np.ndarray
+    """
+    rows = np.where(valid, np.arange(len(values))[:, np.newaxis], 0)
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    filled = np.take_along_axis(values, rows, axis=0)
+    return np.where(np.logical_or.accumulate(valid, axis=0), filled, 0)
+
+
+def delta_width(deltas, signed):
+    for width in (1, 2, 4):
+        if signed:
+            bound = 1 << (8 * width - 1)
+            if len(deltas) == 0 or (deltas.min() >= -bound and deltas.max() < bound):
+                return width
+        elif len(deltas) == 0 or deltas.max() < (1 << (8 * width)):
+            return width
+    return 8 if signed else 4
+
+
+def encode_block(values, quantum=0):
+    """
+    Delta encode a block of coordinates in the 'HCD1' layout
+
+    :param values -- np.ndarray of frames x values, NaN for missing values
+    :param quantum -- float, quantization step (e.g. 1.0 for pixel precision), 0 for lossless float32
+    :return bytes
+    """
+    values = np.asarray(values, dtype=np.float64)
+    num_frames, num_values = values.shape
+    # Quantize with the quantum as it's stored, so decoding multiplies by exactly the same step
+    quantum = float(np.float32(quantum))
+    nan_mask = np.isnan(values)
+
+    kept = ~nan_mask.all(axis=1)
+    kept_frames = np.flatnonzero(kept)
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], kept.astype(np.int8), [0]])))
+    runs = np.stack([edges[0::2], edges[1::2] - edges[0::2]], axis=1).astype('<u4')
+
+    kept_values = values[kept_frames]
+    kept_valid = ~nan_mask[kept_frames]
+    flags = 0
+    if not kept_valid.all():
+        flags |= FLAG_PARTIAL_NANS
+
+    if quantum > 0:
+        flags |= FLAG_QUANTIZED
+        steps = forward_fill(np.round(np.where(kept_valid, kept_values, 0) / quantum).astype(np.int64), kept_valid)
+        base = steps[:1].astype('<i8')
+        deltas = np.diff(steps, axis=0)
+        width = delta_width(deltas, signed=True)
+        encoded = deltas.astype('<i%d' % width)
+    else:
+        bits = forward_fill(np.where(kept_valid, kept_values, 0).astype('<f4').view('<u4'), kept_valid).astype(np.uint32)
+        base = bits[:1].astype('<u4')
+        deltas = np.bitwise_xor(bits[1:], bits[:-1])
+        width = delta_width(deltas, signed=False)
+        encoded = deltas.astype('<u%d' % width)
+
+    parts = [
+        BLOCK_HEADER.pack(BLOCK_MAGIC, num_frames, num_values, flags, width, max(quantum, 0)),
+        struct.pack('<I', len(runs)),
+        runs.tobytes()
+    ]
+    if flags & FLAG_PARTIAL_NANS:
+        parts.append(np.packbits(~kept_valid, axis=None, bitorder='little').tobytes())
+    parts.append(base.tobytes())
+    parts.append(encoded.tobytes())
+    return b"".join(parts)
+
+
+def decode_block(data):
+    """
+    Decode an 'HCD1' block, see encode_block
+
+    :param data -- bytes
+    :return np.ndarray of frames x values, float32 when lossless, float64 when quantized
+    """
+    data = bytes(data)
+    magic, num_frames, num_values, flags, width, quantum = BLOCK_HEADER.unpack_from(data)
+    if magic != BLOCK_MAGIC:
+        raise ValueError("Not a delta encoded block, magic %r" % magic)
+
+    offset = BLOCK_HEADER.size
+    num_runs = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    runs = np.frombuffer(data, dtype='<u4', count=2 * num_runs, offset=offset).reshape((num_runs, 2)).astype(np.int64)
+    offset += 8 * num_runs
+
+    num_kept = int(runs[:, 1].sum())
+    kept_frames = np.repeat(runs[:, 0] - np.cumsum(runs[:, 1]) + runs[:, 1], runs[:, 1]) + np.arange(num_kept)
+
+    kept_nan = np.zeros((num_kept, num_values), dtype=bool)
+    if flags & FLAG_PARTIAL_NANS:
+        bitmap_size = (num_kept * num_values + 7) // 8
+        kept_nan = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=bitmap_size, offset=offset), count=num_kept * num_values, bitorder='little').astype(bool).reshape((num_kept, num_values))
+        offset += bitmap_size
+
+    num_base = min(num_kept, 1)
+    if flags & FLAG_QUANTIZED:
+        base = np.frombuffer(data, dtype='<i8', count=num_base * num_values, offset=offset).reshape((num_base, num_values))
+        offset += 8 * num_base * num_values
+        deltas = np.frombuffer(data, dtype='<i%d' % width, count=(num_kept - num_base) * num_values, offset=offset).reshape((-1, num_values))
+        kept_values = np.cumsum(np.concatenate([base, deltas.astype(np.int64)]), axis=0) * float(quantum)
+        values = np.full((num_frames, num_values), np.nan)
+    else:
+        base = np.frombuffer(data, dtype='<u4', count=num_base * num_values, offset=offset).reshape((num_base, num_values))
+        offset += 4 * num_base * num_values
+        deltas = np.frombuffer(data, dtype='<u%d' % width, count=(num_kept - num_base) * num_values, offset=offset).reshape((-1, num_values))
+        kept_values = np.bitwise_xor.accumulate(np.concatenate([base, deltas.astype(np.uint32)]), axis=0).view(np.float32)
+        values = np.full((num_frames, num_values), np.nan, dtype=np.float32)
+
+    kept_values = np.where(kept_nan, np.nan, kept_values)
+    values[kept_frames] = kept_values
+    return values
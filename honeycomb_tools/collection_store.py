@@ -0,0 +1,303 @@
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import pickle
+import struct
+import tempfile
+import zipfile
+
+import click
+import numpy as np
+from geom_render import GeomJSONEncoder
+
+import honeycomb_tools.config as config
+
+
+# A collection store is an uncompressed .npz holding a 'manifest' (UTF-8 JSON as a uint8 array) and one
+# 'coordinates_<n>' array per device. Members are stored (not deflated) so each device's coordinates can be
+# memory-mapped straight out of the archive.
+#
+# manifest = {
+#   "version": 1,
+#   "devices": [{
+#     "device_id": string, "array": "coordinates_<n>",
+#     "start_time": ISO 8601, "frames_per_second": int, "num_frames": int, "frame_width": int, "frame_height": int,
+#     "source_id": string, "source_type": string, "source_name": string,
+#     "geoms": [{"type": string, "coordinate_indices": [int], "attributes": {...}}]
+#   }]
+# }
+STORE_VERSION = 1
+
+ZIP_LOCAL_HEADER_SIZE = 30
+
+
+class StoredGeom:
+    """
+    A geom loaded from a collection store, it carries the geom's type name and already scrubbed attributes instead of
+    a geom_render object
+    """
+
+    def __init__(self, geom_type, coordinate_indices, attributes):
+        self.geom_type = geom_type
+        self.coordinate_indices = coordinate_indices
+        self.attributes = attributes
+        self.id = attributes.get('id')
+        self.object_id = attributes.get('object_id')
+        self.object_type = attributes.get('object_type')
+        self.object_name = attributes.get('object_name')
+
+
+class StoredGeomCollection:
+    """
+    A device's GeomCollection2D loaded from a collection store, coordinates are usually a read-only np.memmap
+    """
+
+    def __init__(self, coordinates, geom_list, start_time, frames_per_second, num_frames, frame_width=None, frame_height=None, source_id=None, source_type=None, source_name=None):
+        self.coordinates = coordinates
+        self.geom_list = geom_list
+        self.start_time = start_time
+        self.frames_per_second = frames_per_second
+        self.num_frames = num_frames
+        self.frame_width = frame_width
+        self.frame_height = frame_height
+        self.source_id = source_id
+        self.source_type = source_type
+        self.source_name = source_name
+
+
+def is_collection_store(path):
+    if not zipfile.is_zipfile(path):
+        return False
+
+    with zipfile.ZipFile(path) as archive:
+        return 'manifest.npy' in archive.namelist()
+
+
+def save_collections(sample_collection, path):
+    """
+    Write a sample's device -> GeomCollection2D dict as a collection store
+
+    :param sample_collection -- {device_id: GeomCollection2D}
+    :param path -- string
+    """
+    # Late import, process imports this module
+    from honeycomb_tools.process import geom_type_name, scrub_geom_object
+
+    devices = []
+    arrays = dict()
+    for idx, (device_id, device) in enumerate(sample_collection.items()):
+        array_name = "coordinates_%d" % idx
+        arrays[array_name] = np.ascontiguousarray(device.coordinates)
+        devices.append({
+            'device_id': device_id,
+            'array': array_name,
+            'start_time': device.start_time.isoformat(),
+            'frames_per_second': device.frames_per_second,
+            'num_frames': device.num_frames,
+            'frame_width': device.frame_width,
+            'frame_height': device.frame_height,
+            'source_id': device.source_id,
+            'source_type': device.source_type,
+            'source_name': device.source_name,
+            'geoms': [{
+                'type': geom_type_name(geom),
+                'coordinate_indices': np.asarray(geom.coordinate_indices).tolist(),
+                'attributes': scrub_geom_object(geom)
+            } for geom in device.geom_list]
+        })
+
+    manifest = json.dumps({'version': STORE_VERSION, 'devices': devices}, cls=GeomJSONEncoder).encode('utf-8')
+    with open(path, 'wb') as fp:
+        np.savez(fp, manifest=np.frombuffer(manifest, dtype=np.uint8), **arrays)
+
+
+def load_collections(path, mmap=True):
+    """
+    Read a collection store as a device -> StoredGeomCollection dict
+
+    :param path -- string
+    :param mmap -- boolean, memory-map coordinates rather than reading them into memory
+    :return {device_id: StoredGeomCollection}
+    """
+    with np.load(path) as store:
+        manifest = json.loads(store['manifest'].tobytes().decode('utf-8'))
+        if manifest.get('version') != STORE_VERSION:
+            raise ValueError("Unsupported collection store version %s in %s" % (manifest.get('version'), path))
+
+        sample_collection = dict()
+        for device in manifest['devices']:
+            coordinates = map_npz_array(path, device['array']) if mmap else store[device['array']]
+            sample_collection[device['device_id']] = StoredGeomCollection(
+                coordinates=coordinates,
+                geom_list=[StoredGeom(geom_type=g['type'], coordinate_indices=g['coordinate_indices'], attributes=g['attributes']) for g in device['geoms']],
+                start_time=datetime.fromisoformat(device['start_time']),
+                frames_per_second=device['frames_per_second'],
+                num_frames=device['num_frames'],
+                frame_width=device['frame_width'],
+                frame_height=device['frame_height'],
+                source_id=device['source_id'],
+                source_type=device['source_type'],
+                source_name=device['source_name'])
+
+    return sample_collection
+
+
+def map_npz_array(path, name):
+    """
+    Memory-map an array stored (uncompressed) in an .npz archive
+
+    :param path -- string
+    :param name -- string, array name without the .npy extension
+    :return np.memmap
+    """
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("Array %s in %s is compressed and can't be memory-mapped" % (name, path))
+
+    with open(path, 'rb') as fp:
+        fp.seek(info.header_offset)
+        header = fp.read(ZIP_LOCAL_HEADER_SIZE)
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        fp.seek(info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length)
+
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+        offset = fp.tell()
+
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape, order='F' if fortran_order else 'C')
+
+
+class CollectionCache:
+    """
+    Directory of collection stores keyed by what was fetched, least recently used stores are evicted once the
+    directory exceeds max_bytes
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        os.makedirs(path, exist_ok=True)
+
+    def get(self, key):
+        path = self._store_path(key)
+        try:
+            sample_collection = load_collections(path)
+        except FileNotFoundError:
+            return None
+        except (ValueError, OSError, zipfile.BadZipFile):
+            logging.warning("Discarding unreadable cached collection %s", path)
+            self._remove(path)
+            return None
+
+        # mtime tracks last use for eviction, another process may have evicted the store since it was loaded
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return sample_collection
+
+    def put(self, key, sample_collection):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        os.close(fd)
+        try:
+            save_collections(sample_collection, tmp_path)
+            os.replace(tmp_path, self._store_path(key))
+        finally:
+            self._remove(tmp_path)
+
+        self.evict()
+
+    def evict(self):
+        stores = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                stat = entry.stat()
+                stores.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_bytes = sum(size for _, size, _ in stores)
+        for _, size, path in sorted(stores):
+            if total_bytes <= self.max_bytes:
+                break
+            logging.info("Evicting cached collection %s (%0.1f MB)", path, size / 1048576)
+            self._remove(path)
+            total_bytes -= size
+
+    def _store_path(self, key):
+        digest = hashlib.sha256(json.dumps(key, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.npz')
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+_collection_cache = None
+
+
+def get_collection_cache():
+    """
+    Shared fetch cache configured from FETCH_CACHE_*, None when FETCH_CACHE_DIR is empty
+
+    :return CollectionCache
+    """
+    global _collection_cache
+    if not config.FETCH_CACHE_DIR:
+        return None
+    if _collection_cache is None:
+        _collection_cache = CollectionCache(config.FETCH_CACHE_DIR, config.FETCH_CACHE_MAX_BYTES)
+    return _collection_cache
+
+
+def fetch_collections_cached(key, fetch):
+    """
+    Return the cached sample collection for key, otherwise call fetch and cache its result
+
+    :param key -- JSON serializable list identifying the fetch, e.g. ['cuwb', environment_name, start_time, end_time]
+    :param fetch -- callable returning {device_id: GeomCollection2D}
+    :return {device_id: GeomCollection2D or StoredGeomCollection}
+    """
+    cache = get_collection_cache()
+    if cache is None:
+        return fetch()
+
+    sample_collection = cache.get(key)
+    if sample_collection is not None:
+        logging.info("Using cached collections for %s", key)
+        return sample_collection
+
+    sample_collection = {k: (v['geom'] if isinstance(v, dict) else v) for k, v in fetch().items()}
+    if len(sample_collection) > 0:
+        try:
+            cache.put(key, sample_collection)
+        except Exception:
+            logging.exception("Failed caching collections for %s", key)
+    return sample_collection
+
+
+@click.command()
+@click.argument('pickle_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('output_path', type=click.Path(dir_okay=False))
+def convert_pickle(pickle_path, output_path):
+    """
+    Convert a pickled {device_id: GeomCollection2D} sample (as used by --pickle_url) into a collection store
+    """
+    with open(pickle_path, 'rb') as fp:
+        sample_collection = pickle.load(fp)
+
+    sample_collection = {k: (v['geom'] if isinstance(v, dict) else v) for k, v in sample_collection.items()}
+    save_collections(sample_collection, output_path)
+    logging.info("Wrote %s devices to %s", len(sample_collection), output_path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    convert_pickle()
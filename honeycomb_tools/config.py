@@ -10,6 +10,21 @@ HONEYCOMB_AUDIENCE = os.getenv("HONEYCOMB_AUDIENCE", "https://honeycomb.api.wild
 HONEYCOMB_CLIENT_ID = os.getenv("HONEYCOMB_CLIENT_ID")
 HONEYCOMB_CLIENT_SECRET = os.getenv("HONEYCOMB_CLIENT_SECRET")
 
+# Honeycomb introspection queries (environments, assignments, inferences) are cached for INTROSPECTION_CACHE_TTL seconds
+# Set INTROSPECTION_CACHE_PATH to a SQLite file to share the cache across runs
+INTROSPECTION_CACHE_TTL = int(os.getenv("INTROSPECTION_CACHE_TTL", 3600))
+INTROSPECTION_CACHE_SIZE = int(os.getenv("INTROSPECTION_CACHE_SIZE", 256))
+INTROSPECTION_CACHE_PATH = os.getenv("INTROSPECTION_CACHE_PATH")
+
+# Files fetched by URL (--pickle_url) are cached here, keyed by URL and ETag
+DOWNLOAD_CACHE_DIR = os.getenv("DOWNLOAD_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "honeycomb-geom-processor", "downloads"))
+DOWNLOAD_RETRIES = int(os.getenv("DOWNLOAD_RETRIES", 5))
+
+# Fetched CUWB/pose collections are cached here as collection stores so retries and re-loads skip the fetch,
+# least recently used stores are evicted past FETCH_CACHE_MAX_BYTES. Set FETCH_CACHE_DIR to an empty string to disable
+FETCH_CACHE_DIR = os.getenv("FETCH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "honeycomb-geom-processor", "collections"))
+FETCH_CACHE_MAX_BYTES = int(os.getenv("FETCH_CACHE_MAX_BYTES", 20 * 1024 ** 3))
+
 PG_USER = os.getenv("PGUSER", "geom-processor-user")
 PG_PASSWORD = os.getenv("PGPASSWORD", "iamaninsecurepassword")
 PG_DATABASE = os.getenv("PGDATABASE", "geom-processor")
@@ -17,3 +32,62 @@ PG_PORT = os.getenv("PGPORT", "5432")
 PG_HOST = os.getenv("PGHOST", "localhost")
 
 MAX_WORKERS = int(os.getenv("MAX_WORKERS", 5))
+# Number of samples loaded at once by prepare-geoms-batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 2))
+# Coordinate formatting runs on a 'thread' or 'process' pool of MAX_WORKERS
+EXECUTOR = os.getenv("EXECUTOR", "thread")
+
+# CUWB time ranges are fetched in shards of CUWB_SHARD_MINUTES (0 to fetch in one go), FETCH_CONCURRENCY shards at a time
+CUWB_SHARD_MINUTES = int(os.getenv("CUWB_SHARD_MINUTES", 30))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", 4))
+
+# Coordinates are streamed into each device's COPY in windows of PIPELINE_WINDOW_FRAMES frames per geom,
+# with at most PIPELINE_QUEUE_SIZE formatted windows waiting per device
+PIPELINE_WINDOW_FRAMES = int(os.getenv("PIPELINE_WINDOW_FRAMES", 3000))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 10))
+
+# Device COPYs run on 'thread' (psycopg2, MAX_WORKERS threads) or 'asyncio' (asyncpg, ASYNC_COPY_CONCURRENCY coroutines)
+LOADER_ENGINE = os.getenv("LOADER_ENGINE", "thread")
+ASYNC_COPY_CONCURRENCY = int(os.getenv("ASYNC_COPY_CONCURRENCY", 32))
+
+# Coordinates are COPYed 'direct' into the coordinates hypertable, or into an unlogged 'staging' table per sample that's
+# validated and moved into coordinates in one INSERT ... SELECT once every device is loaded (a failed load is just a DROP)
+LOAD_MODE = os.getenv("LOAD_MODE", "direct")
+
+# A loading sample's heartbeat is renewed every SAMPLE_HEARTBEAT_SECONDS, a 'started' sample is only resumed by another
+# run once it was released by its failed run or its heartbeat is older than SAMPLE_STALE_SECONDS
+SAMPLE_HEARTBEAT_SECONDS = float(os.getenv("SAMPLE_HEARTBEAT_SECONDS", 30))
+SAMPLE_STALE_SECONDS = int(os.getenv("SAMPLE_STALE_SECONDS", 120))
+
+# Storage format of new samples' coordinates, a coordinates row per frame as 'numeric' (numeric[]), 'real' (real[]) or
+# 'packed' (float32 bytea with a NaN bitmap), or 'blocks', a coordinate_blocks row per geom per COORDINATE_BLOCK_SECONDS
+# holding a real[][] of the block's frames, or 'delta', the same rows holding the block delta encoded as a bytea (see codec)
+COORDINATES_FORMAT = os.getenv("COORDINATES_FORMAT", "numeric")
+COORDINATE_BLOCK_SECONDS = int(os.getenv("COORDINATE_BLOCK_SECONDS", 25))
+# 'delta' quantization step in coordinate units (e.g. 1 for pixel precision), 0 stores float32 values losslessly
+COORDINATES_QUANTUM = float(os.getenv("COORDINATES_QUANTUM", 0))
+# Sparse samples skip frames where all of a geom's coordinates are NaN ('blocks' and 'delta' skip all NaN blocks) and
+# geoms with no valid frames at all, recorded in samples.sparse
+SPARSE_COORDINATES = os.getenv("SPARSE_COORDINATES", "false").lower() in ("1", "true", "yes")
+
+# Columnar windows of each device's coordinates for the read path, written at load time to the coordinate_windows table
+# ('table') or to EXPORT_DIR ('files'), see export. Empty to disable
+EXPORT_TARGET = os.getenv("EXPORT_TARGET", "")
+EXPORT_WINDOW_SECONDS = int(os.getenv("EXPORT_WINDOW_SECONDS", 25))
+# Levels of detail exported, comma separated decimation factors of the sample's frames_per_second, e.g. "1,5,25"
+# Level 1 is always exported
+EXPORT_LEVELS = [int(level) for level in os.getenv("EXPORT_LEVELS", "1").split(",")]
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "honeycomb-geom-processor", "windows"))
+
+# Coordinates are loaded with COPY, either 'text' or 'binary'
+# Binary skips float to text formatting and server side numeric parsing, but rounds coordinates to 8 decimal places
+# and fails loading 'numeric' coordinates of magnitude 1e8 or more
+COPY_FORMAT = os.getenv("COPY_FORMAT", "text")
+COPY_CHUNK_SIZE = int(os.getenv("COPY_CHUNK_SIZE", 256 * 1024))
+
+# Per sample load metrics (phase durations, rows/bytes per device, peak RSS, queue depths), see metrics. A JSON report
+# per sample is written to METRICS_DIR, the last sample's metrics to the METRICS_PROMETHEUS_FILE textfile. Empty to disable
+METRICS_DIR = os.getenv("METRICS_DIR", "")
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE", "")
+# Peak RSS and queue depths are sampled every METRICS_SAMPLE_SECONDS
+METRICS_SAMPLE_SECONDS = float(os.getenv("METRICS_SAMPLE_SECONDS", 0.5))
@@ -0,0 +1,175 @@
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.pool
+
+import honeycomb_tools.config as config
+
+
+# Postgres error classes that mean the server is overloaded rather than that the data is bad
+# 08 - connection exception, 53 - insufficient resources, 57 - operator intervention (e.g. query canceled, admin shutdown)
+SERVER_ERROR_CLASSES = ('08', '53', '57')
+
+
+def connection_pool_size(concurrency=1, max_workers=None):
+    """
+    Connections needed to process concurrency samples at once, each sample holds one connection for its own queries,
+    one for its heartbeat and one per COPY worker
+
+    :param concurrency -- int, samples processed at once
+    :param max_workers -- int, COPY workers per sample, defaults to MAX_WORKERS
+    :return int
+    """
+    return concurrency * ((max_workers or config.MAX_WORKERS) + 2)
+
+
+def create_connection_pool(concurrency=1, max_workers=None):
+    """
+    Create a ThreadedConnectionPool sized for the given sample concurrency
+
+    minconn equals maxconn, so connections are opened up front and kept open when returned to the pool instead of
+    being closed and re-dialed
+
+    :return psycopg2.pool.ThreadedConnectionPool
+    """
+    size = connection_pool_size(concurrency=concurrency, max_workers=max_workers)
+    logging.info("Opening %s database connections", size)
+    return psycopg2.pool.ThreadedConnectionPool(size, size,
+                                                user=config.PG_USER,
+                                                password=config.PG_PASSWORD,
+                                                host=config.PG_HOST,
+                                                port=config.PG_PORT,
+                                                database=config.PG_DATABASE)
+
+
+def warm_up_connections(pg_client, count):
+    """
+    Check out count pooled connections and run a trivial query on each, dead connections are replaced before they
+    are handed to a COPY
+
+    :param pg_client -- psycopg2.pool.AbstractConnectionPool
+    :param count -- int
+    :return int, number of healthy connections
+    """
+    connections = []
+    healthy = 0
+    try:
+        for _ in range(count):
+            try:
+                conn = pg_client.getconn()
+            except psycopg2.pool.PoolError:
+                break
+            connections.append(conn)
+
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1')
+                cursor.close()
+                conn.rollback()
+                healthy += 1
+            except psycopg2.Error:
+                logging.warning("Replacing dead database connection")
+                connections.pop()
+                pg_client.putconn(conn, close=True)
+    finally:
+        for conn in connections:
+            pg_client.putconn(conn)
+
+    return healthy
+
+
+def is_server_error(error):
+    """
+    Whether a COPY failed because of the server (lost connection, out of resources) rather than its data
+
+    :param error -- Exception
+    :return boolean
+    """
+    if isinstance(error, psycopg2.OperationalError):
+        return True
+
+    pgcode = getattr(error, 'pgcode', None)
+    return pgcode is not None and pgcode[:2] in SERVER_ERROR_CLASSES
+
+
+class CopyThrottle:
+    """
+    Limits the number of concurrent COPYs, adapting the limit to observed throughput and server errors
+
+    Every `limit` completed COPYs the aggregate rows/s is compared to the previous window's, the limit steps up by one
+    while throughput improves and back down by one when it drops. A server error halves the limit.
+
+    The limit starts at initial_limit (defaults to half of max_limit), so the first windows have room to probe upwards.
+    """
+
+    def __init__(self, max_limit, min_limit=1, initial_limit=None):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max(min_limit, min(max_limit, initial_limit if initial_limit is not None else (max_limit + 1) // 2))
+        self._active = 0
+        # Devices waiting for a slot
+        self.waiting = 0
+        self._condition = threading.Condition()
+        self._window_started = time.perf_counter()
+        self._window_rows = 0
+        self._window_copies = 0
+        self._last_throughput = None
+        self._last_step = 0
+
+    @contextmanager
+    def slot(self):
+        with self._condition:
+            self.waiting += 1
+            while self._active >= self.limit:
+                self._condition.wait()
+            self.waiting -= 1
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def record(self, rows):
+        with self._condition:
+            self._window_rows += rows
+            self._window_copies += 1
+            if self._window_copies < self.limit:
+                return
+
+            now = time.perf_counter()
+            throughput = self._window_rows / max(now - self._window_started, 1e-9)
+            if self._last_throughput is None or throughput > self._last_throughput * 1.05:
+                # Improving (or first window), keep stepping the same way, probing upwards by default
+                step = self._last_step if self._last_step != 0 else 1
+            elif throughput < self._last_throughput * 0.9:
+                step = -self._last_step if self._last_step != 0 else -1
+            else:
+                step = 0
+
+            self._set_limit(self.limit + step, "%0.1f rows/s" % throughput)
+            self._last_step = step
+            self._last_throughput = throughput
+            self._window_started = now
+            self._window_rows = 0
+            self._window_copies = 0
+
+    def record_error(self, error):
+        if not is_server_error(error):
+            return
+
+        with self._condition:
+            self._set_limit(self.limit // 2, "server error %s" % type(error).__name__)
+            self._last_step = -1
+            self._last_throughput = None
+
+    def _set_limit(self, limit, reason):
+        limit = max(self.min_limit, min(self.max_limit, limit))
+        if limit != self.limit:
+            logging.info("COPY concurrency %s -> %s (%s)", self.limit, limit, reason)
+            self.limit = limit
+            self._condition.notify_all()
@@ -0,0 +1,481 @@
+import logging
+import os
+import struct
+import tempfile
+
+import numpy as np
+import psycopg2
+from psycopg2 import extras
+
+import honeycomb_tools.config as config
+
+
+#  Columnar coordinate windows for the read path, written at load time when EXPORT_TARGET is 'table' or 'files'
+#  Each window holds every geom of one device for EXPORT_WINDOW_SECONDS, aligned to multiples of EXPORT_WINDOW_SECONDS
+#  since the Unix epoch, so a reader fetches a window by its (sample_id, device_id, level, window_start) key instead of
+#  scanning and grouping coordinates rows
+#
+#  Each of EXPORT_LEVELS is a level of detail, level n holds the NaN-aware mean of every n frames (frames_per_second / n)
+#  in windows of n * EXPORT_WINDOW_SECONDS, so every level's windows have the same number of frames
+#
+#  Window blob layout (little-endian):
+#    4s   magic 'HCW1'
+#    u32  num_geoms
+#    u32  num_frames, frames per window, frames missing from the sample are NaN
+#    f32  frames_per_second
+#    f64  start_time, seconds since the Unix epoch, frame i is at start_time + i / frames_per_second
+#    i32  geom_ids[num_geoms]
+#    u32  num_values[num_geoms], values per frame of each geom
+#    f32  values, for each geom in order num_frames x num_values[geom] row-major
+
+
+WINDOW_MAGIC = b'HCW1'
+WINDOW_HEADER = struct.Struct('<4sIIfd')
+
+COORDINATE_WINDOWS_UPSERT = """
+    INSERT INTO coordinate_windows
+        (sample_id, device_id, level, window_start, frames_per_second, num_frames, data)
+    VALUES %s
+    ON CONFLICT (sample_id, device_id, level, window_start) DO UPDATE
+        SET frames_per_second = EXCLUDED.frames_per_second, num_frames = EXCLUDED.num_frames, data = EXCLUDED.data
+"""
+
+COORDINATE_WINDOWS_UPSERT_TEMPLATE = "(%(sample_id)s, %(device_id)s, %(level)s, %(window_start)s, %(frames_per_second)s, %(num_frames)s, %(data)s)"
+
+COORDINATE_WINDOWS_SELECT = """
+    SELECT window_start, data FROM coordinate_windows
+    WHERE sample_id = %(sample_id)s AND device_id = %(device_id)s AND level = %(level)s AND window_start = ANY(%(window_starts)s)
+"""
+
+COORDINATE_WINDOWS_SELECT_STRADDLING = """
+    SELECT device_id, level, window_start, frames_per_second, num_frames, data FROM coordinate_windows
+    WHERE
+        sample_id = %(sample_id)s
+        AND window_start < %(from_time)s
+        AND window_start + level * %(window_seconds)s * INTERVAL '1 second' > %(from_time)s
+"""
+
+COORDINATE_WINDOWS_DELETE_FROM_TIME = """
+    DELETE FROM coordinate_windows
+    WHERE sample_id = %(sample_id)s AND window_start + level * %(window_seconds)s * INTERVAL '1 second' > %(from_time)s
+"""
+
+
+def encode_coordinate_window(start_time, frames_per_second, geoms):
+    """
+    Encode a window's geoms in the window blob layout
+
+    :param start_time -- np.datetime64
+    :param frames_per_second -- float
+    :param geoms -- {geom_id: np.ndarray of num_frames x num_values}, every geom with the same number of frames
+    :return bytes
+    """
+    geom_ids = list(geoms.keys())
+    values = [np.asarray(geoms[geom_id], dtype='<f4') for geom_id in geom_ids]
+    num_frames = len(values[0]) if len(values) > 0 else 0
+
+    return b"".join([
+        WINDOW_HEADER.pack(WINDOW_MAGIC, len(geom_ids), num_frames, frames_per_second, datetime64_to_seconds(start_time)),
+        np.asarray(geom_ids, dtype='<i4').tobytes(),
+        np.asarray([v.shape[1] for v in values], dtype='<u4').tobytes()
+    ] + [v.tobytes() for v in values])
+
+
+def decode_coordinate_window(data):
+    """
+    Decode a window blob, see encode_coordinate_window
+
+    :param data -- bytes
+    :return {'start_time': np.datetime64[us], 'frames_per_second': float, 'num_frames': int, 'geoms': {geom_id: np.ndarray of float32}}
+    """
+    data = bytes(data)
+    magic, num_geoms, num_frames, frames_per_second, start_seconds = WINDOW_HEADER.unpack_from(data)
+    if magic != WINDOW_MAGIC:
+        raise ValueError("Not a coordinate window, magic %r" % magic)
+
+    offset = WINDOW_HEADER.size
+    geom_ids = np.frombuffer(data, dtype='<i4', count=num_geoms, offset=offset)
+    offset += 4 * num_geoms
+    num_values = np.frombuffer(data, dtype='<u4', count=num_geoms, offset=offset)
+    offset += 4 * num_geoms
+
+    geoms = {}
+    for geom_id, geom_num_values in zip(geom_ids.tolist(), num_values.tolist()):
+        count = num_frames * geom_num_values
+        geoms[geom_id] = np.frombuffer(data, dtype='<f4', count=count, offset=offset).reshape((num_frames, geom_num_values))
+        offset += 4 * count
+
+    return {
+        'start_time': np.datetime64(int(round(start_seconds * 1000000)), 'us'),
+        'frames_per_second': frames_per_second,
+        'num_frames': num_frames,
+        'geoms': geoms
+    }
+
+
+def datetime64_to_seconds(value):
+    return np.datetime64(value, 'us').astype(np.int64) / 1000000
+
+
+def build_device_windows(coordinates, times, frames_per_second, geoms, start_frame=0, end_frame=None, window_seconds=None):
+    """
+    Generate a device's coordinate windows from frames start_frame to end_frame
+
+    :param coordinates -- np.ndarray, the device's coordinates (frames x points x 2)
+    :param times -- np.ndarray of datetime64[us], time of each of the device's frames
+    :param frames_per_second -- int
+    :param geoms -- [(geom_id, coordinate_indices)]
+    :param window_seconds -- int, defaults to EXPORT_WINDOW_SECONDS
+    :return generator of (window_start np.datetime64[us], {geom_id: np.ndarray}, complete boolean), complete is False when part of the window lies outside the frames
+    """
+    window_seconds = window_seconds or config.EXPORT_WINDOW_SECONDS
+    end_frame = len(coordinates) if end_frame is None else end_frame
+    window_us = int(window_seconds * 1000000)
+    window_frames = int(round(window_seconds * frames_per_second))
+
+    times_us = np.asarray(times[start_frame:end_frame]).astype('datetime64[us]').astype(np.int64)
+    if len(times_us) == 0:
+        return
+
+    window_ids = times_us // window_us
+    window_starts = np.concatenate([[0], np.flatnonzero(window_ids[1:] != window_ids[:-1]) + 1])
+    window_ends = np.concatenate([window_starts[1:], [len(times_us)]])
+
+    for first, last in zip(window_starts.tolist(), window_ends.tolist()):
+        window_start_us = int(window_ids[first]) * window_us
+        # Position of each frame in the window, frames are assumed to be evenly spaced at frames_per_second
+        offsets = np.clip(np.round((times_us[first:last] - window_start_us) * frames_per_second / 1000000).astype(np.int64), 0, window_frames - 1)
+
+        window_geoms = {}
+        frame_coordinates = coordinates[start_frame + first:start_frame + last]
+        for geom_id, coordinate_indices in geoms:
+            geom_coordinates = frame_coordinates[:, coordinate_indices].reshape((last - first, -1))
+            values = np.full((window_frames, geom_coordinates.shape[1]), np.nan, dtype=np.float32)
+            values[offsets] = geom_coordinates
+            window_geoms[geom_id] = values
+
+        complete = offsets[0] == 0 and offsets[-1] == window_frames - 1
+        yield np.datetime64(window_start_us, 'us'), window_geoms, complete
+
+
+def decimate_coordinates(values, factor):
+    """
+    NaN-aware mean of each run of factor frames, runs without a single valid value are NaN
+
+    :param values -- np.ndarray of num_frames x num_values, num_frames a multiple of factor
+    :param factor -- int
+    :return np.ndarray of num_frames / factor x num_values
+    """
+    if factor == 1:
+        return values
+
+    grouped = values.reshape((-1, factor, values.shape[1]))
+    valid = ~np.isnan(grouped)
+    with np.errstate(invalid='ignore'):
+        return (np.where(valid, grouped, 0).sum(axis=1) / valid.sum(axis=1)).astype(np.float32)
+
+
+def merge_coordinate_windows(stored, geoms):
+    """
+    Fill a full rate window's missing (NaN) frames from the stored level 1 windows it spans
+
+    :param stored -- [decoded window or None], the consecutive level 1 windows covering the window, see decode_coordinate_window
+    :param geoms -- {geom_id: np.ndarray}, full rate frames of the window
+    :return {geom_id: np.ndarray}
+    """
+    merged = dict(geoms)
+    for idx, existing in enumerate(stored):
+        if existing is None:
+            continue
+
+        for geom_id, previous in existing['geoms'].items():
+            values = merged.get(geom_id)
+            if values is None:
+                values = merged[geom_id] = np.full((len(stored) * len(previous), previous.shape[1]), np.nan, dtype=np.float32)
+
+            part = values[idx * len(previous):(idx + 1) * len(previous)]
+            if part.shape == previous.shape:
+                part[...] = np.where(np.isnan(part), previous, part)
+    return merged
+
+
+def coordinate_window_starts(from_time, seconds, window_seconds=None, level=1):
+    """
+    Starts of a level's windows covering seconds from from_time, a read of the default 25 seconds touches one or two windows
+
+    :param from_time -- datetime or np.datetime64
+    :param seconds -- number
+    :param level -- int
+    :return [np.datetime64[us]]
+    """
+    window_us = int((window_seconds or config.EXPORT_WINDOW_SECONDS) * level * 1000000)
+    from_us = np.datetime64(from_time.replace(tzinfo=None) if hasattr(from_time, 'tzinfo') else from_time, 'us').astype(np.int64)
+    to_us = from_us + int(seconds * 1000000)
+    return [np.datetime64(int(start), 'us') for start in range((from_us // window_us) * window_us, to_us + 1, window_us)]
+
+
+def coordinate_window_path(directory, sample_id, device_id, window_start, level=1):
+    device_dir = os.path.join(directory, "sample_%d" % sample_id, str(device_id))
+    if level != 1:
+        device_dir = os.path.join(device_dir, "level_%d" % level)
+    return os.path.join(device_dir, "%d.hcw" % (np.datetime64(window_start, 'ms').astype(np.int64)))
+
+
+def fetch_coordinate_windows(cursor, sample_id, device_id, window_starts, target=None, directory=None, level=1, pending=None):
+    """
+    Fetch a device's stored windows of a level by window_start
+
+    :param cursor -- DB Transaction, unused for the 'files' target
+    :param window_starts -- [np.datetime64], see coordinate_window_starts
+    :param target -- 'table' or 'files', defaults to EXPORT_TARGET
+    :param directory -- string, defaults to EXPORT_DIR
+    :param level -- int
+    :param pending -- optional {path: part path} of window files not yet promoted, read in place of the stored files
+    :return {np.datetime64[us]: decoded window}
+    """
+    target = target or config.EXPORT_TARGET
+    windows = {}
+    if target == 'files':
+        for window_start in window_starts:
+            path = coordinate_window_path(directory or config.EXPORT_DIR, sample_id, device_id, window_start, level=level)
+            path = (pending or {}).get(path, path)
+            if os.path.exists(path):
+                with open(path, 'rb') as fp:
+                    windows[np.datetime64(window_start, 'us')] = decode_coordinate_window(fp.read())
+        return windows
+
+    cursor.execute(COORDINATE_WINDOWS_SELECT, {
+        'sample_id': sample_id,
+        'device_id': device_id,
+        'level': level,
+        'window_starts': [np.datetime64(window_start, 'us').item() for window_start in window_starts]
+    })
+    for window_start, data in cursor.fetchall():
+        windows[np.datetime64(window_start, 'us')] = decode_coordinate_window(data)
+    return windows
+
+
+def put_coordinate_windows(cursor, sample_id, device_id, frames_per_second, windows, target=None, directory=None, level=1, pending=None):
+    """
+    Store encoded windows of a level, replacing any stored window with the same window_start
+
+    With the 'files' target and pending, windows are written to part files recorded in pending and only replace the
+    stored files once promoted with promote_coordinate_window_files
+
+    :param frames_per_second -- int, the sample's full rate frames_per_second
+    :param windows -- [(window_start np.datetime64, data bytes, num_frames int)]
+    :param pending -- optional {path: part path}, updated
+    """
+    target = target or config.EXPORT_TARGET
+    if target == 'files':
+        for window_start, data, _ in windows:
+            path = coordinate_window_path(directory or config.EXPORT_DIR, sample_id, device_id, window_start, level=level)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            if pending is None:
+                os.replace(part_path, path)
+                continue
+
+            previous_part_path = pending.get(path)
+            pending[path] = part_path
+            if previous_part_path is not None:
+                os.remove(previous_part_path)
+        return
+
+    extras.execute_values(cursor,
+                          COORDINATE_WINDOWS_UPSERT,
+                          [{
+                              'sample_id': sample_id,
+                              'device_id': device_id,
+                              'level': level,
+                              'window_start': window_start.item(),
+                              'frames_per_second': frames_per_second,
+                              'num_frames': num_frames,
+                              'data': psycopg2.Binary(data)
+                          } for window_start, data, num_frames in windows],
+                          template=COORDINATE_WINDOWS_UPSERT_TEMPLATE,
+                          page_size=max(len(windows), 1))
+
+
+def promote_coordinate_window_files(pending):
+    """
+    Replace the stored window files with the part files put_coordinate_windows wrote to pending, emptying it
+    """
+    for path, part_path in list(pending.items()):
+        os.replace(part_path, path)
+        del pending[path]
+
+
+def discard_coordinate_window_files(pending):
+    """
+    Remove the part files put_coordinate_windows wrote to pending, emptying it, the stored window files are left as they were
+    """
+    for path, part_path in list(pending.items()):
+        try:
+            os.remove(part_path)
+        except OSError:
+            logging.exception("Failed to remove coordinate window part file %s", part_path)
+        del pending[path]
+
+
+def export_device_windows(cursor, sample_id, device_id, coordinates, times, frames_per_second, geoms, start_frame=0, end_frame=None, target=None, window_seconds=None, levels=None, batch_size=100, pending=None):
+    """
+    Export a device's coordinates as columnar windows at each level of detail and return the number of windows written
+
+    Windows only partly covered by the frames (the ends of a shard or an append) are merged with the stored windows
+    before decimating. Level 1 is always exported first, since it's what the other levels are merged from.
+
+    :param cursor -- DB Transaction
+    :param sample_id -- int
+    :param device_id -- string
+    :param coordinates -- np.ndarray, the device's coordinates
+    :param times -- np.ndarray of datetime64[us], time of each of the device's frames
+    :param frames_per_second -- int
+    :param geoms -- [(geom_id, coordinate_indices)], the device's geoms by DB id
+    :param target -- 'table' or 'files', defaults to EXPORT_TARGET
+    :param window_seconds -- int, defaults to EXPORT_WINDOW_SECONDS
+    :param levels -- [int], decimation factors, defaults to EXPORT_LEVELS
+    :param batch_size -- int, windows per INSERT
+    :param pending -- optional {path: part path}, with the 'files' target windows are written to part files to be
+    promoted once the load commits, see put_coordinate_windows
+    :return num windows -- int, None on failure
+    """
+    target = target or config.EXPORT_TARGET
+    window_seconds = window_seconds or config.EXPORT_WINDOW_SECONDS
+    num_windows = 0
+    try:
+        for level in sorted(set([1] + list(levels or config.EXPORT_LEVELS))):
+            batch = []
+            for window_start, window_geoms, complete in build_device_windows(coordinates, times, frames_per_second, geoms, start_frame=start_frame, end_frame=end_frame, window_seconds=window_seconds * level):
+                if not complete:
+                    level_starts = [window_start + np.timedelta64(idx * window_seconds * 1000000, 'us') for idx in range(level)]
+                    stored = fetch_coordinate_windows(cursor, sample_id, device_id, level_starts, target=target, level=1, pending=pending)
+                    window_geoms = merge_coordinate_windows([stored.get(level_start) for level_start in level_starts], window_geoms)
+
+                window_geoms = {geom_id: decimate_coordinates(values, level) for geom_id, values in window_geoms.items()}
+
+                batch.append((window_start, encode_coordinate_window(window_start, frames_per_second / level, window_geoms), len(next(iter(window_geoms.values()), []))))
+                if len(batch) >= batch_size:
+                    put_coordinate_windows(cursor, sample_id, device_id, frames_per_second, batch, target=target, level=level, pending=pending)
+                    num_windows += len(batch)
+                    batch = []
+
+            if len(batch) > 0:
+                put_coordinate_windows(cursor, sample_id, device_id, frames_per_second, batch, target=target, level=level, pending=pending)
+                num_windows += len(batch)
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("SampleId - %s, DeviceId - %s: Failed exporting coordinate windows", sample_id, device_id)
+        return None
+
+    return num_windows
+
+
+def sample_window_files(directory, sample_id, window_seconds):
+    """
+    A sample's window files with their start and end, see coordinate_window_path
+
+    :return generator of (path, window start ms, window end ms)
+    """
+    sample_dir = os.path.join(directory, "sample_%d" % sample_id)
+    for root, _, names in os.walk(sample_dir):
+        level_dir = os.path.basename(root)
+        level = int(level_dir[len('level_'):]) if level_dir.startswith('level_') else 1
+        for name in names:
+            if name.endswith('.hcw'):
+                start_ms = int(name[:-len('.hcw')])
+                yield os.path.join(root, name), start_ms, start_ms + level * window_seconds * 1000
+
+
+def fetch_straddling_coordinate_windows(cursor, sample_id, from_time, target=None, directory=None, window_seconds=None):
+    """
+    Snapshot a sample's windows of every level that start before from_time and end after it, the windows an append
+    from from_time rebuilds, see restore_coordinate_windows
+
+    :return [window], None on failure
+    """
+    target = target or config.EXPORT_TARGET
+    window_seconds = window_seconds or config.EXPORT_WINDOW_SECONDS
+    try:
+        if target == 'files':
+            from_ms = np.datetime64(from_time.replace(tzinfo=None), 'ms').astype(np.int64)
+            windows = []
+            for path, start_ms, end_ms in sample_window_files(directory or config.EXPORT_DIR, sample_id, window_seconds):
+                if start_ms < from_ms < end_ms:
+                    with open(path, 'rb') as fp:
+                        windows.append((path, fp.read()))
+            return windows
+
+        cursor.execute(COORDINATE_WINDOWS_SELECT_STRADDLING, {
+            'sample_id': sample_id,
+            'from_time': from_time,
+            'window_seconds': window_seconds
+        })
+        return [{
+            'sample_id': sample_id,
+            'device_id': device_id,
+            'level': level,
+            'window_start': window_start,
+            'frames_per_second': frames_per_second,
+            'num_frames': num_frames,
+            'data': psycopg2.Binary(bytes(data))
+        } for device_id, level, window_start, frames_per_second, num_frames, data in cursor.fetchall()]
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to fetch coordinate windows")
+        return None
+
+
+def restore_coordinate_windows(cursor, windows, target=None):
+    """
+    Store windows snapshot by fetch_straddling_coordinate_windows as they were
+
+    :return boolean
+    """
+    target = target or config.EXPORT_TARGET
+    try:
+        if target == 'files':
+            for path, data in windows:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                fd, part_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+                with os.fdopen(fd, 'wb') as fp:
+                    fp.write(data)
+                os.replace(part_path, path)
+        elif len(windows) > 0:
+            extras.execute_values(cursor,
+                                  COORDINATE_WINDOWS_UPSERT,
+                                  windows,
+                                  template=COORDINATE_WINDOWS_UPSERT_TEMPLATE,
+                                  page_size=len(windows))
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to restore coordinate windows")
+        return False
+
+    return True
+
+
+def delete_coordinate_windows_from_time(cursor, sample_id, from_time, target=None, directory=None, window_seconds=None):
+    """
+    Delete a sample's windows of every level ending after from_time, including windows straddling from_time
+
+    :return boolean
+    """
+    target = target or config.EXPORT_TARGET
+    window_seconds = window_seconds or config.EXPORT_WINDOW_SECONDS
+    try:
+        if target == 'files':
+            from_ms = np.datetime64(from_time.replace(tzinfo=None), 'ms').astype(np.int64)
+            for path, _, end_ms in list(sample_window_files(directory or config.EXPORT_DIR, sample_id, window_seconds)):
+                if end_ms > from_ms:
+                    os.remove(path)
+        else:
+            cursor.execute(COORDINATE_WINDOWS_DELETE_FROM_TIME, {
+                'sample_id': sample_id,
+                'from_time': from_time,
+                'window_seconds': window_seconds
+            })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to delete coordinate windows")
+        return False
+
+    return True
@@ -1,18 +1,66 @@
+from contextlib import nullcontext
 import logging
+import time
+
 import numpy as np
 import psycopg2
-from psycopg2 import extras
+from psycopg2 import extras, sql
 
 import honeycomb_tools.handle_extensions
-from honeycomb_tools.handle_utils import IteratorFile
+from honeycomb_tools.handle_utils import IteratorFile, drop_empty_frames, format_coordinates_text, format_coordinates_binary, format_coordinate_blocks_text, format_coordinate_blocks_binary, split_assignment_runs, split_coordinate_blocks, DEFAULT_BLOCK_SECONDS, DEFAULT_CHUNK_SIZE, PG_BINARY_COPY_HEADER, PG_BINARY_COPY_TRAILER
 
 SAMPLES_INSERT = """
     INSERT INTO samples
-        (status, start_time, end_time, frames_per_second, num_frames, frame_width, frame_height, environment_id, source_id, source_type, source_name, inference_id, inference_name, inference_model, inference_version)
-    VALUES (%(status)s, %(start_time)s, %(end_time)s, %(frames_per_second)s, %(num_frames)s, %(frame_width)s, %(frame_height)s, %(environment_id)s, %(source_id)s, %(source_type)s, %(source_name)s, %(inference_id)s, %(inference_name)s, %(inference_model)s, %(inference_version)s)
+        (status, start_time, end_time, frames_per_second, num_frames, frame_width, frame_height, environment_id, source_id, source_type, source_name, inference_id, inference_name, inference_model, inference_version, coordinates_format, sparse, loader_id, heartbeat_at)
+    VALUES (%(status)s, %(start_time)s, %(end_time)s, %(frames_per_second)s, %(num_frames)s, %(frame_width)s, %(frame_height)s, %(environment_id)s, %(source_id)s, %(source_type)s, %(source_name)s, %(inference_id)s, %(inference_name)s, %(inference_model)s, %(inference_version)s, %(coordinates_format)s, %(sparse)s, %(loader_id)s, NOW())
+    RETURNING id
+"""
+
+# Samples another loader is loading are locked (while it claims them) or have a current heartbeat, both are passed over
+SAMPLES_CLAIM_MATCHING = """
+    UPDATE samples SET loader_id = %(loader_id)s, heartbeat_at = NOW()
+    WHERE id = (
+        SELECT id FROM samples
+        WHERE
+            status = %(status)s
+            AND environment_id = %(environment_id)s
+            AND start_time = %(start_time)s
+            AND end_time = %(end_time)s
+            AND source_type IS NOT DISTINCT FROM %(source_type)s
+            AND inference_id IS NOT DISTINCT FROM %(inference_id)s
+            AND coordinates_format = %(coordinates_format)s
+            AND sparse = %(sparse)s
+            AND (heartbeat_at IS NULL OR heartbeat_at < NOW() - %(stale_seconds)s * INTERVAL '1 second')
+        ORDER BY id DESC
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
     RETURNING id
 """
 
+SAMPLES_HEARTBEAT = """
+    UPDATE samples SET heartbeat_at = NOW() WHERE id = %(sample_id)s AND loader_id = %(loader_id)s
+"""
+
+SAMPLES_RELEASE = """
+    UPDATE samples SET heartbeat_at = NULL WHERE id = %(sample_id)s AND loader_id = %(loader_id)s
+"""
+
+SAMPLES_SELECT_FOR_DAY = """
+    SELECT id, start_time, end_time, frames_per_second, num_frames, coordinates_format, sparse FROM samples
+    WHERE
+        status = %(status)s
+        AND environment_id = %(environment_id)s
+        AND start_time::date = %(day)s::date
+        AND source_type IS NOT DISTINCT FROM %(source_type)s
+    ORDER BY id DESC
+    LIMIT 1
+"""
+
+SAMPLES_UPDATE_RANGE = """
+    UPDATE samples SET end_time = %(end_time)s, num_frames = %(num_frames)s WHERE id = %(sample_id)s
+"""
+
 SAMPLES_UPDATE_STATUS = """
     UPDATE samples SET status = %(status)s WHERE id = %(sample_id)s
 """
@@ -21,13 +69,46 @@ SAMPLES_DELETE = """
     DELETE FROM samples WHERE id = %(sample_id)s
 """
 
-GEOMS_INSERT = """
+SAMPLE_DEVICES_SELECT = """
+    SELECT device_id, status FROM sample_devices WHERE sample_id = %(sample_id)s AND shard = %(shard)s
+"""
+
+SAMPLE_DEVICES_UPSERT = """
+    INSERT INTO sample_devices
+        (sample_id, device_id, shard, assignment_id, status, updated_at)
+    VALUES (%(sample_id)s, %(device_id)s, %(shard)s, %(assignment_id)s, %(status)s, NOW())
+    ON CONFLICT (sample_id, device_id, shard) DO UPDATE
+        SET assignment_id = EXCLUDED.assignment_id, status = EXCLUDED.status, updated_at = EXCLUDED.updated_at
+"""
+
+COORDINATES_DELETE_FOR_SAMPLE_FROM_TIME = """
+    DELETE FROM coordinates
+    WHERE
+        geom_id IN (SELECT id FROM geoms WHERE sample_id = %(sample_id)s)
+        AND time >= %(from_time)s
+"""
+
+COORDINATE_BLOCKS_DELETE_FOR_SAMPLE_FROM_TIME = """
+    DELETE FROM coordinate_blocks
+    WHERE
+        geom_id IN (SELECT id FROM geoms WHERE sample_id = %(sample_id)s)
+        AND start_time >= %(from_time)s
+"""
+
+GEOMS_INSERT_MANY = """
     INSERT INTO geoms
         (uuid, sample_id, attributes, type, object_id, object_type, object_name)
-    VALUES (%(uuid)s, %(sample_id)s, %(attributes)s, %(type)s, %(object_id)s, %(object_type)s, %(object_name)s)
-    RETURNING id
+    VALUES %s
+    ON CONFLICT (sample_id, uuid) DO UPDATE SET uuid = EXCLUDED.uuid
+    RETURNING uuid, id, (xmax = 0) AS inserted
+"""
+
+GEOMS_DELETE = """
+    DELETE FROM geoms WHERE id = ANY(%(geom_ids)s)
 """
 
+GEOMS_INSERT_MANY_TEMPLATE = "(%(uuid)s, %(sample_id)s, %(attributes)s, %(type)s, %(object_id)s, %(object_type)s, %(object_name)s)"
+
 COORDINATES_INSERT = """
     INSERT INTO coordinates
         (device_id, assignment_id, geom_id, time, coordinates)
@@ -35,6 +116,73 @@ COORDINATES_INSERT = """
     RETURNING id
 """
 
+# A sample's coordinates_format picks the column its coordinates are stored in, 'blocks' and 'delta' samples are stored
+# one row per geom per time block in coordinate_blocks instead
+COORDINATES_FORMAT_COLUMNS = {
+    'numeric': 'coordinates',
+    'real': 'coordinates_real',
+    'packed': 'coordinates_packed'
+}
+
+COORDINATE_BLOCKS_FORMAT_COLUMNS = {
+    'blocks': 'coordinates',
+    'delta': 'coordinates_encoded'
+}
+
+COORDINATE_BLOCKS_COLUMNS = ('device_id', 'assignment_id', 'geom_id', 'start_time', 'frames_per_second', 'num_frames')
+
+COORDINATES_COPY_BINARY = """
+    COPY {table}
+        ({columns})
+    FROM STDIN WITH (FORMAT binary)
+"""
+
+# Staging tables copy their target's columns but none of its indexes, constraints or hypertable chunks
+COORDINATES_STAGING_CREATE = """
+    CREATE UNLOGGED TABLE IF NOT EXISTS {table} (LIKE {target} INCLUDING DEFAULTS)
+"""
+
+COORDINATES_STAGING_VALIDATE = """
+    SELECT
+        count(*),
+        count(*) - count(DISTINCT (device_id, geom_id, time)),
+        count(*) FILTER (WHERE time IS NULL OR geom_id IS NULL OR num_nonnulls(coordinates, coordinates_real, coordinates_packed) = 0),
+        count(*) FILTER (WHERE geom_id NOT IN (SELECT id FROM geoms WHERE sample_id = %(sample_id)s))
+    FROM {table}
+"""
+
+# Ordered by time so rows arrive at the hypertable one chunk after another
+COORDINATES_STAGING_MOVE = """
+    INSERT INTO coordinates
+        (device_id, assignment_id, geom_id, time, coordinates, coordinates_real, coordinates_packed)
+    SELECT device_id, assignment_id, geom_id, time, coordinates, coordinates_real, coordinates_packed FROM {table}
+    ORDER BY time
+"""
+
+COORDINATE_BLOCKS_STAGING_VALIDATE = """
+    SELECT
+        count(*),
+        count(*) - count(DISTINCT (device_id, geom_id, start_time)),
+        count(*) FILTER (WHERE start_time IS NULL OR geom_id IS NULL OR num_nonnulls(coordinates, coordinates_encoded) = 0 OR num_frames <> array_length(coordinates, 1)),
+        count(*) FILTER (WHERE geom_id NOT IN (SELECT id FROM geoms WHERE sample_id = %(sample_id)s))
+    FROM {table}
+"""
+
+COORDINATE_BLOCKS_STAGING_MOVE = """
+    INSERT INTO coordinate_blocks
+        (device_id, assignment_id, geom_id, start_time, frames_per_second, num_frames, coordinates, coordinates_encoded)
+    SELECT device_id, assignment_id, geom_id, start_time, frames_per_second, num_frames, coordinates, coordinates_encoded FROM {table}
+    ORDER BY start_time
+"""
+
+COORDINATES_STAGING_DROP = """
+    DROP TABLE IF EXISTS {table}
+"""
+
+SAMPLE_DEVICES_DELETE = """
+    DELETE FROM sample_devices WHERE sample_id = %(sample_id)s
+"""
+
 COORDINATES_INSERT_MANY = """
     INSERT INTO coordinates
         (geom_id, device_id, assignment_id time, coordinates)
@@ -42,7 +190,7 @@ COORDINATES_INSERT_MANY = """
 """
 
 
-def put_sample(cursor, status, start_time, end_time, frames_per_second, num_frames, frame_width, frame_height, environment_id, source_id, source_type, source_name, inference_id=None, inference_name=None, inference_model=None, inference_version=None):
+def put_sample(cursor, status, start_time, end_time, frames_per_second, num_frames, frame_width, frame_height, environment_id, source_id, source_type, source_name, inference_id=None, inference_name=None, inference_model=None, inference_version=None, coordinates_format='numeric', sparse=False, loader_id=None):
     """
     Insert sample record into database and return record ID
 
@@ -61,6 +209,9 @@ def put_sample(cursor, status, start_time, end_time, frames_per_second, num_fram
     :param inference_name -- string
     :param inference_model -- string
     :param inference_version -- string
+    :param coordinates_format -- string, see COORDINATES_FORMAT_COLUMNS and COORDINATE_BLOCKS_FORMAT_COLUMNS
+    :param sparse -- boolean, frames with no valid coordinates and geoms with no valid frames aren't stored
+    :param loader_id -- string, the sample is created claimed by this loader, see claim_sample
     :return sample id -- int
     """
     sample_id = None
@@ -80,7 +231,10 @@ def put_sample(cursor, status, start_time, end_time, frames_per_second, num_fram
             'inference_id': inference_id,
             'inference_name': inference_name,
             'inference_model': inference_model,
-            'inference_version': inference_version
+            'inference_version': inference_version,
+            'coordinates_format': coordinates_format,
+            'sparse': sparse,
+            'loader_id': loader_id
         })
 
         sample_id = cursor.fetchone()[0]
@@ -90,6 +244,125 @@ def put_sample(cursor, status, start_time, end_time, frames_per_second, num_fram
     return sample_id
 
 
+def claim_sample(cursor, loader_id, status, environment_id, start_time, end_time, source_type, inference_id=None, coordinates_format='numeric', sparse=False, stale_seconds=120):
+    """
+    Claim the most recent sample record matching a sample's identifying fields that no other loader is loading and
+    return its ID
+
+    A sample is being loaded while its claim is uncommitted or its heartbeat is less than stale_seconds old. The claim
+    sets the sample's loader_id and heartbeat, commit it before loading, see touch_sample and release_sample
+
+    :param cursor - DB Transaction
+    :param loader_id -- string, unique per run
+    :param status -- string
+    :param environment_id -- string
+    :param start_time -- date
+    :param end_time -- date
+    :param source_type -- string
+    :param inference_id -- string
+    :param coordinates_format -- string
+    :param sparse -- boolean
+    :param stale_seconds -- int
+    :return sample id -- int, None if there is no match
+    """
+    sample_id = None
+    try:
+        cursor.execute(SAMPLES_CLAIM_MATCHING, {
+            'loader_id': loader_id,
+            'status': status,
+            'environment_id': environment_id,
+            'start_time': start_time,
+            'end_time': end_time,
+            'source_type': source_type,
+            'inference_id': inference_id,
+            'coordinates_format': coordinates_format,
+            'sparse': sparse,
+            'stale_seconds': stale_seconds
+        })
+
+        row = cursor.fetchone()
+        if row is not None:
+            sample_id = row[0]
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to claim Sample record")
+
+    return sample_id
+
+
+def touch_sample(cursor, sample_id, loader_id):
+    """
+    Renew a claimed sample's heartbeat
+
+    :return boolean, False if the sample isn't claimed by loader_id (any more)
+    """
+    try:
+        cursor.execute(SAMPLES_HEARTBEAT, {
+            'sample_id': sample_id,
+            'loader_id': loader_id
+        })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to update Sample heartbeat")
+        return False
+
+    return cursor.rowcount > 0
+
+
+def release_sample(cursor, sample_id, loader_id):
+    try:
+        cursor.execute(SAMPLES_RELEASE, {
+            'sample_id': sample_id,
+            'loader_id': loader_id
+        })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to release Sample record")
+        return False
+
+    return True
+
+
+def find_sample_for_day(cursor, status, environment_id, day, source_type):
+    """
+    Find the sample served for an environment's day (the most recent, like the socket API's fetchSample)
+
+    :param cursor - DB Transaction
+    :param status -- string
+    :param environment_id -- string
+    :param day -- date
+    :param source_type -- string
+    :return sample -- {'id': int, 'start_time': date, 'end_time': date, 'frames_per_second': int, 'num_frames': int, 'coordinates_format': string, 'sparse': boolean}, None if there is no match
+    """
+    sample = None
+    try:
+        cursor.execute(SAMPLES_SELECT_FOR_DAY, {
+            'status': status,
+            'environment_id': environment_id,
+            'day': day,
+            'source_type': source_type
+        })
+
+        row = cursor.fetchone()
+        if row is not None:
+            sample = dict(zip(['id', 'start_time', 'end_time', 'frames_per_second', 'num_frames', 'coordinates_format', 'sparse'], row))
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to find Sample record")
+
+    return sample
+
+
+def update_sample_range(cursor, sample_id, end_time, num_frames):
+    try:
+        cursor.execute(SAMPLES_UPDATE_RANGE, {
+                       'sample_id': sample_id,
+                       'end_time': end_time,
+                       'num_frames': num_frames
+        })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to update Sample record")
+        return False
+
+    return True
+
+
 def update_sample_status(cursor, sample_id, status):
     try:
         cursor.execute(SAMPLES_UPDATE_STATUS, {
@@ -115,37 +388,111 @@ def delete_sample(cursor, sample_id):
     return True
 
 
-def put_geom(cursor, uuid, sample_id, attributes, geom_type, object_id, object_type, object_name):
+def fetch_sample_device_statuses(cursor, sample_id, shard=''):
     """
-    Insert geom record into database and return record ID
+    Fetch the load status of each device of a sample (or of one shard of a sharded sample)
 
-    Keyword arguments:
     :param cursor - DB Transaction
-    :param uuid -- string
     :param sample_id -- int
-    :param attributes -- JSON
-    :param geom_type -- string
-    :param object_id -- string
-    :param object_type -- string
-    :param object_name -- string
-    :return geom id -- int
+    :param shard -- string, shard key, '' for unsharded samples
+    :return device id to status map -- {string: string}
     """
-    geom_id = None
+    cursor.execute(SAMPLE_DEVICES_SELECT, {
+        'sample_id': sample_id,
+        'shard': shard
+    })
+    return {device_id: status for device_id, status in cursor.fetchall()}
+
+
+def put_sample_device_status(cursor, sample_id, device_id, assignment_id, status, shard=''):
     try:
-        cursor.execute(GEOMS_INSERT, {
-            'uuid': uuid,
+        cursor.execute(SAMPLE_DEVICES_UPSERT, {
             'sample_id': sample_id,
-            'attributes': attributes,
-            'type': geom_type,
-            'object_id': object_id,
-            'object_type': object_type,
-            'object_name': object_name
+            'device_id': device_id,
+            'shard': shard,
+            'assignment_id': assignment_id,
+            'status': status
+        })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to update Sample Device record")
+        return False
+
+    return True
+
+
+def delete_sample_device_statuses(cursor, sample_id):
+    try:
+        cursor.execute(SAMPLE_DEVICES_DELETE, {
+            'sample_id': sample_id
+        })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to delete Sample Device records")
+        return False
+
+    return True
+
+
+def delete_sample_coordinates_from_time(cursor, sample_id, from_time, coordinates_format='numeric'):
+    try:
+        cursor.execute(COORDINATE_BLOCKS_DELETE_FOR_SAMPLE_FROM_TIME if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS else COORDINATES_DELETE_FOR_SAMPLE_FROM_TIME, {
+            'sample_id': sample_id,
+            'from_time': from_time
+        })
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to delete Coordinate records")
+        return False
+
+    return True
+
+
+def put_geoms_bulk(cursor, sample_id, geoms, metrics=None, inserted=None):
+    """
+    Insert a batch of geom records with a single multi-row INSERT and return a map of geom uuid to record ID
+
+    Geoms already stored for the sample (matched on the (sample_id, uuid) unique index) are reused, uuids must be unique within the batch
+
+    :param cursor - DB Transaction
+    :param sample_id -- int
+    :param geoms -- [{'uuid': string, 'attributes': JSON, 'type': string, 'object_id': string, 'object_type': string, 'object_name': string}]
+    :param metrics -- optional LoadMetrics, the insert is added to its 'geom_insert' phase
+    :param inserted -- optional set, updated with the ids of the geoms that were created rather than reused
+    :return geom uuid to geom id map -- {string: int}, None on failure
+    """
+    geom_ids = None
+    try:
+        with (metrics.phase('geom_insert') if metrics is not None else nullcontext()):
+            rows = extras.execute_values(cursor,
+                                         GEOMS_INSERT_MANY,
+                                         [dict(geom, sample_id=sample_id) for geom in geoms],
+                                         template=GEOMS_INSERT_MANY_TEMPLATE,
+                                         page_size=max(len(geoms), 1),
+                                         fetch=True)
+        geom_ids = {uuid: geom_id for uuid, geom_id, _ in rows}
+        if inserted is not None:
+            inserted.update(geom_id for _, geom_id, is_inserted in rows if is_inserted)
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to insert collection of Geom records")
+
+    return geom_ids
+
+
+def delete_geoms(cursor, geom_ids):
+    """
+    Delete geom records, their coordinates are deleted with them
+
+    :param cursor -- DB Transaction
+    :param geom_ids -- [int]
+    :return boolean
+    """
+    try:
+        cursor.execute(GEOMS_DELETE, {
+            'geom_ids': list(geom_ids)
         })
-        geom_id = cursor.fetchone()[0]
     except (Exception, psycopg2.DatabaseError):
-        logging.exception("Failed to insert Geom record")
+        logging.exception("Failed to delete Geom records")
+        return False
 
-    return geom_id
+    return True
 
 
 def put_coordinate(cursor, device_id, assignment_id, geom_id, time, coordinates):
@@ -177,32 +524,203 @@ def put_coordinate(cursor, device_id, assignment_id, geom_id, time, coordinates)
     return coordinate_id
 
 
-def put_coordinates_list(cursor, coordinates):
+def coordinates_copy_table(coordinates_format='numeric'):
+    return 'coordinate_blocks' if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS else 'coordinates'
+
+
+def coordinates_copy_columns(coordinates_format='numeric'):
+    if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS:
+        return COORDINATE_BLOCKS_COLUMNS + (COORDINATE_BLOCKS_FORMAT_COLUMNS[coordinates_format],)
+    return ('device_id', 'assignment_id', 'geom_id', 'time', COORDINATES_FORMAT_COLUMNS[coordinates_format])
+
+
+def coordinates_staging_table(sample_id):
+    return "coordinates_staging_%d" % sample_id
+
+
+def create_coordinates_staging(cursor, sample_id, coordinates_format='numeric'):
+    """
+    Create (or reuse) an unlogged, unindexed staging table for a sample's coordinates
+
+    :param cursor: DB Transaction
+    :param sample_id: int
+    :param coordinates_format: string, the staging table is shaped like coordinate_blocks for 'blocks' and 'delta', coordinates otherwise
+    :return table name: string, None on failure
+    """
+    table = coordinates_staging_table(sample_id)
+    try:
+        cursor.execute(sql.SQL(COORDINATES_STAGING_CREATE).format(table=sql.Identifier(table), target=sql.Identifier(coordinates_copy_table(coordinates_format))))
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to create Coordinate staging table")
+        return None
+
+    return table
+
+
+def validate_coordinates_staging(cursor, table, sample_id, coordinates_format='numeric'):
+    """
+    Check a staging table's rows can be moved into coordinates: no duplicate (device_id, geom_id, time), no missing
+    values and only geoms of the sample
+
+    :param cursor: DB Transaction
+    :param table: string
+    :param sample_id: int
+    :param coordinates_format: string
+    :return {'rows': int, 'duplicates': int, 'incomplete': int, 'foreign_geoms': int}
+    """
+    validate = COORDINATE_BLOCKS_STAGING_VALIDATE if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS else COORDINATES_STAGING_VALIDATE
+    cursor.execute(sql.SQL(validate).format(table=sql.Identifier(table)), {
+        'sample_id': sample_id
+    })
+    return dict(zip(('rows', 'duplicates', 'incomplete', 'foreign_geoms'), cursor.fetchone()))
+
+
+def move_coordinates_staging(cursor, table, coordinates_format='numeric'):
+    """
+    Insert a staging table's rows into coordinates (or coordinate_blocks) with a single INSERT ... SELECT
+
+    :param cursor: DB Transaction
+    :param table: string
+    :param coordinates_format: string
+    :return rows moved: int, None on failure
+    """
+    move = COORDINATE_BLOCKS_STAGING_MOVE if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS else COORDINATES_STAGING_MOVE
+    try:
+        cursor.execute(sql.SQL(move).format(table=sql.Identifier(table)))
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to move Coordinate records out of staging")
+        return None
+
+    return cursor.rowcount
+
+
+def drop_coordinates_staging(cursor, table):
+    try:
+        cursor.execute(sql.SQL(COORDINATES_STAGING_DROP).format(table=sql.Identifier(table)))
+    except (Exception, psycopg2.DatabaseError):
+        logging.exception("Failed to drop Coordinate staging table")
+        return False
+
+    return True
+
+
+def put_coordinates_list(cursor, coordinates, copy_format='text', chunk_size=DEFAULT_CHUNK_SIZE, stats=None, coordinates_format='numeric', block_seconds=DEFAULT_BLOCK_SECONDS, quantum=0, sparse=False, metrics=None):
     """
     Insert a batch of coordinate records into database and return boolean for success/failure
 
     :param cursor: DB Transaction
-    :param coordinates: [{'device_id': int, 'assignment_id': int, 'geom_id': int, 'time': datetime, 'coordinates': []}]
+    :param coordinates: [{'device_id': int, 'assignment_id': int, 'geom_id': int, 'time': np.datetime64[], 'coordinates': np.ndarray}]
+    :param copy_format: 'text' or 'binary'
+    :param chunk_size: bytes per read during the COPY
+    :param stats: optional dict, updated with 'rows', 'bytes' and 'seconds' of the COPY
+    :param coordinates_format: 'numeric', 'real', 'packed', 'blocks' or 'delta'
+    :param block_seconds: int, length of a 'blocks' or 'delta' sample's time blocks
+    :param quantum: float, 'delta' quantization step, 0 for lossless
+    :param sparse: boolean, skip frames (or blocks) with no valid coordinates
+    :param metrics: optional LoadMetrics, formatting is added to its 'format' phase and the rest of the COPY to 'copy'
     :return success: boolean
     """
+    format_seconds = 0.0
+
+    def chunks():
+        nonlocal format_seconds
+        for coordinate_block in coordinates:
+            started = time.perf_counter()
+            data = format_coordinates(coordinate_block, copy_format, coordinates_format, block_seconds, quantum, sparse)
+            format_seconds += time.perf_counter() - started
+            yield data, len(coordinate_block['coordinates'])
+
+    stats = stats if stats is not None else dict()
+    success = copy_coordinates_chunks(cursor, chunks(), copy_format=copy_format, chunk_size=chunk_size, stats=stats, coordinates_format=coordinates_format)
+    if metrics is not None:
+        metrics.add('format', format_seconds)
+        metrics.add('copy', stats.get('seconds', 0.0) - format_seconds)
+    return success
+
+
+def format_coordinates(coordinates, copy_format='text', coordinates_format='numeric', block_seconds=DEFAULT_BLOCK_SECONDS, quantum=0, sparse=False):
+    """
+    Format a columnar block of coordinates as COPY data
+
+    assignment_id may be a single id or an array with an id per frame, a None id is written as NULL
+
+    :param coordinates: {'device_id': int, 'assignment_id': int or np.ndarray, 'geom_id': int, 'frames_per_second': int, 'time': np.datetime64[], 'coordinates': np.ndarray}
+    :param copy_format: 'text' or 'binary'
+    :param coordinates_format: 'numeric', 'real' or 'packed' for a row per frame, 'blocks' or 'delta' (delta encoded,
+        see codec) for a row per time block of block_seconds
+    :param block_seconds: int
+    :param quantum: float, 'delta' quantization step, 0 for lossless
+    :param sparse: boolean, skip frames with no valid coordinates. Blocks keep every frame of a block (a frame's time is
+        its offset in the block), so only blocks with no valid coordinates are skipped
+    :return data: string (text) or bytes (binary)
+    """
+    if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS:
+        blocks = [block for run in split_assignment_runs(coordinates) for block in split_coordinate_blocks(run, block_seconds)]
+        if sparse:
+            blocks = [block for block in blocks if not np.isnan(block['coordinates']).all()]
+        if copy_format == 'binary':
+            return format_coordinate_blocks_binary(blocks, coordinates_format, quantum)
+        return format_coordinate_blocks_text(blocks, coordinates_format, quantum)
+
+    if sparse:
+        coordinates = drop_empty_frames(coordinates)
+
+    if copy_format == 'binary':
+        return b"".join(format_coordinates_binary(run, coordinates_format) for run in split_assignment_runs(coordinates))
+    return "".join(format_coordinates_text(run, coordinates_format) for run in split_assignment_runs(coordinates))
+
+
+def copy_coordinates_chunks(cursor, chunks, copy_format='text', chunk_size=DEFAULT_CHUNK_SIZE, stats=None, table=None, coordinates_format='numeric'):
+    """
+    COPY pre-formatted coordinate chunks into the database and return boolean for success/failure
+
+    Chunks are consumed lazily, so a generator can keep producing them while the COPY is in progress
+
+    :param cursor: DB Transaction
+    :param chunks: iterable of (data, num_rows) tuples, data produced by format_coordinates
+    :param copy_format: 'text' or 'binary'
+    :param chunk_size: bytes per read during the COPY
+    :param stats: optional dict, updated with 'rows', 'bytes' and 'seconds' of the COPY, and 'error' when it fails
+    :param table: table to COPY into, a staging table or defaults to coordinates (coordinate_blocks for 'blocks' and 'delta')
+    :param coordinates_format: 'numeric', 'real', 'packed', 'blocks' or 'delta', the format the chunks were formatted with
+    :return success: boolean
+    """
+    table = table or coordinates_copy_table(coordinates_format)
+    columns = coordinates_copy_columns(coordinates_format)
     success = False
+    num_rows = 0
+    f = None
     try:
-        # Use execute_values
-        # psycopg2.extras.execute_values(cursor, COORDINATES_INSERT_MANY, coordinates, "(%(sample_id)s, %(geom_id)s, %(time)s, %(coordinates)s)", 100000)
-
         def coordinate_generator():
-            for coordinate in coordinates:
-                clean_coordinates = np.where(np.isnan(coordinate['coordinates']), "NULL", coordinate['coordinates'])
-                str_coordinates = "{%s}" % (','.join(clean_coordinates.tolist()))
-                yield "\t".join([str(coordinate['device_id']), str(coordinate['assignment_id']), str(coordinate['geom_id']), str(coordinate['time']), str_coordinates])
-                #formatted_content.append("\t".join([str(coordinate['sample_id']), str(coordinate['geom_id']), str(coordinate['time']), str_coordinates]))
+            nonlocal num_rows
+
+            if copy_format == 'binary':
+                yield PG_BINARY_COPY_HEADER
+
+            for data, chunk_rows in chunks:
+                if len(data) == 0:
+                    continue
 
-        f = IteratorFile(coordinate_generator())
+                yield data
+                num_rows += chunk_rows
 
-        cursor.copy_from(f, 'coordinates', columns=('device_id', 'assignment_id', 'geom_id', 'time', 'coordinates'))
+            if copy_format == 'binary':
+                yield PG_BINARY_COPY_TRAILER
+
+        f = IteratorFile(coordinate_generator(), chunk_size=chunk_size)
+
+        if copy_format == 'binary':
+            cursor.copy_expert(sql.SQL(COORDINATES_COPY_BINARY).format(table=sql.Identifier(table), columns=sql.SQL(', ').join(map(sql.Identifier, columns))), f, size=chunk_size)
+        else:
+            cursor.copy_from(f, table, columns=columns, size=chunk_size)
 
         success = True
-    except (Exception, psycopg2.DatabaseError):
+    except (Exception, psycopg2.DatabaseError) as error:
         logging.exception("Failed to insert collection of Coordinate records")
+        if stats is not None:
+            stats['error'] = error
+    finally:
+        if stats is not None and f is not None:
+            stats.update({'rows': num_rows, 'bytes': f.bytes_read, 'seconds': f.elapsed})
 
     return success
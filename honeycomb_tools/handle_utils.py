@@ -1,43 +1,522 @@
 import io
-import sys
+import struct
+import time
 
+import numpy as np
 
-class IteratorFile(io.TextIOBase):
-    """ given an iterator which yields strings,
+from honeycomb_tools.codec import encode_block
 
-    Author: JSHeedy
-    Source: https://gist.github.com/jsheedy/ed81cdf18190183b3b7d
+# Size of the reads issued by psycopg2 against IteratorFile during a COPY
+DEFAULT_CHUNK_SIZE = 256 * 1024
 
-    return a file like object for reading those strings """
+# Length of the time blocks a 'blocks' sample's coordinates are stored in, matches the websocket API's fetch window
+DEFAULT_BLOCK_SECONDS = 25
 
-    def __init__(self, it):
-        self._it = it
-        self._f = io.StringIO()
+# PostgreSQL binary COPY framing, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+PG_BINARY_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + b"\x00\x00\x00\x00" + b"\x00\x00\x00\x00"
+PG_BINARY_COPY_TRAILER = b"\xff\xff"
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+PG_NUMERIC_OID = 1700
+PG_REAL_OID = 700
+PG_NUMERIC_POS = 0x0000
+PG_NUMERIC_NEG = 0x4000
 
-    def read(self, length=sys.maxsize):
+# Every numeric is written with a fixed number of base-10000 digit groups, which bounds the
+# encodable range to |value| < 10000 ** NUMERIC_INTEGER_GROUPS and the precision to 4 * NUMERIC_FRACTION_GROUPS decimals
+NUMERIC_INTEGER_GROUPS = 2
+NUMERIC_FRACTION_GROUPS = 2
 
-        try:
-            while self._f.tell() < length:
-                self._f.write(next(self._it) + "\n")
 
-        except StopIteration as e:
-            # soak up StopIteration. this block is not necessary because
-            # of finally, but just to be explicit
-            pass
+class IteratorFile(io.RawIOBase):
+    """
+    Given an iterator which yields strings or bytes chunks, return a binary file like object for reading those chunks
 
-        except Exception as e:
-            print("uncaught exception: {}".format(e))
+    Strings are encoded as UTF-8. Chunks are handed out as-is or sliced, never buffered and re-joined (except by a read
+    to EOF), so at most one pending chunk is held in memory. Exceptions raised by the iterator propagate to the reader so a COPY is aborted
+    rather than silently truncated.
 
-        finally:
-            self._f.seek(0)
-            data = self._f.read(length)
+    Originally based on https://gist.github.com/jsheedy/ed81cdf18190183b3b7d by JSHeedy
+    """
 
-            # save the remainder for next read
-            remainder = self._f.read()
-            self._f.seek(0)
-            self._f.truncate(0)
-            self._f.write(remainder)
-            return data
+    def __init__(self, it, chunk_size=DEFAULT_CHUNK_SIZE):
+        self._it = iter(it)
+        self._chunk_size = chunk_size
+        self._chunk = b""
+        self._offset = 0
+        self._time_started = None
+        self.bytes_read = 0
 
-    def readline(self):
-        return next(self._it)
+    def readable(self):
+        return True
+
+    def _fill(self):
+        if self._time_started is None:
+            self._time_started = time.perf_counter()
+
+        while self._offset >= len(self._chunk):
+            try:
+                chunk = next(self._it)
+            except StopIteration:
+                return False
+
+            self._chunk = chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+            self._offset = 0
+
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # Read to EOF, the one read that joins chunks
+            return b"".join(iter(lambda: self.read(self._chunk_size), b""))
+
+        if not self._fill():
+            return b""
+
+        if self._offset == 0 and len(self._chunk) <= size:
+            data = self._chunk
+        else:
+            data = self._chunk[self._offset:self._offset + size]
+
+        self._offset += len(data)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, b):
+        if not self._fill():
+            return 0
+
+        with memoryview(self._chunk) as view:
+            size = min(len(b), len(self._chunk) - self._offset)
+            b[:size] = view[self._offset:self._offset + size]
+
+        self._offset += size
+        self.bytes_read += size
+        return size
+
+    @property
+    def elapsed(self):
+        if self._time_started is None:
+            return 0.0
+        return time.perf_counter() - self._time_started
+
+
+def format_coordinates_text(coordinates, coordinates_format='numeric'):
+    """
+    Format a columnar block of coordinates as tab delimited COPY text using bulk numpy string operations
+
+    :param coordinates: {'device_id': string, 'assignment_id': string, 'geom_id': int, 'time': np.datetime64[], 'coordinates': np.ndarray}
+    :param coordinates_format: 'numeric' or 'real' array literals, or 'packed' bytea
+    :return rows: string, one newline terminated line per frame
+    """
+    values = np.asarray(coordinates['coordinates'])
+    if len(values) == 0:
+        return ""
+
+    assignment_id = "\\N" if coordinates['assignment_id'] is None else str(coordinates['assignment_id'])
+    prefix = "\t".join([str(coordinates['device_id']), assignment_id, str(coordinates['geom_id'])])
+    rows = np.char.add(prefix + "\t", np.datetime_as_string(coordinates['time'], unit='us'))
+
+    if coordinates_format == 'packed':
+        # bytea hex input, the backslash is doubled because it's COPY's escape character
+        packed, row_lengths = pack_coordinates(values)
+        packed_hex = packed.tobytes().hex()
+        offsets = np.concatenate([[0], np.cumsum(row_lengths) * 2])
+        rows = np.char.add(rows, "\t\\\\x")
+        return "\n".join(np.char.add(rows, [packed_hex[start:end] for start, end in zip(offsets[:-1], offsets[1:])]).tolist()) + "\n"
+
+    # float32 text is shorter, and parses as real without rounding
+    text_values = (values.astype(np.float32) if coordinates_format == 'real' else values).astype(str)
+    text_values[np.isnan(values)] = "NULL"
+
+    for idx in range(text_values.shape[1]):
+        rows = np.char.add(rows, ("\t{" if idx == 0 else ","))
+        rows = np.char.add(rows, text_values[:, idx])
+    rows = np.char.add(rows, "}")
+
+    return "\n".join(rows.tolist()) + "\n"
+
+
+def pack_coordinates(values):
+    """
+    Pack each row of a 2D ndarray of floats in the 'packed' bytea layout:
+
+        uint16 LE      number of values (n)
+        ceil(n / 8)    NaN bitmap, bit i (least significant bit first) is set when value i is NaN
+        float32 LE     each value that isn't NaN, in order
+
+    :param values: 2D np.ndarray of floats
+    :return (packed, row_lengths): np.ndarray[uint8] of every row's bytes back to back, np.ndarray of each row's byte length
+    """
+    values = np.asarray(values, dtype=np.float64)
+    num_rows, num_values = values.shape
+    nan_mask = np.isnan(values)
+
+    row_dtype = packed_row_dtype(num_values)
+    rows = np.zeros(num_rows, dtype=row_dtype)
+    rows['count'] = num_values
+    rows['bitmap'] = np.packbits(nan_mask, axis=1, bitorder='little')
+    rows['values'] = np.where(nan_mask, 0, values)
+
+    # NaN values are only their bitmap bit, so drop their float bytes
+    keep = np.ones((num_rows, row_dtype.itemsize), dtype=bool)
+    keep[:, row_dtype.fields['values'][1]:] = np.repeat(~nan_mask, 4, axis=1)
+
+    return rows.view(np.uint8).reshape((num_rows, -1))[keep], keep.sum(axis=1)
+
+
+def packed_row_dtype(num_values):
+    return np.dtype([
+        ('count', '<u2'),
+        ('bitmap', 'u1', ((num_values + 7) // 8,)),
+        ('values', '<f4', (num_values,))
+    ])
+
+
+def unpack_coordinates(data):
+    """
+    Decode one 'packed' bytea value, see pack_coordinates
+
+    :param data: bytes
+    :return values: np.ndarray of float64 with NaNs
+    """
+    num_values = struct.unpack_from('<H', data)[0]
+    bitmap_size = (num_values + 7) // 8
+    nan_mask = np.unpackbits(np.frombuffer(data, dtype=np.uint8, count=bitmap_size, offset=2), count=num_values, bitorder='little').astype(bool)
+
+    values = np.full(num_values, np.nan)
+    values[~nan_mask] = np.frombuffer(data, dtype='<f4', offset=2 + bitmap_size)
+    return values
+
+
+def encode_numerics_binary(values):
+    """
+    Encode an ndarray of floats as fixed width PostgreSQL binary numerics, NaNs are left for the caller to write as NULL
+
+    Values are rounded to 4 * NUMERIC_FRACTION_GROUPS decimals, infinite values and values of magnitude
+    10000 ** NUMERIC_INTEGER_GROUPS or more raise ValueError
+
+    :param values: np.ndarray of floats
+    :return (sign, dscale, digits): np.ndarrays, digits has a trailing axis of NUMERIC_INTEGER_GROUPS + NUMERIC_FRACTION_GROUPS
+    """
+    fraction_scale = 10 ** (4 * NUMERIC_FRACTION_GROUPS)
+
+    # Values that don't fit fail the COPY rather than being written wrong, the text COPY format has no such limit
+    finite = np.where(np.isnan(values), 0, values)
+    out_of_range = ~np.isfinite(finite) | (np.abs(finite) >= 10000 ** NUMERIC_INTEGER_GROUPS)
+    if out_of_range.any():
+        raise ValueError("Coordinate value %r out of range for binary numeric encoding, |value| must be below %d (use COPY_FORMAT=text)" % (float(finite[out_of_range].flat[0]), 10000 ** NUMERIC_INTEGER_GROUPS))
+
+    magnitude = np.abs(finite)
+    integer_part = np.floor(magnitude)
+    fraction_part = np.rint((magnitude - integer_part) * fraction_scale).astype(np.int64)
+    integer_part = integer_part.astype(np.int64)
+
+    # Rounding the fraction may carry into the integer part
+    carry = fraction_part == fraction_scale
+    integer_part[carry] += 1
+    fraction_part[carry] = 0
+
+    groups = []
+    for idx in reversed(range(NUMERIC_INTEGER_GROUPS)):
+        groups.append((integer_part // 10000 ** idx) % 10000)
+    for idx in reversed(range(NUMERIC_FRACTION_GROUPS)):
+        groups.append((fraction_part // 10000 ** idx) % 10000)
+    digits = np.stack(groups, axis=-1)
+
+    # dscale is the count of significant decimal places, so 1.5 reads back as 1.5 rather than 1.50000000
+    dscale = np.full(values.shape, 4 * NUMERIC_FRACTION_GROUPS, dtype=np.int64)
+    remainder = fraction_part.copy()
+    for _ in range(4 * NUMERIC_FRACTION_GROUPS):
+        trailing_zero = (remainder % 10 == 0) & (dscale > 0)
+        dscale[trailing_zero] -= 1
+        remainder[trailing_zero] //= 10
+
+    sign = np.where(finite < 0, PG_NUMERIC_NEG, PG_NUMERIC_POS)
+    return sign, dscale, digits
+
+
+def format_coordinates_binary(coordinates, coordinates_format='numeric'):
+    """
+    Format a columnar block of coordinates as PostgreSQL binary COPY tuples (without the COPY header/trailer)
+
+    Columns are (device_id, assignment_id, geom_id, time, coordinates) where coordinates is a numeric[] or real[] with
+    NaNs written as NULL elements, or a 'packed' bytea (see pack_coordinates). Timestamps are written as int64
+    microseconds since 2000-01-01.
+
+    :param coordinates: {'device_id': string, 'assignment_id': string, 'geom_id': int, 'time': np.datetime64[], 'coordinates': np.ndarray}
+    :param coordinates_format: 'numeric', 'real' or 'packed'
+    :return tuples: bytes
+    """
+    values = np.asarray(coordinates['coordinates'], dtype=np.float64)
+    if len(values) == 0:
+        return b""
+
+    num_rows, num_values = values.shape
+    nan_mask = np.isnan(values)
+
+    def text_field(value):
+        if value is None:
+            return struct.pack('>i', -1)
+        encoded = str(value).encode('utf-8')
+        return struct.pack('>i', len(encoded)) + encoded
+
+    prefix = b"".join([
+        struct.pack('>h', 5),
+        text_field(coordinates['device_id']),
+        text_field(coordinates['assignment_id']),
+        struct.pack('>ii', 4, coordinates['geom_id'])
+    ])
+    times = (np.asarray(coordinates['time']).astype('datetime64[us]') - PG_EPOCH).astype(np.int64)
+
+    if coordinates_format == 'packed':
+        packed_dtype = packed_row_dtype(num_values)
+        row_dtype = np.dtype([
+            ('prefix', 'u1', (len(prefix),)),
+            ('time_length', '>i4'),
+            ('time', '>i8'),
+            ('packed_length', '>i4'),
+            ('packed', packed_dtype)
+        ])
+
+        rows = np.zeros(num_rows, dtype=row_dtype)
+        rows['prefix'] = np.frombuffer(prefix, dtype=np.uint8)
+        rows['time_length'] = 8
+        rows['time'] = times
+        rows['packed_length'] = packed_dtype.itemsize - 4 * nan_mask.sum(axis=1)
+        rows['packed']['count'] = num_values
+        rows['packed']['bitmap'] = np.packbits(nan_mask, axis=1, bitorder='little')
+        rows['packed']['values'] = np.where(nan_mask, 0, values)
+
+        keep = np.ones((num_rows, row_dtype.itemsize), dtype=bool)
+        keep[:, row_dtype.fields['packed'][1] + packed_dtype.fields['values'][1]:] = np.repeat(~nan_mask, 4, axis=1)
+
+        return rows.view(np.uint8).reshape((num_rows, -1))[keep].tobytes()
+
+    if coordinates_format == 'real':
+        element_type = PG_REAL_OID
+        element_dtype = np.dtype([
+            ('length', '>i4'),
+            ('value', '>f4')
+        ])
+    else:
+        element_type = PG_NUMERIC_OID
+        num_groups = NUMERIC_INTEGER_GROUPS + NUMERIC_FRACTION_GROUPS
+        element_dtype = np.dtype([
+            ('length', '>i4'),
+            ('ndigits', '>i2'),
+            ('weight', '>i2'),
+            ('sign', '>i2'),
+            ('dscale', '>i2'),
+            ('digits', '>i2', (num_groups,))
+        ])
+
+    row_dtype = np.dtype([
+        ('prefix', 'u1', (len(prefix),)),
+        ('time_length', '>i4'),
+        ('time', '>i8'),
+        ('array_length', '>i4'),
+        ('ndim', '>i4'),
+        ('hasnull', '>i4'),
+        ('element_type', '>i4'),
+        ('dim', '>i4'),
+        ('lower_bound', '>i4'),
+        ('elements', element_dtype, (num_values,))
+    ])
+
+    rows = np.zeros(num_rows, dtype=row_dtype)
+    rows['prefix'] = np.frombuffer(prefix, dtype=np.uint8)
+    rows['time_length'] = 8
+    rows['time'] = times
+    rows['ndim'] = 1
+    rows['hasnull'] = nan_mask.any(axis=1)
+    rows['element_type'] = element_type
+    rows['dim'] = num_values
+    rows['lower_bound'] = 1
+
+    elements = rows['elements']
+    elements['length'] = np.where(nan_mask, -1, element_dtype.itemsize - 4)
+    if coordinates_format == 'real':
+        elements['value'] = np.where(nan_mask, 0, values)
+    else:
+        sign, dscale, digits = encode_numerics_binary(values)
+        elements['ndigits'] = num_groups
+        elements['weight'] = NUMERIC_INTEGER_GROUPS - 1
+        elements['sign'] = sign
+        elements['dscale'] = dscale
+        elements['digits'] = digits
+
+    # NULL elements are only their -1 length word, so drop the rest of their bytes
+    element_sizes = np.where(nan_mask, 4, element_dtype.itemsize)
+    rows['array_length'] = 20 + element_sizes.sum(axis=1)
+
+    keep = np.ones((num_rows, row_dtype.itemsize), dtype=bool)
+    element_keep = np.ones((num_rows, num_values, element_dtype.itemsize), dtype=bool)
+    element_keep[:, :, 4:] = ~nan_mask[:, :, np.newaxis]
+    keep[:, row_dtype.fields['elements'][1]:] = element_keep.reshape((num_rows, -1))
+
+    return rows.view(np.uint8).reshape((num_rows, -1))[keep].tobytes()
+
+
+def drop_empty_frames(coordinates):
+    """
+    Drop the frames of a columnar block of coordinates where every value is NaN
+
+    :param coordinates: {'device_id': string, 'assignment_id': string or np.ndarray, 'geom_id': int, 'time': np.datetime64[], 'coordinates': np.ndarray}
+    :return coordinates
+    """
+    valid = ~np.isnan(coordinates['coordinates']).all(axis=1)
+    if valid.all():
+        return coordinates
+
+    assignment_ids = coordinates['assignment_id']
+    return dict(coordinates,
+                assignment_id=assignment_ids[valid] if isinstance(assignment_ids, np.ndarray) else assignment_ids,
+                time=coordinates['time'][valid],
+                coordinates=coordinates['coordinates'][valid])
+
+
+def split_assignment_runs(coordinates):
+    """
+    Split a columnar block of coordinates whose assignment_id is a per-frame array into blocks of constant assignment_id
+
+    :param coordinates: {'device_id': string, 'assignment_id': string or np.ndarray, 'geom_id': int, 'time': np.datetime64[], 'coordinates': np.ndarray}
+    :return [coordinates]
+    """
+    assignment_ids = coordinates['assignment_id']
+    if not isinstance(assignment_ids, np.ndarray):
+        return [coordinates]
+    if len(assignment_ids) == 0:
+        return [dict(coordinates, assignment_id=None)]
+
+    run_starts = np.concatenate([[0], np.flatnonzero(assignment_ids[1:] != assignment_ids[:-1]) + 1])
+    run_ends = np.concatenate([run_starts[1:], [len(assignment_ids)]])
+    return [dict(coordinates,
+                 assignment_id=assignment_ids[start],
+                 time=coordinates['time'][start:end],
+                 coordinates=coordinates['coordinates'][start:end]) for start, end in zip(run_starts, run_ends)]
+
+
+def split_coordinate_blocks(coordinates, block_seconds=DEFAULT_BLOCK_SECONDS):
+    """
+    Split a columnar block of coordinates with a single assignment_id into time blocks of at most block_seconds
+
+    Blocks are aligned to multiples of block_seconds since the Unix epoch, so boundaries line up across devices, shards
+    and appends. A block's start_time is the time of its first frame.
+
+    :param coordinates: {'device_id': string, 'assignment_id': string, 'geom_id': int, 'frames_per_second': int, 'time': np.datetime64[], 'coordinates': np.ndarray}
+    :param block_seconds: int
+    :return [{'device_id': string, 'assignment_id': string, 'geom_id': int, 'frames_per_second': int, 'start_time': np.datetime64, 'coordinates': np.ndarray}]
+    """
+    times = np.asarray(coordinates['time']).astype('datetime64[us]')
+    if len(times) == 0:
+        return []
+
+    block_ids = times.astype(np.int64) // int(block_seconds * 1000000)
+    block_starts = np.concatenate([[0], np.flatnonzero(block_ids[1:] != block_ids[:-1]) + 1])
+    block_ends = np.concatenate([block_starts[1:], [len(times)]])
+    return [{
+        'device_id': coordinates['device_id'],
+        'assignment_id': coordinates['assignment_id'],
+        'geom_id': coordinates['geom_id'],
+        'frames_per_second': coordinates['frames_per_second'],
+        'start_time': times[start],
+        'coordinates': coordinates['coordinates'][start:end]
+    } for start, end in zip(block_starts, block_ends)]
+
+
+def format_coordinate_blocks_text(blocks, coordinates_format='blocks', quantum=0):
+    """
+    Format coordinate blocks as tab delimited COPY text
+
+    Columns are (device_id, assignment_id, geom_id, start_time, frames_per_second, num_frames, coordinates) where
+    coordinates is a 2D real[][] literal with one inner array per frame and NaNs written as NULL. For 'delta' the last
+    column is coordinates_encoded instead, a bytea of the block delta encoded by codec.encode_block
+
+    :param blocks: [block] from split_coordinate_blocks
+    :param coordinates_format: 'blocks' or 'delta'
+    :param quantum: float, 'delta' quantization step, 0 for lossless
+    :return rows: string, one newline terminated line per block
+    """
+    rows = []
+    for block in blocks:
+        values = np.asarray(block['coordinates'])
+        if coordinates_format == 'delta':
+            column = "\\\\x" + encode_block(values, quantum).hex()
+        else:
+            text_values = values.astype(np.float32).astype(str)
+            text_values[np.isnan(values)] = "NULL"
+            column = "{{" + "},{".join(",".join(frame) for frame in text_values.tolist()) + "}}"
+
+        rows.append("\t".join([
+            str(block['device_id']),
+            "\\N" if block['assignment_id'] is None else str(block['assignment_id']),
+            str(block['geom_id']),
+            np.datetime_as_string(block['start_time'], unit='us'),
+            str(block['frames_per_second']),
+            str(len(values)),
+            column
+        ]) + "\n")
+
+    return "".join(rows)
+
+
+def format_coordinate_blocks_binary(blocks, coordinates_format='blocks', quantum=0):
+    """
+    Format coordinate blocks as PostgreSQL binary COPY tuples (without the COPY header/trailer), see format_coordinate_blocks_text
+
+    :param blocks: [block] from split_coordinate_blocks
+    :param coordinates_format: 'blocks' or 'delta'
+    :param quantum: float, 'delta' quantization step, 0 for lossless
+    :return tuples: bytes
+    """
+    element_dtype = np.dtype([
+        ('length', '>i4'),
+        ('value', '>f4')
+    ])
+
+    def text_field(value):
+        if value is None:
+            return struct.pack('>i', -1)
+        encoded = str(value).encode('utf-8')
+        return struct.pack('>i', len(encoded)) + encoded
+
+    tuples = []
+    for block in blocks:
+        values = np.asarray(block['coordinates'], dtype=np.float64)
+        if coordinates_format == 'delta':
+            array = encode_block(values, quantum)
+        else:
+            array = real_block_array(values, element_dtype)
+
+        tuples.append(b"".join([
+            struct.pack('>h', 7),
+            text_field(block['device_id']),
+            text_field(block['assignment_id']),
+            struct.pack('>ii', 4, block['geom_id']),
+            struct.pack('>iq', 8, int((np.datetime64(block['start_time'], 'us') - PG_EPOCH).astype(np.int64))),
+            struct.pack('>ii', 4, int(block['frames_per_second'])),
+            struct.pack('>ii', 4, len(values)),
+            struct.pack('>i', len(array)),
+            array
+        ]))
+
+    return b"".join(tuples)
+
+
+def real_block_array(values, element_dtype):
+    """
+    A 2D real[][] in PostgreSQL's binary array format, one inner array per frame and NaNs as NULL elements
+
+    :return bytes
+    """
+    num_frames, num_values = values.shape
+    nan_mask = np.isnan(values)
+
+    elements = np.zeros((num_frames, num_values), dtype=element_dtype)
+    elements['length'] = np.where(nan_mask, -1, 4)
+    elements['value'] = np.where(nan_mask, 0, values)
+
+    # NULL elements are only their -1 length word, so drop their value bytes
+    keep = np.ones((num_frames, num_values, element_dtype.itemsize), dtype=bool)
+    keep[:, :, 4:] = ~nan_mask[:, :, np.newaxis]
+    return struct.pack('>iiiiiii', 2, int(nan_mask.any()), PG_REAL_OID, num_frames, 1, num_values, 1) + elements.view(np.uint8).reshape((num_frames, num_values, -1))[keep].tobytes()
@@ -1,16 +1,22 @@
-from datetime import datetime, timezone
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone
 from gqlpycgen.api import ISO_FORMAT
+import numpy as np
+
+from honeycomb_tools.cache import cached, get_cache
 
 
 def wf_strptime(date_string):
     return datetime.strptime(date_string, ISO_FORMAT).replace(tzinfo=timezone.utc)
 
 
+@cached('environment_id')
 def get_environment_id(honeycomb_client, environment_name):
     environments = honeycomb_client.query.findEnvironment(name=environment_name)
     return environments.data[0].get('environment_id')
 
 
+@cached('inference')
 def fetch_inference_for_inference_id(honeycomb_client, inference_id):
     return honeycomb_client.query.query(
         """
@@ -61,6 +67,7 @@ def fetch_first_pose_for_inference_id(honeycomb_client, inference_id):
     return next((p for p in data.get('searchPoses2D').get('poses')), None)
 
 
+@cached('assignments')
 def fetch_assignments(honeycomb_client, environment_id):
     return honeycomb_client.query.query(
         """
@@ -111,14 +118,103 @@ def get_environment_for_inference_id(honeycomb_client, inference_id):
     }
 
 
+class AssignmentIndex:
+    """
+    Device assignments pre-parsed into per-device intervals sorted by start time
+
+    Looking up a device's assignment at a time is a bisect rather than a filter over every assignment
+    """
+
+    def __init__(self, assignments):
+        intervals = dict()
+        self.devices = dict()
+        for assignment in assignments:
+            device_id = (assignment.get('assigned') or dict()).get('device_id')
+            if device_id is None:
+                continue
+
+            start = wf_strptime(assignment['start'])
+            end = wf_strptime(assignment['end']) if assignment['end'] is not None else None
+            intervals.setdefault(device_id, []).append((start, end, assignment))
+            self.devices[device_id] = assignment['assigned']
+
+        self._intervals = {device_id: sorted(device_intervals, key=lambda i: i[0]) for device_id, device_intervals in intervals.items()}
+        self._starts = {device_id: [i[0] for i in device_intervals] for device_id, device_intervals in self._intervals.items()}
+
+    def assignment_at(self, device_id, time, assignment_filter=None):
+        """
+        :param device_id -- string
+        :param time -- datetime
+        :param assignment_filter -- optional function, assignments it rejects are skipped, so an overlapping assignment
+        it accepts is found instead
+        :return assignment -- dict, None if the device isn't assigned at time
+        """
+        intervals = self._intervals.get(device_id)
+        if intervals is None:
+            return None
+
+        # Latest started interval first, earlier ones only matter if intervals overlap
+        for idx in reversed(range(bisect_right(self._starts[device_id], time))):
+            _, end, assignment = intervals[idx]
+            if (end is None or end >= time) and (assignment_filter is None or assignment_filter(assignment)):
+                return assignment
+
+        return None
+
+    def assignment_ids_at_times(self, device_id, times, assignment_filter=None):
+        """
+        Vectorized assignment lookup for a device's frame times, a searchsorted over the boundaries of the device's
+        assignment intervals
+
+        :param device_id -- string
+        :param times -- np.ndarray of datetime64, naive UTC
+        :param assignment_filter -- optional function, assignments it rejects are treated as unassigned
+        :return np.ndarray of assignment ids (object), None where the device isn't assigned
+        """
+        assignment_ids = np.full(len(times), None, dtype=object)
+
+        intervals = self._intervals.get(device_id)
+        if intervals is None:
+            return assignment_ids
+
+        # Assignment ends are inclusive, the interval closes a microsecond later
+        boundaries = sorted(set([start for start, _, _ in intervals] + [end + timedelta(microseconds=1) for _, end, _ in intervals if end is not None]))
+        boundary_assignment_ids = np.full(len(boundaries), None, dtype=object)
+        for idx, boundary in enumerate(boundaries):
+            assignment = self.assignment_at(device_id, boundary, assignment_filter=assignment_filter)
+            if assignment is not None:
+                boundary_assignment_ids[idx] = assignment['assignment_id']
+
+        boundary_times = np.array([boundary.replace(tzinfo=None) for boundary in boundaries], dtype='datetime64[us]')
+        boundary_idx = np.searchsorted(boundary_times, np.asarray(times, dtype='datetime64[us]'), side='right') - 1
+        assigned = boundary_idx >= 0
+        assignment_ids[assigned] = boundary_assignment_ids[boundary_idx[assigned]]
+        return assignment_ids
+
+    def assignments_at(self, time, assignment_filter=None):
+        assignments = [self.assignment_at(device_id, time, assignment_filter=assignment_filter) for device_id in self._intervals.keys()]
+        return [assignment for assignment in assignments if assignment is not None]
+
+
+def get_assignment_index(honeycomb_client, environment_id):
+    cache = get_cache('assignment_index', persist=False)
+
+    index = cache.get(environment_id)
+    if index is None:
+        index = AssignmentIndex(fetch_assignments(honeycomb_client, environment_id))
+        cache.set(environment_id, index)
+    return index
+
+
+def is_cc_assignment(assignment):
+    return "name" in assignment["assigned"] and assignment["assigned"]["name"].startswith("cc")
+
+
 def get_assignments_at_time(honeycomb_client, environment_id, time):
-    assignments = fetch_assignments(honeycomb_client, environment_id)
-    filtered_assignments = filter_assignments_at_time(assignments, time)
-    return [(assignment["assignment_id"], assignment["assigned"]["name"]) for assignment in filtered_assignments if "name" in assignment["assigned"] and assignment["assigned"]["name"].startswith("cc")]
+    filtered_assignments = get_assignment_index(honeycomb_client, environment_id).assignments_at(time, assignment_filter=is_cc_assignment)
+    return [(assignment["assignment_id"], assignment["assigned"]["name"]) for assignment in filtered_assignments]
 
 
 def get_device_to_assignment_mapping_at_time(honeycomb_client, environment_id, time):
-    assignments = fetch_assignments(honeycomb_client, environment_id)
-    filtered_assignments = filter_assignments_at_time(assignments, time)
-    return {assignment["assigned"]["device_id"]: assignment["assignment_id"] for assignment in filtered_assignments if "name" in assignment["assigned"] and assignment["assigned"]["name"].startswith("cc")}
-
+    filtered_assignments = get_assignment_index(honeycomb_client, environment_id).assignments_at(time, assignment_filter=is_cc_assignment)
+    return {assignment["assigned"]["device_id"]: assignment["assignment_id"] for assignment in filtered_assignments}
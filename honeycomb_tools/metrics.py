@@ -0,0 +1,240 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psutil
+
+import honeycomb_tools.config as config
+
+
+#  Per sample load metrics, written as a JSON report per sample to METRICS_DIR and as a Prometheus textfile to
+#  METRICS_PROMETHEUS_FILE (for node_exporter's textfile collector). The textfile holds the last sample's series of each
+#  label set, so samples loaded at once by prepare-geoms-batch don't overwrite each other's series
+#
+#  Phases run once per sample are wall clock seconds: 'fetch', 'introspection', 'geom_insert', 'export', 'load' (waiting
+#  on every device's COPY), 'staging_move' and 'commit'. 'format' (worker time formatting windows) and 'copy' (each
+#  device's COPY) are summed over devices running concurrently, so they can exceed the sample's total_seconds
+#
+#  Peak RSS (this process plus its children, e.g. the 'process' format pool) and queue depths are sampled every
+#  METRICS_SAMPLE_SECONDS. RSS is per process, not per sample, samples loaded at once each report the shared peak
+
+
+PROMETHEUS_PREFIX = "geom_processor"
+
+# The last report written per textfile and label set, guarded by _prometheus_lock
+_prometheus_reports = dict()
+_prometheus_lock = threading.Lock()
+
+
+class LoadMetrics:
+    """
+    Thread safe collector of a sample load's metrics, see the module comment
+    """
+
+    def __init__(self, sample_interval=None, **labels):
+        self.labels = {name: value for name, value in labels.items() if value is not None}
+        self.sample_id = None
+        self.status = 'started'
+        self.phases = dict()
+        self.devices = dict()
+        self.queues = dict()
+        self.peak_rss = 0
+        self._gauges = dict()
+        self._lock = threading.Lock()
+        self._started_at = datetime.datetime.utcnow()
+        self._started = time.perf_counter()
+        self._finished = None
+        self._finished_timestamp = None
+        self._sample_interval = sample_interval or config.METRICS_SAMPLE_SECONDS
+        self._stopped = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        self.sample()
+        self._sampler = threading.Thread(target=self._sample_loop, name="metrics-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop(self, status=None):
+        if status is not None:
+            self.status = status
+        self._finished = time.perf_counter()
+        self._finished_timestamp = time.time()
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        self.sample()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def timed(self, iterable, name):
+        """
+        Iterate iterable, adding the time spent waiting on each item to phase name
+        """
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(name, time.perf_counter() - started)
+            yield item
+
+    def record_device(self, device_id, rows, num_bytes, seconds):
+        """
+        Add a device's COPY (a device is COPYed once per shard) to its totals and to the 'copy' phase
+        """
+        with self._lock:
+            device = self.devices.setdefault(str(device_id), {'rows': 0, 'bytes': 0, 'copy_seconds': 0.0})
+            device['rows'] += rows
+            device['bytes'] += num_bytes
+            device['copy_seconds'] += seconds
+            self.phases['copy'] = self.phases.get('copy', 0.0) + seconds
+
+    def record_queue_depth(self, name, depth):
+        with self._lock:
+            queue = self.queues.setdefault(name, {'max': 0, 'total': 0, 'samples': 0})
+            queue['max'] = max(queue['max'], depth)
+            queue['total'] += depth
+            queue['samples'] += 1
+
+    def gauge(self, name, read):
+        """
+        Sample read() as queue name's depth every sample interval
+        """
+        with self._lock:
+            self._gauges[name] = read
+
+    def sample(self):
+        try:
+            process = psutil.Process()
+            rss = process.memory_info().rss
+            for child in process.children(recursive=True):
+                try:
+                    rss += child.memory_info().rss
+                except psutil.NoSuchProcess:
+                    pass
+        except psutil.Error:
+            logging.exception("Failed to sample RSS")
+            return
+
+        with self._lock:
+            self.peak_rss = max(self.peak_rss, rss)
+            gauges = list(self._gauges.items())
+
+        for name, read in gauges:
+            self.record_queue_depth(name, read())
+
+    def _sample_loop(self):
+        while not self._stopped.wait(self._sample_interval):
+            self.sample()
+
+    def report(self):
+        """
+        :return dict, JSON serializable
+        """
+        with self._lock:
+            devices = {device_id: dict(device) for device_id, device in self.devices.items()}
+            return {
+                'sample_id': self.sample_id,
+                'status': self.status,
+                'labels': dict(self.labels),
+                'started_at': self._started_at.isoformat() + 'Z',
+                'total_seconds': (self._finished or time.perf_counter()) - self._started,
+                'finished_timestamp': self._finished_timestamp,
+                'phases': dict(self.phases),
+                'rows': sum(device['rows'] for device in devices.values()),
+                'bytes': sum(device['bytes'] for device in devices.values()),
+                'devices': devices,
+                'peak_rss_bytes': self.peak_rss,
+                'queues': {name: {
+                    'max': queue['max'],
+                    'mean': queue['total'] / max(queue['samples'], 1)
+                } for name, queue in self.queues.items()}
+            }
+
+    def write(self, report_dir=None, prometheus_file=None):
+        """
+        Write the JSON report to report_dir (defaults to METRICS_DIR) and the Prometheus textfile to prometheus_file
+        (defaults to METRICS_PROMETHEUS_FILE), either is skipped when empty
+
+        The textfile is rewritten with the last report of every label set written to it, replacing the previous report
+        with this one's labels
+
+        :return success: boolean
+        """
+        report_dir = config.METRICS_DIR if report_dir is None else report_dir
+        prometheus_file = config.METRICS_PROMETHEUS_FILE if prometheus_file is None else prometheus_file
+        report = self.report()
+        try:
+            if report_dir:
+                os.makedirs(report_dir, exist_ok=True)
+                path = os.path.join(report_dir, "sample_%s_%s.json" % (report['sample_id'], self._started_at.strftime('%Y%m%dT%H%M%S')))
+                write_atomic(path, json.dumps(report, indent=2))
+                logging.info("SampleId - %s: Metrics written to %s", report['sample_id'], path)
+            if prometheus_file:
+                with _prometheus_lock:
+                    reports = _prometheus_reports.setdefault(prometheus_file, dict())
+                    reports[tuple(sorted((name, str(value)) for name, value in report['labels'].items()))] = report
+                    write_atomic(prometheus_file, format_prometheus([reports[key] for key in sorted(reports)]))
+        except Exception:
+            logging.exception("SampleId - %s: Failed writing metrics", report['sample_id'])
+            return False
+
+        return True
+
+
+def format_prometheus(reports):
+    """
+    Format reports in the Prometheus text exposition format, each report's series labelled with its sample's labels
+
+    :param reports -- [dict], see LoadMetrics.report, one per label set
+    :return string
+    """
+    def labels(report, **extra):
+        items = dict(report['labels'], **extra)
+        if len(items) == 0:
+            return ""
+        return "{" + ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in sorted(items.items())) + "}"
+
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append("# HELP %s_%s %s" % (PROMETHEUS_PREFIX, name, help_text))
+        lines.append("# TYPE %s_%s gauge" % (PROMETHEUS_PREFIX, name))
+        for sample_labels, value in samples:
+            lines.append("%s_%s%s %s" % (PROMETHEUS_PREFIX, name, sample_labels, repr(float(value))))
+
+    metric("sample_success", "1 if the last sample loaded successfully", [(labels(r), int(r['status'] == 'success')) for r in reports])
+    metric("sample_seconds", "Total seconds of the last sample's load", [(labels(r), r['total_seconds']) for r in reports])
+    metric("phase_seconds", "Seconds per phase of the last sample's load, format and copy are summed over devices", [(labels(r, phase=phase), seconds) for r in reports for phase, seconds in sorted(r['phases'].items())])
+    metric("rows", "Rows COPYed by the last sample's load", [(labels(r), r['rows']) for r in reports])
+    metric("bytes", "Bytes COPYed by the last sample's load", [(labels(r), r['bytes']) for r in reports])
+    metric("devices", "Devices COPYed by the last sample's load", [(labels(r), len(r['devices'])) for r in reports])
+    metric("peak_rss_bytes", "Peak RSS of the loader process and its children during the last sample's load, shared by samples loaded at once", [(labels(r), r['peak_rss_bytes']) for r in reports])
+    metric("queue_depth_max", "Max sampled depth per queue during the last sample's load", [(labels(r, queue=queue), depths['max']) for r in reports for queue, depths in sorted(r['queues'].items())])
+    metric("last_run_timestamp_seconds", "Unix time the last sample's load finished", [(labels(r), r['finished_timestamp'] or time.time()) for r in reports])
+    return "\n".join(lines) + "\n"
+
+
+def write_atomic(path, content):
+    # Readers (e.g. node_exporter) never see a partially written file
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as fp:
+        fp.write(content)
+    os.replace(tmp_path, path)
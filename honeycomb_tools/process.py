@@ -1,32 +1,65 @@
-from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
-import copy
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_EXCEPTION
 import datetime
+from functools import lru_cache
+from itertools import chain
 import json
 import logging
+import multiprocessing
 from operator import itemgetter
 import os
 import pickle
 import psycopg2
+import psycopg2.pool
+import shutil
+import socket
+import tempfile
+import threading
 import time
+import uuid
 
+import numpy as np
 from process_cuwb_data import fetch_geoms_2d as fetch_cuwb_geoms_2d
 from process_pose_data import fetch_geoms_2d_by_inference_execution as fetch_pose_geoms_2d
 import geom_render
 from geom_render import GeomJSONEncoder
 
 import honeycomb_tools.config as config
-from honeycomb_tools.introspection import get_device_to_assignment_mapping_at_time, get_environment_id, get_environment_for_inference_id, fetch_inference_for_inference_id
-from honeycomb_tools.handle import put_sample, update_sample_status, delete_sample, put_geom, put_coordinates_list
-from honeycomb_tools.util import kill_child_processes, download_pickle
-
-
-#  Max number of threads = MAX_WORKERS
-#  Caution, each thread will attempt to throw a large # of coordinates at postgres using the PG copy_from functionality
+from honeycomb_tools.introspection import get_assignment_index, is_cc_assignment, get_environment_id, get_environment_for_inference_id, fetch_inference_for_inference_id
+from honeycomb_tools.handle import put_sample, claim_sample, touch_sample, release_sample, find_sample_for_day, update_sample_status, update_sample_range, delete_sample_coordinates_from_time, fetch_sample_device_statuses, put_sample_device_status, delete_sample_device_statuses, put_geoms_bulk, delete_geoms, copy_coordinates_chunks, format_coordinates, \
+    coordinates_staging_table, create_coordinates_staging, validate_coordinates_staging, move_coordinates_staging, drop_coordinates_staging, COORDINATE_BLOCKS_FORMAT_COLUMNS
+from honeycomb_tools.handle_utils import DEFAULT_BLOCK_SECONDS, drop_empty_frames
+from honeycomb_tools.collection_store import StoredGeom, StoredGeomCollection, fetch_collections_cached, is_collection_store, load_collections, save_collections
+from honeycomb_tools.util import download_to_cache
+from honeycomb_tools.async_load import load_device_coordinates_async
+from honeycomb_tools.connections import CopyThrottle, warm_up_connections
+from honeycomb_tools.export import delete_coordinate_windows_from_time, discard_coordinate_window_files, export_device_windows, fetch_straddling_coordinate_windows, \
+    promote_coordinate_window_files, restore_coordinate_windows
+from honeycomb_tools.metrics import LoadMetrics
+
+
+#  Max number of threads = MAX_WORKERS, for both formatting coordinates and loading devices
+#  Concurrent COPYs start at MAX_WORKERS and are throttled down (and back up) by observed throughput and server errors
+#  Caution, each loading thread holds an open COPY and will throw a large # of coordinates at postgres
+#  Each device's COPY is fed by at most PIPELINE_QUEUE_SIZE formatted windows of PIPELINE_WINDOW_FRAMES frames
+#  With EXECUTOR = 'process' formatting runs on a pool of MAX_WORKERS forkserver processes which read each device's coordinates from a memory-mapped file
+#  With LOADER_ENGINE = 'asyncio' the COPYs run as coroutines on asyncpg connections instead of threads, see async_load
+#  With LOAD_MODE = 'staging' devices COPY into an unlogged, unindexed per-sample table that's moved into coordinates in one INSERT at the end
+#  CUWB windows longer than CUWB_SHARD_MINUTES are fetched as shards on a pool of FETCH_CONCURRENCY processes, each shard is loaded as it arrives
 
 
 DEFAULT_FRAME_WIDTH = 1296
 DEFAULT_FRAME_HEIGHT = 972
 
+# Geom attributes that are stored elsewhere (or not at all) and are left out of geoms.attributes
+GEOM_ATTRIBUTES_EXCLUDED = frozenset(['coordinates', 'coordinate_indices', 'time_index', 'start_time', 'end_time', 'frames_per_second', 'num_frames', 'frame_width', 'frame_height'])
+# Geom attributes that are unique to each geom, everything else (color, alpha, line_width, ...) tends to repeat across geoms of a class
+GEOM_IDENTITY_ATTRIBUTES = ('id', 'source_id', 'source_type', 'source_name', 'object_id', 'object_type', 'object_name')
+
+# Namespace for deterministic geom uuids, see geom_uuid()
+GEOM_UUID_NAMESPACE = uuid.UUID('0b5c3a8e-5d0e-4f4e-9a57-3f1d1c6f2b8a')
+
 
 class ProcessingError(Exception):
     pass
@@ -40,34 +73,90 @@ def process_geoms_2d(
         start_time=None,
         end_time=None,
         inference_id=None,
-        pickle_url=None):
+        pickle_url=None,
+        append=False):
+    """
+    Fetch a sample's geoms and load the geoms and their coordinates into the database
+
+    With append, coordinates are added to the environment's existing 'success' sample for the day (if any) instead of
+    creating a new sample. Only frames at or after the sample's current end_time are loaded, and the sample's
+    end_time/num_frames are extended.
+
+    The load's metrics are written to METRICS_DIR and METRICS_PROMETHEUS_FILE, see metrics
+
+    :return sample id -- int, None if nothing was loaded
+    """
+    metrics = LoadMetrics(environment=environment_name, source_type=source_type, inference_id=inference_id)
+    metrics.start()
+    status = 'failed'
+    try:
+        sample_db_id = _process_geoms_2d(honeycomb_client, pg_client, source_type, environment_name, start_time, end_time, inference_id, pickle_url, append, metrics)
+        status = 'skipped' if sample_db_id is None else 'success'
+        return sample_db_id
+    finally:
+        metrics.stop(status)
+        metrics.write()
 
+
+def _process_geoms_2d(honeycomb_client, pg_client, source_type, environment_name, start_time, end_time, inference_id, pickle_url, append, metrics):
     time_start_processing = time.perf_counter()
 
     inference_name, inference_model, inference_version = None, None, None
 
     # Load geoms
+    # shards is a time ordered iterable of (shard key, shard end_time, sample collection), unsharded samples are a single '' shard
+    shards = None
+    shard_fetcher = None
     if pickle_url is not None:
-        environment_id = get_environment_id(honeycomb_client, environment_name)
-
-        sample_collection = pickle.load(download_pickle(pickle_url))
+        with metrics.phase('introspection'):
+            environment_id = get_environment_id(honeycomb_client, environment_name)
+
+        # Downloads are cached locally, a collection store is memory-mapped rather than unpickled
+        with metrics.phase('fetch'):
+            pickle_path = download_to_cache(pickle_url)
+            if is_collection_store(pickle_path):
+                sample_collection = load_collections(pickle_path)
+            else:
+                with open(pickle_path, 'rb') as fp:
+                    sample_collection = pickle.load(fp)
     elif source_type == 'cuwb':
-        environment_id = get_environment_id(honeycomb_client, environment_name)
-
-        sample_collection = fetch_cuwb_geoms_2d(environment_name, start_time, end_time)
+        with metrics.phase('introspection'):
+            environment_id = get_environment_id(honeycomb_client, environment_name)
+
+        shard_ranges = cuwb_shard_ranges(start_time, end_time)
+        if len(shard_ranges) > 1:
+            logging.info("Fetching (%s, %s, %s) as %s shards", environment_name, start_time, end_time, len(shard_ranges))
+            shard_fetcher = fetch_cuwb_shards(environment_name, shard_ranges)
+            sample_collection = dict()
+            # The first shard with data supplies the sample's meta information, waits on later shards are timed as they're loaded
+            for shard in metrics.timed(shard_fetcher, 'fetch'):
+                sample_collection = shard[2]
+                if len(sample_collection) > 0:
+                    shards = chain([shard], metrics.timed(shard_fetcher, 'fetch'))
+                    break
+        # A range that hasn't ended yet may still gain data, so it isn't cached
+        elif end_time is not None and end_time < datetime.datetime.now(end_time.tzinfo):
+            with metrics.phase('fetch'):
+                sample_collection = fetch_collections_cached(['cuwb', environment_name, start_time, end_time],
+                                                             lambda: fetch_cuwb_geoms_2d(environment_name, start_time, end_time))
+        else:
+            with metrics.phase('fetch'):
+                sample_collection = fetch_cuwb_geoms_2d(environment_name, start_time, end_time)
     elif source_type == 'pose':
         if inference_id is None:
             logging.warning("Source type 'pose' requires inference_id")
             return None
 
-        inference = fetch_inference_for_inference_id(honeycomb_client, inference_id)
+        with metrics.phase('introspection'):
+            inference = fetch_inference_for_inference_id(honeycomb_client, inference_id)
         if inference is None:
             logging.warning("Unable to find inference with inference id %s", inference_id)
             return None
 
         inference_name, inference_model, inference_version = itemgetter('inference_name', 'inference_model', 'inference_version')(inference)
 
-        meta = get_environment_for_inference_id(honeycomb_client, inference_id)
+        with metrics.phase('introspection'):
+            meta = get_environment_for_inference_id(honeycomb_client, inference_id)
         if meta is None:
             logging.warning("Unable to extract environment from inference id %s", inference_id)
             return None
@@ -77,7 +166,8 @@ def process_geoms_2d(
             logging.warning("Unable to extract environment from inference id: %s", meta)
             return None
 
-        sample_collection = fetch_pose_geoms_2d(inference_id)
+        with metrics.phase('fetch'):
+            sample_collection = fetch_collections_cached(['pose', inference_id], lambda: fetch_pose_geoms_2d(inference_id))
     else:
         logging.warning("Invalid source type: %s", source_type)
         return None
@@ -86,12 +176,14 @@ def process_geoms_2d(
 
     if len(sample_collection) == 0:
         logging.warning("No devices found for: Environment - %s, Start - %s, End - %s", environment_name, start_time, end_time)
+        if shard_fetcher is not None:
+            shard_fetcher.close()
         return None
 
     sample_collection = {k: (v['geom'] if isinstance(v, dict) else v) for k, v in sample_collection.items()}
 
     for _, device in sample_collection.items():
-        if not isinstance(device, geom_render.core.GeomCollection2D):
+        if not isinstance(device, (geom_render.core.GeomCollection2D, StoredGeomCollection)):
             raise ProcessingError("Unexpected device type returned by geom generator, expectected GeomCollection2D, received: %s", type(device))
 
     # Pick a geom at random to gather some general meta information that SHOULD be common across geoms
@@ -102,167 +194,782 @@ def process_geoms_2d(
     if end_time is None:
         end_time = geom_collection_meta.start_time + datetime.timedelta(seconds=(geom_collection_meta.num_frames / geom_collection_meta.frames_per_second))
 
-    device_to_assignment_map = get_device_to_assignment_mapping_at_time(honeycomb_client, environment_id, start_time)
+    if shards is None:
+        shards = [('', None, sample_collection)]
+        sample_num_frames = geom_collection_meta.num_frames
+    else:
+        sample_num_frames = int(round((end_time - start_time).total_seconds() * geom_collection_meta.frames_per_second))
+
+    with metrics.phase('introspection'):
+        assignment_index = get_assignment_index(honeycomb_client, environment_id)
 
     conn = pg_client.getconn()
     cursor = conn.cursor()
 
     sample_db_id = None
+    appended_sample = None
+    staging_table = None
     pool = ThreadPoolExecutor(max_workers=config.MAX_WORKERS)
+    futures_coord_insert = []
+    cancel_loading = threading.Event()
+    inserted_geom_ids = set()
+    pending_window_files = dict()
+    straddling_windows = None
+    loader_id = "%s-%d-%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    heartbeat = None
+    if config.EXECUTOR == 'process':
+        format_pool = process_pool(max_workers=config.MAX_WORKERS)
+        mapped_coordinates_dir = tempfile.mkdtemp(prefix='geom-processor-')
+    else:
+        format_pool = ThreadPoolExecutor(max_workers=config.MAX_WORKERS)
+        mapped_coordinates_dir = None
     try:
-        logging.info("Loading Sample (%s, %s, %s, inference_name=%s) into database...", environment_name, start_time, end_time, inference_name)
-        sample_db_id = put_sample(cursor,
-                                  status='started',
-                                  start_time=start_time,
-                                  end_time=end_time,
-                                  frames_per_second=geom_collection_meta.frames_per_second,
-                                  num_frames=geom_collection_meta.num_frames,
-                                  frame_width=geom_collection_meta.frame_width or DEFAULT_FRAME_WIDTH,
-                                  frame_height=geom_collection_meta.frame_height or DEFAULT_FRAME_HEIGHT,
-                                  environment_id=environment_id,
-                                  source_id=geom_collection_meta.source_id,
-                                  source_type=geom_collection_meta.source_type or source_type,
-                                  source_name=geom_collection_meta.source_name,
-                                  inference_id=inference_id,
-                                  inference_name=inference_name,
-                                  inference_model=inference_model,
-                                  inference_version=inference_version)
-
-        if sample_db_id is None:
-            raise ProcessingError("Failed creating sample record for %s, %s, %s, inference_name=%s" % (environment_name, start_time, end_time, inference_name))
-
-        logging.info("Sample record staged with id %s", sample_db_id)
-
-        # Geoms will use an autogenerated primary ID in Postgres, use this dict to build a geom uuid -> PG ID map
-        geom_id_to_geom_db_id_map = dict()
-
-        # Insert geom objects into DB
-        for device_id, device in sample_collection.items():
-            for geom in device.geom_list:
-                if geom.id in geom_id_to_geom_db_id_map:
+        sample_source_type = geom_collection_meta.source_type or source_type
+
+        if append:
+            appended_sample = find_sample_for_day(cursor,
+                                                  status='success',
+                                                  environment_id=environment_id,
+                                                  day=start_time.date(),
+                                                  source_type=sample_source_type)
+
+        # Appends keep the format (and sparseness) the sample was created with
+        coordinates_format = appended_sample['coordinates_format'] if appended_sample is not None else config.COORDINATES_FORMAT
+        sparse = appended_sample['sparse'] if appended_sample is not None else config.SPARSE_COORDINATES
+
+        resumed = False
+        if appended_sample is not None:
+            if appended_sample['frames_per_second'] != geom_collection_meta.frames_per_second:
+                raise ProcessingError("Unable to append to SampleId - %s, frames_per_second %s doesn't match %s" % (appended_sample['id'], appended_sample['frames_per_second'], geom_collection_meta.frames_per_second))
+
+            sample_db_id = appended_sample['id']
+            logging.info("Appending (%s, %s, %s) to SampleId - %s, loading frames from %s", environment_name, start_time, end_time, sample_db_id, appended_sample['end_time'])
+
+            # The windows straddling the sample's end are rebuilt with the appended frames, a failed append restores them
+            if config.EXPORT_TARGET:
+                straddling_windows = fetch_straddling_coordinate_windows(cursor, sample_db_id, appended_sample['end_time'])
+                if straddling_windows is None:
+                    raise ProcessingError("SampleId - %s: Failed fetching coordinate windows straddling %s" % (sample_db_id, appended_sample['end_time']))
+        else:
+            # A sample left 'started' by a failed run is resumed, only devices that haven't finished loading are loaded
+            # Samples another run is still loading aren't claimed
+            sample_db_id = claim_sample(cursor,
+                                        loader_id=loader_id,
+                                        status='started',
+                                        environment_id=environment_id,
+                                        start_time=start_time,
+                                        end_time=end_time,
+                                        source_type=sample_source_type,
+                                        inference_id=inference_id,
+                                        coordinates_format=coordinates_format,
+                                        sparse=sparse,
+                                        stale_seconds=config.SAMPLE_STALE_SECONDS)
+            if sample_db_id is not None:
+                resumed = True
+                logging.info("Resuming Sample (%s, %s, %s, inference_name=%s) with id %s", environment_name, start_time, end_time, inference_name, sample_db_id)
+            else:
+                logging.info("Loading Sample (%s, %s, %s, inference_name=%s) into database...", environment_name, start_time, end_time, inference_name)
+                sample_db_id = put_sample(cursor,
+                                          status='started',
+                                          start_time=start_time,
+                                          end_time=end_time,
+                                          frames_per_second=geom_collection_meta.frames_per_second,
+                                          num_frames=sample_num_frames,
+                                          frame_width=geom_collection_meta.frame_width or DEFAULT_FRAME_WIDTH,
+                                          frame_height=geom_collection_meta.frame_height or DEFAULT_FRAME_HEIGHT,
+                                          environment_id=environment_id,
+                                          source_id=geom_collection_meta.source_id,
+                                          source_type=sample_source_type,
+                                          source_name=geom_collection_meta.source_name,
+                                          inference_id=inference_id,
+                                          inference_name=inference_name,
+                                          inference_model=inference_model,
+                                          inference_version=inference_version,
+                                          coordinates_format=coordinates_format,
+                                          sparse=sparse,
+                                          loader_id=loader_id)
+
+                if sample_db_id is None:
+                    raise ProcessingError("Failed creating sample record for %s, %s, %s, inference_name=%s" % (environment_name, start_time, end_time, inference_name))
+
+                logging.info("Sample record staged with id %s", sample_db_id)
+
+            # Publish the claim, the heartbeat keeps it from going stale while the sample loads
+            conn.commit()
+            heartbeat = SampleHeartbeat(pg_client, sample_db_id, loader_id)
+            heartbeat.start()
+
+        metrics.sample_id = sample_db_id
+
+        coordinates_table = None
+        if config.LOAD_MODE == 'staging':
+            # An unlogged table is emptied by a server crash, so a retried sample always reloads into a fresh one
+            drop_coordinates_staging(cursor, coordinates_staging_table(sample_db_id))
+            # The device statuses of a sample being appended to record its earlier loads and are kept
+            if appended_sample is None:
+                delete_sample_device_statuses(cursor, sample_db_id)
+            resumed = False
+
+            staging_table = create_coordinates_staging(cursor, sample_db_id, coordinates_format=coordinates_format)
+            if staging_table is None:
+                raise ProcessingError("SampleId - %s: Failed creating coordinates staging table" % (sample_db_id))
+            conn.commit()
+
+            coordinates_table = staging_table
+            logging.info("SampleId - %s: Staging coordinates in %s", sample_db_id, staging_table)
+
+        # Open or replace the connections device COPYs will use before any COPY starts
+        copy_throttle = CopyThrottle(max_limit=config.MAX_WORKERS)
+        metrics.gauge('copy_waiting', lambda: copy_throttle.waiting)
+        if config.LOADER_ENGINE != 'asyncio':
+            warm_up_connections(pg_client, min(config.MAX_WORKERS, len(sample_collection)))
+
+        # Only frames at or after load_from_time are loaded, when appending that's the sample's current end_time
+        load_from_time = appended_sample['end_time'] if appended_sample is not None else None
+
+        for shard_idx, (shard_key, shard_end_time, sample_collection) in enumerate(shards):
+            if len(sample_collection) == 0:
+                logging.info("SampleId - %s, Shard - %s: No devices found, skipping", sample_db_id, shard_key)
+                continue
+
+            device_statuses = fetch_sample_device_statuses(cursor, sample_db_id, shard=shard_key) if resumed else dict()
+            if len(device_statuses) > 0:
+                logging.info("SampleId - %s, Shard - %s: %s devices already loaded", sample_db_id, shard_key, len([s for s in device_statuses.values() if s == 'success']))
+
+            # Geoms will use an autogenerated primary ID in Postgres, build a geom id -> PG ID map with a single bulk insert
+            # Geoms are stored under a deterministic uuid so a resumed or appended sample reuses the geoms of its earlier runs
+            geom_id_to_geom_uuid_map = dict()
+            geoms = dict()
+            empty_geom_ids = set()
+            for device_id, device in sample_collection.items():
+                # Sparse samples don't store geoms without a single valid frame
+                valid_points = valid_coordinate_indices(device.coordinates) if sparse else None
+                for geom, geom_attributes, geom_db_uuid in device_geom_uuids(device):
+                    if geom.id in geom_id_to_geom_uuid_map:
+                        continue
+                    if valid_points is not None and not valid_points[geom.coordinate_indices].any():
+                        empty_geom_ids.add(geom.id)
+                        continue
+
+                    geom_id_to_geom_uuid_map[geom.id] = geom_db_uuid
+
+                    logging.debug("SampleId - %s: Staging Geom (%s, %s, %s, %s)", sample_db_id, geom_type_name(geom), geom.object_id, geom.object_type, geom.object_name)
+                    geoms[geom_db_uuid] = {
+                        'uuid': geom_db_uuid,
+                        'attributes': geom_attributes,
+                        'type': geom_type_name(geom),
+                        'object_id': geom.object_id,
+                        'object_type': geom.object_type,
+                        'object_name': geom.object_name
+                    }
+
+            if len(empty_geom_ids) > 0:
+                logging.info("SampleId - %s: Skipping %s Geoms with no valid frames", sample_db_id, len(empty_geom_ids - set(geom_id_to_geom_uuid_map)))
+            logging.info("SampleId - %s: Loading %s Geoms into database...", sample_db_id, len(geoms))
+            geom_uuid_to_geom_db_id_map = put_geoms_bulk(cursor, sample_id=sample_db_id, geoms=list(geoms.values()), metrics=metrics, inserted=inserted_geom_ids)
+            if geom_uuid_to_geom_db_id_map is None or len(geom_uuid_to_geom_db_id_map) != len(geoms):
+                raise ProcessingError("SampleId - %s: Failed creating Geom records" % (sample_db_id))
+
+            geom_id_to_geom_db_id_map = {geom_id: geom_uuid_to_geom_db_id_map[geom_db_uuid] for geom_id, geom_db_uuid in geom_id_to_geom_uuid_map.items()}
+
+            logging.info("SampleId - %s: %s Geom records staged", sample_db_id, len(geom_uuid_to_geom_db_id_map))
+
+            with metrics.phase('commit'):
+                conn.commit()
+
+            # Create parallel jobs to stream each device's massive coordinate list into DB
+            # Coordinates are formatted on the format pool while the device's COPY is in progress
+            async_jobs = []
+            export_jobs = []
+            for idx, (device_id, device) in enumerate(sample_collection.items()):
+                # Devices can be reassigned mid sample, label each frame with the assignment active at the frame's time
+                device_frame_times = frame_times(device.start_time, device.frames_per_second, len(device.coordinates))
+                frame_assignment_ids = assignment_index.assignment_ids_at_times(device_id, device_frame_times, assignment_filter=is_cc_assignment)
+                assignment_id = frame_assignment_ids[0] if len(frame_assignment_ids) > 0 else None
+                if (frame_assignment_ids == assignment_id).all():
+                    frame_assignment_ids = assignment_id
+                else:
+                    logging.info("SampleId - %s, DeviceId - %s: Device reassigned during sample, assignments %s", sample_db_id, device_id, sorted(set(frame_assignment_ids) - {None}))
+
+                # Frames at or after the shard's end_time belong to the next shard
+                start_frame = 0
+                end_frame = len(device.coordinates)
+                if load_from_time is not None:
+                    start_frame = int(np.searchsorted(device_frame_times, np.datetime64(load_from_time.replace(tzinfo=None), 'us')))
+                if shard_end_time is not None:
+                    end_frame = int(np.searchsorted(device_frame_times, np.datetime64(shard_end_time.replace(tzinfo=None), 'us')))
+                if start_frame >= end_frame:
+                    logging.info("SampleId - %s, DeviceId - %s: No new frames to load, skipping", sample_db_id, device_id)
                     continue
 
-                logging.info("SampleId - %s: Loading Geom (%s, %s, %s, %s) into database...", sample_db_id, type(geom).__name__, geom.object_id, geom.object_type, geom.object_name)
-                geom_db_id = put_geom(cursor,
-                                      uuid=geom.id,
-                                      sample_id=sample_db_id,
-                                      attributes=json.dumps(scrub_geom_object(geom), cls=GeomJSONEncoder),
-                                      geom_type=type(geom).__name__,
-                                      object_id=geom.object_id,
-                                      object_type=geom.object_type,
-                                      object_name=geom.object_name)
-                if geom_db_id is None:
-                    raise ProcessingError("SampleId - %s: Failed creating Geom record" % (sample_db_id))
-
-                logging.info("SampleId - %s: Geom record staged with id %s", sample_db_id, geom_db_id)
-                geom_id_to_geom_db_id_map[geom.id] = geom_db_id
-
-        conn.commit()
-
-        # Create parallel jobs to load each device's massive coordinate list into DB
-        # pool_coord_insert = ThreadPoolExecutor(len(sample_collection.items()))
-        futures_coord_insert = []
-        for device_id, device in sample_collection.items():
-            assignment_id = device_to_assignment_map[device_id]
-
-            # Generate geoms object coordinates for each device over a separate thread
-            future_prepare_coords = []
-            all_coordinates = []
-            for geom in device.geom_list:
-                future_prepare_coords.append(pool.submit(prepare_geom_coordinates,
-                                             device_id=device_id,
-                                             device=device,
-                                             assignment_id=assignment_id,
-                                             geom=geom,
-                                             geom_db_id=geom_id_to_geom_db_id_map[geom.id]))
-
-            done, _ = wait(future_prepare_coords)
-            [all_coordinates.extend(f.result()) for f in done]
-
-            futures_coord_insert.append(pool.submit(
-                pooled_put_coordinates_list,
-                pg_client=pg_client,
-                sample_db_id=sample_db_id,
-                device_id=device_id,
-                assignment_id=assignment_id,
-                all_coordinates=all_coordinates))
+                device_status = device_statuses.get(device_id)
+                if device_status == 'success':
+                    logging.info("SampleId - %s, DeviceId - %s: Already loaded, skipping", sample_db_id, device_id)
+                    continue
 
-        done, _ = wait(futures_coord_insert, return_when=FIRST_EXCEPTION)
-        [f.result() for f in done]  # Raise exception if there is one
+                # Windows are written on this connection, a device is only 'success' once its windows are committed
+                if config.EXPORT_TARGET:
+                    export_jobs.append((assignment_id, dict(device_id=device_id,
+                                                            coordinates=device.coordinates,
+                                                            times=device_frame_times,
+                                                            frames_per_second=device.frames_per_second,
+                                                            geoms=list({geom_id_to_geom_db_id_map[geom.id]: geom.coordinate_indices for geom in device.geom_list if geom.id in geom_id_to_geom_db_id_map}.items()),
+                                                            start_frame=start_frame,
+                                                            end_frame=end_frame,
+                                                            pending=pending_window_files)))
+
+                if device_status == 'loaded':
+                    logging.info("SampleId - %s, DeviceId - %s: Coordinates already loaded, exporting windows only", sample_db_id, device_id)
+                    continue
+
+                # Process workers are handed a path to the device's coordinates rather than a pickled copy of the device
+                coordinates_path = None
+                if mapped_coordinates_dir is not None:
+                    coordinates_path = os.path.join(mapped_coordinates_dir, "shard_%d_device_%d.npy" % (shard_idx, idx))
+                    np.save(coordinates_path, device.coordinates)
+
+                coordinate_chunks = stream_device_coordinates(
+                    pool=format_pool,
+                    device_id=device_id,
+                    device=device,
+                    assignment_id=frame_assignment_ids,
+                    geom_id_to_geom_db_id_map=geom_id_to_geom_db_id_map,
+                    coordinates_path=coordinates_path,
+                    start_frame=start_frame,
+                    end_frame=end_frame,
+                    coordinates_format=coordinates_format,
+                    sparse=sparse,
+                    metrics=metrics,
+                    cancelled=cancel_loading)
+
+                # With exports the COPY leaves the device 'loaded', it's marked 'success' once its windows are committed
+                job = dict(device_id=device_id,
+                           assignment_id=assignment_id,
+                           coordinate_chunks=coordinate_chunks,
+                           shard=shard_key,
+                           coordinates_format=coordinates_format,
+                           status='loaded' if config.EXPORT_TARGET else 'success')
+                if config.LOADER_ENGINE == 'asyncio':
+                    async_jobs.append(job)
+                else:
+                    futures_coord_insert.append(pool.submit(pooled_put_coordinates_list, pg_client=pg_client, sample_db_id=sample_db_id, copy_throttle=copy_throttle, table=coordinates_table, metrics=metrics, **job))
+
+            # Exports run while the threaded COPYs are in progress
+            for _, export_job in export_jobs:
+                with metrics.phase('export'):
+                    num_windows = export_device_windows(cursor, sample_db_id, **export_job)
+                if num_windows is None:
+                    raise ProcessingError("SampleId - %s, DeviceId - %s: Failed exporting coordinate windows" % (sample_db_id, export_job['device_id']))
+                logging.info("SampleId - %s, DeviceId - %s: Exported %s coordinate windows", sample_db_id, export_job['device_id'], num_windows)
+
+            with metrics.phase('load'):
+                load_device_coordinates_async(sample_db_id, async_jobs, table=coordinates_table, metrics=metrics)
+
+                done, _ = wait(futures_coord_insert, return_when=FIRST_EXCEPTION)
+                [f.result() for f in done]  # Raise exception if there is one
+
+            # The shard's windows and the statuses of its exported devices are committed together, window files are
+            # only promoted once they are
+            if len(export_jobs) > 0:
+                for assignment_id, export_job in export_jobs:
+                    if not put_sample_device_status(cursor, sample_db_id, export_job['device_id'], assignment_id, 'success', shard=shard_key):
+                        raise ProcessingError("SampleId - %s, DeviceId - %s: Failed recording device status" % (sample_db_id, export_job['device_id']))
+                with metrics.phase('commit'):
+                    conn.commit()
+                promote_coordinate_window_files(pending_window_files)
+
+            if mapped_coordinates_dir is not None:
+                for name in os.listdir(mapped_coordinates_dir):
+                    os.remove(os.path.join(mapped_coordinates_dir, name))
+
+        # The staged rows, the sample's range and its status are committed together
+        if staging_table is not None:
+            with metrics.phase('staging_move'):
+                validation = validate_coordinates_staging(cursor, staging_table, sample_db_id, coordinates_format=coordinates_format)
+                if validation['duplicates'] > 0 or validation['incomplete'] > 0 or validation['foreign_geoms'] > 0:
+                    raise ProcessingError("SampleId - %s: Staged coordinates failed validation %s" % (sample_db_id, validation))
+
+                logging.info("SampleId - %s: Moving %s staged coordinates into coordinates...", sample_db_id, validation['rows'])
+                if move_coordinates_staging(cursor, staging_table, coordinates_format=coordinates_format) is None:
+                    raise ProcessingError("SampleId - %s: Failed moving staged coordinates" % (sample_db_id))
+                if not drop_coordinates_staging(cursor, staging_table):
+                    raise ProcessingError("SampleId - %s: Failed dropping coordinates staging table" % (sample_db_id))
+
+        if appended_sample is not None:
+            sample_end_time = max(end_time.replace(tzinfo=None), appended_sample['end_time'].replace(tzinfo=None))
+            update_sample_range(cursor,
+                                sample_db_id,
+                                end_time=sample_end_time,
+                                num_frames=int(round((sample_end_time - appended_sample['start_time'].replace(tzinfo=None)).total_seconds() * appended_sample['frames_per_second'])))
 
         update_sample_status(cursor, sample_db_id, 'success')
-        conn.commit()
+        with metrics.phase('commit'):
+            conn.commit()
 
         time_loaded_sample = time.perf_counter()
-        logging.info("SampleId - %s loaded! Fetch geoms time - %0.4f, Load db time %0.4f, Total time %0.4f", sample_db_id, time_fetched_sample - time_start_processing, time_loaded_sample - time_fetched_sample, time_loaded_sample - time_start_processing)
+        logging.info("SampleId - %s loaded! Fetch geoms time - %0.4f, Load db time %0.4f, Total time %0.4f, Peak RSS %0.1f MB", sample_db_id, time_fetched_sample - time_start_processing, time_loaded_sample - time_fetched_sample, time_loaded_sample - time_start_processing, metrics.peak_rss / (1024 * 1024))
 
-    except (Exception, psycopg2.DatabaseError, ProcessingError) as error:
-        if cursor and conn and sample_db_id:
-            conn.rollback()
+        return sample_db_id
 
-            delete_sample(cursor, sample_db_id)
-            conn.commit()
+    except (Exception, psycopg2.DatabaseError, ProcessingError) as error:
+        # Stop the device COPYs before cleaning up after them, queued devices are cancelled and running COPYs abort
+        # at their next window
+        cancel_loading.set()
+        for future in futures_coord_insert:
+            future.cancel()
+        wait(futures_coord_insert)
+        if heartbeat is not None:
+            heartbeat.stop()
+        # Windows of uncommitted devices never replace the stored window files
+        discard_coordinate_window_files(pending_window_files)
 
-            logging.info("Cleanup, SampleId - %s deleted!", sample_db_id)
+        if cursor and conn and sample_db_id:
+            undo_failed_load(conn,
+                             cursor,
+                             sample_db_id,
+                             loader_id,
+                             staging_table=staging_table,
+                             appended_sample=appended_sample,
+                             inserted_geom_ids=inserted_geom_ids,
+                             straddling_windows=straddling_windows,
+                             coordinates_format=coordinates_format)
             logging.exception(error)
 
-        if pool:
-            pool.shutdown(wait=False)
-            kill_child_processes(os.getpid())
-            exit(1)
-
         raise error
     finally:
+        if heartbeat is not None:
+            heartbeat.stop()
+        pool.shutdown(wait=True)
+        format_pool.shutdown(wait=True)
         if cursor:
             cursor.close()
         if conn:
             pg_client.putconn(conn)
+        if shard_fetcher is not None:
+            shard_fetcher.close()
+        if mapped_coordinates_dir is not None:
+            shutil.rmtree(mapped_coordinates_dir, ignore_errors=True)
 
 
-def pooled_put_coordinates_list(pg_client, sample_db_id, device_id, assignment_id, all_coordinates):
-    conn = pg_client.getconn()
-    cursor = conn.cursor()
-    try:
-        time_copy_from_started = time.perf_counter()
-        logging.info("SampleId - %s, DeviceId - %s, AssignmentId - %s: Loading %s coordinates into database...", sample_db_id, device_id, assignment_id, len(all_coordinates))
-        success = put_coordinates_list(cursor, all_coordinates)
-        if not success:
-            raise ProcessingError("SampleId - %s, DeviceId - %s, AssignmentId - %s: Failed loading coordinate records" % (sample_db_id, device_id, assignment_id))
+def undo_failed_load(conn, cursor, sample_db_id, loader_id, staging_table=None, appended_sample=None, inserted_geom_ids=None, straddling_windows=None, coordinates_format='numeric'):
+    """
+    Clean up after a sample's load failed, once its device COPYs have stopped
 
-        time_copy_from_finished = time.perf_counter()
-        logging.info("SampleId - %s, DeviceId - %s, AssignmentId - %s: Coordinates staged, Staging time - %0.4f", sample_db_id, device_id, assignment_id, time_copy_from_finished - time_copy_from_started)
+    A staged load's staging table is dropped. A failed append removes the coordinates, geoms and windows it added, the
+    sample stays as it was before the append. Otherwise the sample is released and left 'started' to be resumed, a
+    staged load restarting from scratch.
 
-        conn.commit()
-    except (Exception, ProcessingError) as error:
-        conn.rollback()
+    :param conn -- DB connection, rolled back before and committed after the cleanup
+    :param appended_sample -- dict, the sample being appended to, None unless appending
+    :param inserted_geom_ids -- set of geom ids this run inserted, see put_geoms_bulk
+    :param straddling_windows -- the appended sample's windows as they were before the append, see
+    fetch_straddling_coordinate_windows, None when they weren't exported
+    """
+    conn.rollback()
+
+    if staging_table is not None:
+        # Nothing reached coordinates, dropping the staging table undoes the load
+        drop_coordinates_staging(cursor, staging_table)
+        logging.info("Cleanup, SampleId - %s staging table %s dropped", sample_db_id, staging_table)
+
+    if appended_sample is not None:
+        # Remove whatever devices did append and the geoms this run added, the sample stays as it was before this run
+        if staging_table is None:
+            delete_sample_coordinates_from_time(cursor, sample_db_id, appended_sample['end_time'], coordinates_format=coordinates_format)
+        if inserted_geom_ids:
+            delete_geoms(cursor, inserted_geom_ids)
+        if config.EXPORT_TARGET and straddling_windows is not None:
+            delete_coordinate_windows_from_time(cursor, sample_db_id, appended_sample['end_time'])
+            restore_coordinate_windows(cursor, straddling_windows)
+        logging.info("Cleanup, SampleId - %s appended coordinates deleted!", sample_db_id)
+    else:
+        # Keep the sample and the devices that did load, a retry of the same sample resumes from here
+        if staging_table is not None:
+            delete_sample_device_statuses(cursor, sample_db_id)
+        release_sample(cursor, sample_db_id, loader_id)
+        logging.info("SampleId - %s failed, left in 'started' state to be resumed", sample_db_id)
 
-        logging.exception("SampleId - %s, DeviceId - %s, AssignmentId - %s: Failed loading coordinate records")
-        raise error
+    conn.commit()
+
+
+def process_pool(max_workers):
+    """
+    ProcessPoolExecutor whose workers are started by a forkserver rather than forked from this process, which by the
+    time a pool starts its workers has COPY, metrics and logging threads (and the locks they hold) running
+
+    Workers import modules afresh, so anything they need beyond the environment's config is passed to them explicitly
+
+    :param max_workers -- int
+    :return ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('forkserver'))
+
+
+class SampleHeartbeat:
+    """
+    Renews a claimed sample's heartbeat every interval seconds (defaults to SAMPLE_HEARTBEAT_SECONDS) until stopped, see
+    claim_sample
+
+    Each beat holds one of pg_client's connections for the update only
+    """
+
+    def __init__(self, pg_client, sample_id, loader_id, interval=None):
+        self.pg_client = pg_client
+        self.sample_id = sample_id
+        self.loader_id = loader_id
+        self._interval = interval or config.SAMPLE_HEARTBEAT_SECONDS
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._beat_loop, name="sample-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def beat(self):
+        try:
+            conn = self.pg_client.getconn()
+        except psycopg2.pool.PoolError:
+            logging.warning("SampleId - %s: No connection for the sample's heartbeat, skipping a beat", self.sample_id)
+            return
+
+        try:
+            cursor = conn.cursor()
+            claimed = touch_sample(cursor, self.sample_id, self.loader_id)
+            conn.commit()
+            cursor.close()
+            if not claimed:
+                logging.warning("SampleId - %s: Sample is no longer claimed by %s", self.sample_id, self.loader_id)
+        except psycopg2.Error:
+            logging.exception("SampleId - %s: Failed renewing the sample's heartbeat", self.sample_id)
+        finally:
+            self.pg_client.putconn(conn)
+
+    def _beat_loop(self):
+        while not self._stopped.wait(self._interval):
+            self.beat()
+
+
+def cuwb_shard_ranges(start_time, end_time, shard_minutes=None):
+    """
+    Split a time range into consecutive shards of shard_minutes, the last shard may be shorter
+
+    :param start_time -- datetime
+    :param end_time -- datetime
+    :param shard_minutes -- int, defaults to CUWB_SHARD_MINUTES, 0 disables sharding
+    :return [(shard start_time, shard end_time)]
+    """
+    shard_minutes = config.CUWB_SHARD_MINUTES if shard_minutes is None else shard_minutes
+    if start_time is None or end_time is None or shard_minutes <= 0:
+        return [(start_time, end_time)]
+
+    shard_length = datetime.timedelta(minutes=shard_minutes)
+    shard_ranges = []
+    shard_start = start_time
+    while shard_start < end_time:
+        shard_ranges.append((shard_start, min(shard_start + shard_length, end_time)))
+        shard_start += shard_length
+    return shard_ranges
+
+
+def fetch_cuwb_shards(environment_name, shard_ranges, max_workers=None):
+    """
+    Fetch CUWB geoms for each shard on a process pool, generating the shards in time order
+
+    Each worker writes its shard as a collection store, so shards are handed back memory-mapped rather than pickled.
+    At most max_workers shards are fetched ahead of the shard being consumed.
+
+    :return generator of (shard key, shard end_time, {device_id: StoredGeomCollection})
+    """
+    max_workers = max_workers or config.FETCH_CONCURRENCY
+
+    shard_dir = tempfile.mkdtemp(prefix='geom-processor-shards-')
+    fetch_pool = process_pool(max_workers=max_workers)
+    pending = deque()
+    try:
+        for idx, (shard_start, shard_end) in enumerate(shard_ranges):
+            if len(pending) > max_workers:
+                yield load_cuwb_shard(*pending.popleft())
+
+            shard_path = os.path.join(shard_dir, "shard_%d.npz" % idx)
+            pending.append((shard_start, shard_end, fetch_pool.submit(fetch_cuwb_shard, environment_name, shard_start, shard_end, shard_path)))
+
+        while len(pending) > 0:
+            yield load_cuwb_shard(*pending.popleft())
     finally:
-        cursor.close()
-        conn.close()
-        pg_client.putconn(conn)
-
-
-def prepare_geom_coordinates(device_id, device, assignment_id, geom, geom_db_id):
-    queued_coords = []
-    ms_per_frame = 1000 / device.frames_per_second
-    geom_coordinates = reshape_coordinates_using_indices(device.coordinates, geom.coordinate_indices)
-    for idx, coordinates in enumerate(geom_coordinates):
-        time_offset = datetime.timedelta(milliseconds=ms_per_frame * idx)
-        queued_coords.append({
-            'geom_id': geom_db_id,
-            'device_id': device_id,
-            'assignment_id': assignment_id,
-            'time': device.start_time + time_offset,
-            'coordinates': coordinates
-        })
-    return queued_coords
+        for _, _, future in pending:
+            future.cancel()
+        fetch_pool.shutdown(wait=False)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
+def load_cuwb_shard(shard_start, shard_end, future):
+    shard_path = future.result()
+    sample_collection = load_collections(shard_path) if shard_path is not None else dict()
+    logging.info("Fetched shard (%s, %s), %s devices", shard_start, shard_end, len(sample_collection))
+    return shard_start.isoformat(), shard_end, sample_collection
+
+
+def fetch_cuwb_shard(environment_name, start_time, end_time, shard_path):
+    """
+    Process pool entry point, fetches a shard of CUWB geoms and writes it to shard_path as a collection store
+
+    :return shard_path -- string, None if the shard has no devices
+    """
+    # A shard that hasn't ended yet may still gain data, so it isn't cached
+    if end_time < datetime.datetime.now(end_time.tzinfo):
+        sample_collection = fetch_collections_cached(['cuwb', environment_name, start_time, end_time],
+                                                     lambda: fetch_cuwb_geoms_2d(environment_name, start_time, end_time))
+    else:
+        sample_collection = fetch_cuwb_geoms_2d(environment_name, start_time, end_time)
+    if len(sample_collection) == 0:
+        return None
+
+    save_collections({k: (v['geom'] if isinstance(v, dict) else v) for k, v in sample_collection.items()}, shard_path)
+    return shard_path
+
+
+def pooled_put_coordinates_list(pg_client, sample_db_id, device_id, assignment_id, coordinate_chunks, shard='', copy_throttle=None, table=None, coordinates_format='numeric', metrics=None, status='success'):
+    # At most copy_throttle.limit devices hold a connection and COPY at once
+    with (copy_throttle.slot() if copy_throttle is not None else nullcontext()):
+        conn = pg_client.getconn()
+        cursor = conn.cursor()
+        try:
+            time_copy_from_started = time.perf_counter()
+            logging.info("SampleId - %s, DeviceId - %s, AssignmentId - %s: Loading coordinates into database...", sample_db_id, device_id, assignment_id)
+            copy_stats = dict()
+            success = copy_coordinates_chunks(cursor, coordinate_chunks, copy_format=config.COPY_FORMAT, chunk_size=config.COPY_CHUNK_SIZE, stats=copy_stats, table=table, coordinates_format=coordinates_format)
+            if not success:
+                if copy_throttle is not None:
+                    copy_throttle.record_error(copy_stats.get('error'))
+                raise ProcessingError("SampleId - %s, DeviceId - %s, AssignmentId - %s: Failed loading coordinate records" % (sample_db_id, device_id, assignment_id))
+
+            if not put_sample_device_status(cursor, sample_db_id, device_id, assignment_id, status, shard=shard):
+                raise ProcessingError("SampleId - %s, DeviceId - %s, AssignmentId - %s: Failed recording device status" % (sample_db_id, device_id, assignment_id))
+
+            time_copy_from_finished = time.perf_counter()
+            staging_time = time_copy_from_finished - time_copy_from_started
+            logging.info("SampleId - %s, DeviceId - %s, AssignmentId - %s: Coordinates staged, Staging time - %0.4f, Rows - %s (%0.1f rows/s), Bytes - %s (%0.2f MB/s)",
+                         sample_db_id, device_id, assignment_id, staging_time,
+                         copy_stats['rows'], copy_stats['rows'] / max(staging_time, 1e-9),
+                         copy_stats['bytes'], copy_stats['bytes'] / max(staging_time, 1e-9) / (1024 * 1024))
+
+            conn.commit()
+
+            if metrics is not None:
+                metrics.record_device(device_id, copy_stats['rows'], copy_stats['bytes'], staging_time)
+            if copy_throttle is not None:
+                copy_throttle.record(copy_stats['rows'])
+        except (Exception, ProcessingError) as error:
+            conn.rollback()
+
+            if put_sample_device_status(cursor, sample_db_id, device_id, assignment_id, 'failed', shard=shard):
+                conn.commit()
+
+            logging.exception("SampleId - %s, DeviceId - %s, AssignmentId - %s: Failed loading coordinate records", sample_db_id, device_id, assignment_id)
+            raise error
+        finally:
+            cursor.close()
+            # The pool closes connections that were lost, healthy ones stay open for the next device
+            pg_client.putconn(conn)
+
+
+def stream_device_coordinates(pool, device_id, device, assignment_id, geom_id_to_geom_db_id_map, coordinates_path=None, start_frame=0, end_frame=None, window_frames=None, max_pending=None, coordinates_format='numeric', sparse=False, metrics=None, cancelled=None):
+    """
+    Generate a device's COPY chunks, formatting fixed frame windows of each geom on the given pool
+
+    At most max_pending formatted windows are held at once, so memory stays constant per device regardless of sample length
+
+    Frames before start_frame and from end_frame on are skipped. assignment_id is either a single id or an array with an id per frame
+
+    When coordinates_path is given (a .npy copy of device.coordinates), workers memory-map it instead of receiving the
+    device, which is required when the pool is a ProcessPoolExecutor
+
+    For 'blocks' and 'delta' windows end on time block boundaries, so no block is split across two windows
+
+    Geoms missing from geom_id_to_geom_db_id_map (a sparse sample's empty geoms) are skipped. With sparse, frames with
+    no valid coordinates are skipped too
+
+    With metrics, the workers' formatting time is added to its 'format' phase and the number of pending windows is
+    recorded as the 'format_pending' queue depth
+
+    Once cancelled (a threading.Event) is set the generator raises ProcessingError, which aborts the device's COPY
+
+    :return generator of (data, num_rows)
+    """
+    window_frames = window_frames or config.PIPELINE_WINDOW_FRAMES
+    max_pending = max_pending or config.PIPELINE_QUEUE_SIZE
+    end_frame = len(device.coordinates) if end_frame is None else end_frame
+
+    if coordinates_format in COORDINATE_BLOCKS_FORMAT_COLUMNS:
+        window_starts = block_window_starts(device.start_time, device.frames_per_second, start_frame, end_frame, window_frames)
+    else:
+        window_starts = list(range(start_frame, end_frame, window_frames))
+    windows = list(zip(window_starts, window_starts[1:] + [end_frame]))
+
+    pending = deque()
+    streamed_geom_db_ids = set()
+    for geom in device.geom_list:
+        if geom.id not in geom_id_to_geom_db_id_map:
+            continue
+
+        # A geom listed more than once shares its DB record, only load its coordinates once
+        if geom_id_to_geom_db_id_map[geom.id] in streamed_geom_db_ids:
+            continue
+        streamed_geom_db_ids.add(geom_id_to_geom_db_id_map[geom.id])
+
+        for first_frame, last_frame in windows:
+            if cancelled is not None and cancelled.is_set():
+                raise ProcessingError("DeviceId - %s: Loading cancelled" % (device_id))
+            if len(pending) >= max_pending:
+                yield pending_result(pending.popleft(), metrics)
+            if metrics is not None:
+                metrics.record_queue_depth('format_pending', len(pending))
+
+            window = dict(
+                copy_format=config.COPY_FORMAT,
+                coordinates_format=coordinates_format,
+                sparse=sparse,
+                block_seconds=config.COORDINATE_BLOCK_SECONDS,
+                quantum=config.COORDINATES_QUANTUM,
+                device_id=device_id,
+                assignment_id=assignment_id[first_frame:last_frame] if isinstance(assignment_id, np.ndarray) else assignment_id,
+                geom_db_id=geom_id_to_geom_db_id_map[geom.id],
+                start_time=device.start_time,
+                frames_per_second=device.frames_per_second,
+                coordinate_indices=geom.coordinate_indices,
+                first_frame=first_frame,
+                num_frames=last_frame - first_frame)
+
+            if coordinates_path is None:
+                pending.append(pool.submit(timed_call, format_geom_coordinates, coordinates=device.coordinates, **window))
+            else:
+                pending.append(pool.submit(timed_call, format_mapped_geom_coordinates, coordinates_path=coordinates_path, **window))
+
+    while len(pending) > 0:
+        if cancelled is not None and cancelled.is_set():
+            raise ProcessingError("DeviceId - %s: Loading cancelled" % (device_id))
+        yield pending_result(pending.popleft(), metrics)
+
+
+def timed_call(fn, **kwargs):
+    """
+    Format pool entry point, call fn and return its result with the seconds it took
+
+    :return (result, seconds)
+    """
+    started = time.perf_counter()
+    result = fn(**kwargs)
+    return result, time.perf_counter() - started
+
+
+def pending_result(future, metrics=None):
+    result, seconds = future.result()
+    if metrics is not None:
+        metrics.add('format', seconds)
+    return result
+
+
+def block_window_starts(start_time, frames_per_second, start_frame, end_frame, window_frames, block_seconds=None):
+    """
+    First frames of windows of whole time blocks, about window_frames frames each, see split_coordinate_blocks
+
+    :return [int]
+    """
+    block_seconds = block_seconds or config.COORDINATE_BLOCK_SECONDS
+    times = frame_times(start_time, frames_per_second, end_frame - start_frame, first_frame=start_frame)
+    block_ids = times.astype(np.int64) // int(block_seconds * 1000000)
+    block_starts = start_frame + np.concatenate([[0], np.flatnonzero(block_ids[1:] != block_ids[:-1]) + 1])
+    blocks_per_window = max(1, window_frames // max(1, int(block_seconds * frames_per_second)))
+    return block_starts[::blocks_per_window].tolist()
+
+
+def format_geom_coordinates(copy_format, coordinates_format='numeric', sparse=False, block_seconds=DEFAULT_BLOCK_SECONDS, quantum=0, **kwargs):
+    coordinates = build_coordinates_block(**kwargs)
+    # Dropped before formatting so the row count is of the rows written
+    if sparse and coordinates_format not in COORDINATE_BLOCKS_FORMAT_COLUMNS:
+        coordinates = drop_empty_frames(coordinates)
+    return format_coordinates(coordinates, copy_format, coordinates_format, block_seconds, quantum, sparse), len(coordinates['coordinates'])
+
+
+def format_mapped_geom_coordinates(coordinates_path, **kwargs):
+    """
+    Process pool entry point, formats a window of a geom's coordinates read from a memory-mapped .npy file
+
+    :return (data, num_rows) with data encoded as bytes, ready to COPY
+    """
+    data, num_rows = format_geom_coordinates(coordinates=np.load(coordinates_path, mmap_mode='r'), **kwargs)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data, num_rows
+
+
+def prepare_geom_coordinates(device_id, device, assignment_id, geom, geom_db_id, first_frame=0, num_frames=None):
+    """
+    Build a columnar block of a geom's coordinates. Frame times are kept as a single datetime64 array and
+    coordinates as the reshaped 2D ndarray, rather than one dict per frame.
+
+    Optionally limited to a window of num_frames frames starting at first_frame
+
+    :return {'geom_id': int, 'device_id': string, 'assignment_id': string, 'frames_per_second': int, 'time': np.datetime64[us], 'coordinates': np.ndarray}
+    """
+    return build_coordinates_block(
+        device_id=device_id,
+        assignment_id=assignment_id,
+        geom_db_id=geom_db_id,
+        coordinates=device.coordinates,
+        coordinate_indices=geom.coordinate_indices,
+        start_time=device.start_time,
+        frames_per_second=device.frames_per_second,
+        first_frame=first_frame,
+        num_frames=num_frames)
+
+
+def build_coordinates_block(device_id, assignment_id, geom_db_id, coordinates, coordinate_indices, start_time, frames_per_second, first_frame=0, num_frames=None):
+    last_frame = None if num_frames is None else first_frame + num_frames
+    geom_coordinates = reshape_coordinates_using_indices(coordinates[first_frame:last_frame], coordinate_indices)
+    return {
+        'geom_id': geom_db_id,
+        'device_id': device_id,
+        'assignment_id': assignment_id,
+        'frames_per_second': frames_per_second,
+        'time': frame_times(start_time, frames_per_second, len(geom_coordinates), first_frame=first_frame),
+        'coordinates': geom_coordinates
+    }
+
+
+def frame_times(start_time, frames_per_second, num_frames, first_frame=0):
+    """
+    Vectorized equivalent of start_time + timedelta(milliseconds=(1000 / frames_per_second) * idx) for each frame
+
+    Timezone info is dropped (not converted) to match how the coordinates.time column stores timestamps
+
+    :param start_time -- datetime
+    :param frames_per_second -- int
+    :param num_frames -- int
+    :param first_frame -- int
+    :return np.ndarray of datetime64[us]
+    """
+    start = np.datetime64(start_time.replace(tzinfo=None), 'us')
+    offsets = np.round(np.arange(first_frame, first_frame + num_frames) * (1000000 / frames_per_second))
+    return start + offsets.astype('int64').astype('timedelta64[us]')
+
+
+def geom_type_name(geom):
+    if isinstance(geom, StoredGeom):
+        return geom.geom_type
+    return type(geom).__name__
 
 
 def scrub_geom_object(geom):
-    j = copy.deepcopy(geom.__dict__)
-    [j.pop(key, None) for key in ['coordinates', 'coordinate_indices', 'time_index', 'start_time', 'end_time', 'frames_per_second', 'num_frames', 'frame_width', 'frame_height']]
+    if isinstance(geom, StoredGeom):
+        return dict(geom.attributes)
+
+    j = {key: value for key, value in geom.__dict__.items() if key not in GEOM_ATTRIBUTES_EXCLUDED}
 
     if 'color' in j and j['color'] is not None and not j['color'].startswith("#"):
         j['color'] = "#{color}".format(color=j['color'])
@@ -270,6 +977,99 @@ def scrub_geom_object(geom):
     return j
 
 
+def geom_uuid(geom, attributes, position=0):
+    """
+    Deterministic uuid for a geom, derived from its type, identifying fields and serialized attributes
+
+    Geom ids are random per fetch and coordinate indices differ between fetches of a device (shards, appends), this
+    stays the same whenever the same geom is fetched again
+
+    :param geom -- Geom
+    :param attributes -- JSON string, from serialize_geom_attributes
+    :param position -- int, tells apart geoms that are otherwise identical, see device_geom_uuids
+    :return uuid -- string
+    """
+    identity = json.loads(attributes)
+    identity.pop('id', None)
+    # None where coordinate indices used to be, the first of otherwise identical geoms keeps the uuid it had as a sharded geom
+    key = [geom_type_name(geom), None, identity]
+    if position > 0:
+        key.append(position)
+    return str(uuid.uuid5(GEOM_UUID_NAMESPACE, json.dumps(key, sort_keys=True)))
+
+
+def device_geom_uuids(device):
+    """
+    Deterministic uuids of a device's geoms, see geom_uuid
+
+    Geoms that only differ by their coordinate indices (e.g. a pose's limbs) are told apart by their position among each
+    other in device.geom_list, which unlike their indices stays the same across fetches
+
+    :param device -- GeomCollection2D
+    :return [(geom, attributes JSON string, uuid string)] in device.geom_list order
+    """
+    geom_uuids = []
+    positions = dict()
+    coordinate_indices_by_uuid = dict()
+    for geom in device.geom_list:
+        attributes = serialize_geom_attributes(geom)
+        identity_uuid = geom_uuid(geom, attributes)
+        position = positions.get(identity_uuid, 0)
+        positions[identity_uuid] = position + 1
+        geom_db_uuid = geom_uuid(geom, attributes, position=position)
+
+        # Geoms sharing a uuid share a record and only one of them is loaded, which is only right for identical geoms
+        coordinate_indices = np.asarray(geom.coordinate_indices).tolist()
+        if coordinate_indices_by_uuid.setdefault(geom_db_uuid, coordinate_indices) != coordinate_indices:
+            raise ProcessingError("Geoms with coordinate indices %s and %s share uuid %s" % (coordinate_indices_by_uuid[geom_db_uuid], coordinate_indices, geom_db_uuid))
+
+        geom_uuids.append((geom, attributes, geom_db_uuid))
+    return geom_uuids
+
+
+def serialize_geom_attributes(geom):
+    """
+    JSON encode a geom's attributes for the geoms.attributes column
+
+    Attributes shared across geoms of a class are encoded once and cached, only the identifying attributes are encoded per geom
+
+    :param geom -- Geom
+    :return attributes -- JSON string
+    """
+    attributes = scrub_geom_object(geom)
+    identity = {key: attributes.pop(key) for key in GEOM_IDENTITY_ATTRIBUTES if key in attributes}
+
+    try:
+        # 1, 1.0 and True are equal keys, each value's type keeps them from sharing a cached encoding
+        shared_json = encode_shared_geom_attributes(geom_type_name(geom), tuple((key, type(value), value) for key, value in sorted(attributes.items())))
+    except TypeError:
+        # Unhashable attribute values can't be cached
+        shared_json = json.dumps(attributes, cls=GeomJSONEncoder)
+
+    identity_json = json.dumps(identity, cls=GeomJSONEncoder)
+    if len(attributes) == 0:
+        return identity_json
+    if len(identity) == 0:
+        return shared_json
+    return shared_json[:-1] + ", " + identity_json[1:]
+
+
+@lru_cache(maxsize=1024, typed=True)
+def encode_shared_geom_attributes(geom_type, attribute_items):
+    return json.dumps({key: value for key, _, value in attribute_items}, cls=GeomJSONEncoder)
+
+
+def valid_coordinate_indices(coordinates):
+    """
+    Which of a device's coordinate indices have a valid value in at least one frame, a geom has no valid frames when
+    none of its coordinate_indices do
+
+    :param coordinates -- np.ndarray of frames x coordinate indices x 2
+    :return boolean np.ndarray, one per coordinate index
+    """
+    return ~np.isnan(coordinates).all(axis=(0, 2))
+
+
 def reshape_coordinates_using_indices(coordinates, coordinate_indices):
     """
     Reshape coordinates array into a 2D time series using coordinate_indices to extract geom's relevant points-of-interest
@@ -1,10 +1,161 @@
+import hashlib
+import json
+import logging
+import os
 import psutil
 import signal
+import tempfile
+import threading
+import time
 import requests
 
+import honeycomb_tools.config as config
 
-def download_pickle(url):
-    return requests.get(url, stream=True).raw
+
+def download_to_cache(url, cache_dir=None, retries=None, chunk_size=1024 * 1024):
+    """
+    Download a URL into the local download cache and return the cached file's path
+
+    Files are keyed by URL and the response's ETag (or Last-Modified/Content-Length when there is no ETag). A re-run
+    sends the cached validator with If-None-Match (or If-Modified-Since) and a 304 skips the download. A retry resumes
+    the interrupted download with a range request. A response with neither ETag nor Last-Modified can't be told from a
+    changed file, so it's downloaded every time.
+
+    Each download writes to its own part file, so concurrent downloads of the same URL don't write over each other
+
+    :param url -- string
+    :param cache_dir -- string, defaults to DOWNLOAD_CACHE_DIR
+    :param retries -- int, defaults to DOWNLOAD_RETRIES
+    :param chunk_size -- int
+    :return path -- string
+    """
+    cache_dir = cache_dir or config.DOWNLOAD_CACHE_DIR
+    retries = retries if retries is not None else config.DOWNLOAD_RETRIES
+    os.makedirs(cache_dir, exist_ok=True)
+
+    url_key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+    partial_path = os.path.join(cache_dir, "%s.%d.%d.part" % (url_key, os.getpid(), threading.get_ident()))
+    try:
+        for attempt in range(retries + 1):
+            try:
+                return _download_to_cache(url, cache_dir, url_key, partial_path, chunk_size)
+            except (requests.RequestException, IOError):
+                if attempt >= retries:
+                    raise
+                logging.exception("Download of %s failed (attempt %s of %s), retrying...", url, attempt + 1, retries + 1)
+                time.sleep(min(2 ** attempt, 60))
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+def _download_to_cache(url, cache_dir, url_key, partial_path, chunk_size):
+    # The validators of the URL's last download, sent so an unchanged file isn't sent again
+    index_path = os.path.join(cache_dir, url_key + '.json')
+    cached = _read_download_index(index_path)
+    headers = dict()
+    if cached is not None and os.path.exists(os.path.join(cache_dir, cached['key'])):
+        if cached.get('etag') is not None:
+            headers['If-None-Match'] = cached['etag']
+        elif cached.get('last_modified') is not None:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    with requests.get(url, stream=True, timeout=60, headers=headers) as response:
+        if response.status_code == 304 and len(headers) > 0:
+            logging.info("Using cached download of %s", url)
+            return os.path.join(cache_dir, cached['key'])
+        response.raise_for_status()
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        validator = etag
+        if validator is None and last_modified is not None:
+            validator = "%s-%s" % (last_modified, response.headers.get('Content-Length'))
+        key = hashlib.sha256(("%s\n%s" % (url, validator)).encode('utf-8')).hexdigest()
+        path = os.path.join(cache_dir, key)
+
+        if validator is None:
+            logging.info("No ETag or Last-Modified for %s, downloading without the cache", url)
+            fd, uncached_path = tempfile.mkstemp(dir=cache_dir, suffix='.part')
+            os.close(fd)
+            try:
+                _write_response(response, uncached_path, 0, chunk_size)
+                os.replace(uncached_path, path)
+            finally:
+                if os.path.exists(uncached_path):
+                    os.remove(uncached_path)
+            return path
+
+        index = {'key': key, 'etag': etag, 'last_modified': last_modified}
+        if os.path.exists(path):
+            logging.info("Using cached download of %s", url)
+            _write_download_index(index_path, index)
+            return path
+
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        if offset == 0:
+            _write_response(response, partial_path, 0, chunk_size)
+            os.replace(partial_path, path)
+            _write_download_index(index_path, index)
+            return path
+
+    # Resume the partial download, If-Range makes the server send the whole file instead if it changed
+    headers = {'Range': 'bytes=%d-' % offset, 'If-Range': etag or last_modified}
+
+    with requests.get(url, stream=True, timeout=60, headers=headers) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            offset = 0
+        logging.info("Resuming download of %s from byte %s", url, offset)
+        _write_response(response, partial_path, offset, chunk_size)
+
+    os.replace(partial_path, path)
+    _write_download_index(index_path, index)
+    return path
+
+
+def _read_download_index(index_path):
+    try:
+        with open(index_path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logging.warning("Discarding unreadable download index %s", index_path)
+        return None
+
+
+def _write_download_index(index_path, index):
+    # Readers never see a partially written index
+    tmp_path = "%s.%d.%d.tmp" % (index_path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'w') as fp:
+        json.dump(index, fp)
+    os.replace(tmp_path, index_path)
+
+
+def _write_response(response, path, offset, chunk_size):
+    # Content-Length counts the encoded bytes, iter_content hands out decoded (e.g. gunzipped) ones
+    total = response.headers.get('Content-Length')
+    if response.headers.get('Content-Encoding', 'identity') != 'identity':
+        total = None
+    total = int(total) + offset if total is not None else None
+
+    downloaded = offset
+    last_logged = time.perf_counter()
+    with open(path, 'ab' if offset > 0 else 'wb') as fp:
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            fp.write(chunk)
+            downloaded += len(chunk)
+
+            if time.perf_counter() - last_logged > 10:
+                last_logged = time.perf_counter()
+                if total:
+                    logging.info("Downloaded %0.1f of %0.1f MB (%0.1f%%)", downloaded / 1048576, total / 1048576, 100 * downloaded / total)
+                else:
+                    logging.info("Downloaded %0.1f MB", downloaded / 1048576)
+
+    if total is not None and downloaded != total:
+        raise IOError("Download incomplete, received %s of %s bytes" % (downloaded, total))
 
 
 def kill_child_processes(parent_pid, sig=signal.SIGTERM):
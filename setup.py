@@ -22,9 +22,14 @@ BASE_DEPENDENCY_LINKS = []
 #     'git+https://github.com/WildflowerSchools/wf-geom-render.git@master#egg=geom-render'
 # ]
 
-# TEST_DEPENDENCIES = [
-# ]
-#
+ASYNC_DEPENDENCIES = [
+    'asyncpg>=0.21.0'
+]
+
+TEST_DEPENDENCIES = [
+    'pytest>=6.0.0'
+]
+
 # LOCAL_DEPENDENCIES = [
 # ]
 
@@ -43,11 +48,12 @@ setup(
     author_email='ben.talberg@wildflowerschools.org',
     install_requires=BASE_DEPENDENCIES,
     dependency_links=BASE_DEPENDENCY_LINKS,
-    # tests_require=TEST_DEPENDENCIES,
-    # extras_require = {
-    #     'test': TEST_DEPENDENCIES,
-    #     'local': LOCAL_DEPENDENCIES
-    # },
+    tests_require=TEST_DEPENDENCIES,
+    extras_require={
+        'async': ASYNC_DEPENDENCIES,
+        'test': TEST_DEPENDENCIES,
+        # 'local': LOCAL_DEPENDENCIES
+    },
     keywords=['honeycomb, wildflower, websocket, timescaledb'],
     classifiers=[
         'Intended Audience :: Developers',
@@ -0,0 +1,85 @@
+// Decoders for the binary coordinate formats written by the loader (honeycomb_tools/handle_utils.py, codec.py)
+
+// Decode a coordinates_packed value: uint16 LE value count, NaN bitmap (LSB first), float32 LE of the non-NaN values
+exports.unpackCoordinates = function(buffer) {
+  const count = buffer.readUInt16LE(0)
+  const bitmapBytes = Math.ceil(count / 8)
+  const values = new Array(count)
+  let offset = 2 + bitmapBytes
+  for (let i = 0; i < count; i++) {
+    if (buffer[2 + (i >> 3)] & (1 << (i & 7))) {
+      values[i] = null
+    } else {
+      values[i] = buffer.readFloatLE(offset)
+      offset += 4
+    }
+  }
+  return values
+}
+
+// Decode a 'delta' sample's coordinates_encoded block into one array of values per frame (null for NaN), the 'HCD1'
+// layout is documented in honeycomb_tools/codec.py
+exports.decodeBlock = function(buffer) {
+  if (buffer.toString("latin1", 0, 4) !== "HCD1") {
+    throw new Error("Not a delta encoded block")
+  }
+  const numFrames = buffer.readUInt32LE(4)
+  const numValues = buffer.readUInt16LE(8)
+  const flags = buffer.readUInt8(10)
+  const width = buffer.readUInt8(11)
+  const quantum = buffer.readFloatLE(12)
+  const numRuns = buffer.readUInt32LE(16)
+  let offset = 20
+
+  const keptFrames = []
+  for (let run = 0; run < numRuns; run++) {
+    const first = buffer.readUInt32LE(offset)
+    const length = buffer.readUInt32LE(offset + 4)
+    for (let frame = first; frame < first + length; frame++) {
+      keptFrames.push(frame)
+    }
+    offset += 8
+  }
+
+  const bitmap = offset
+  if (flags & 0x02) {
+    offset += Math.ceil((keptFrames.length * numValues) / 8)
+  }
+  const isNaN = index => (flags & 0x02) !== 0 && (buffer[bitmap + (index >> 3)] & (1 << (index & 7))) !== 0
+
+  const frames = new Array(numFrames).fill(null).map(() => new Array(numValues).fill(null))
+  const quantized = (flags & 0x01) !== 0
+  // Buffer.readBigInt64LE isn't available on Node 10, steps are exact while below 2^53
+  const readInt64LE = o => buffer.readInt32LE(o + 4) * 0x100000000 + buffer.readUInt32LE(o)
+  const readDelta = quantized
+    ? { 1: o => buffer.readInt8(o), 2: o => buffer.readInt16LE(o), 4: o => buffer.readInt32LE(o), 8: readInt64LE }[width]
+    : { 1: o => buffer.readUInt8(o), 2: o => buffer.readUInt16LE(o), 4: o => buffer.readUInt32LE(o) }[width]
+
+  // Running quantum steps, or running float32 bit patterns XORed with each delta
+  const current = new Array(numValues)
+  const bits = Buffer.alloc(4)
+  keptFrames.forEach((frame, kept) => {
+    for (let v = 0; v < numValues; v++) {
+      if (kept === 0) {
+        current[v] = quantized ? readInt64LE(offset) : buffer.readUInt32LE(offset)
+        offset += quantized ? 8 : 4
+      } else if (quantized) {
+        current[v] += readDelta(offset)
+        offset += width
+      } else {
+        current[v] = (current[v] ^ readDelta(offset)) >>> 0
+        offset += width
+      }
+
+      if (!isNaN(kept * numValues + v)) {
+        if (quantized) {
+          frames[frame][v] = current[v] * quantum
+        } else {
+          bits.writeUInt32LE(current[v], 0)
+          frames[frame][v] = bits.readFloatLE(0)
+        }
+      }
+    }
+  })
+  return frames
+}
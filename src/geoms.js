@@ -54,6 +54,24 @@ const handleGetCoordinates = async (ws, data) => {
   sendMessage(ws, "coordinates", grouped)
 }
 
+const handleGetCoordinateWindows = async (ws, data) => {
+  const windows = await handle.fetchCoordinateWindowsForSampleAndDeviceWithTime(
+    data.sample_id,
+    data.device_id,
+    data.from,
+    data.seconds || 25,
+    data.level || 1
+  )
+
+  sendMessage(ws, "coordinateWindows", windows.map(w => ({
+    window_start: Number(w.window_start),
+    level: w.level,
+    frames_per_second: w.frames_per_second,
+    num_frames: w.num_frames,
+    data: w.data.toString("base64")
+  })))
+}
+
 const handleWSConnection = wss => {
   wss.on("connection", function(ws, request) {
     ws.isAlive = true
@@ -92,6 +110,9 @@ const handleWSConnection = wss => {
         case "getCoordinates":
           handleGetCoordinates(ws, parsedMsg.data)
           return
+        case "getCoordinateWindows":
+          handleGetCoordinateWindows(ws, parsedMsg.data)
+          return
       }
     })
 
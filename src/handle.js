@@ -1,6 +1,22 @@
 const { Pool } = require("pg")
+const { unpackCoordinates, decodeBlock } = require("./coordinates")
 const pool = new Pool()
 
+// Length of the time blocks 'blocks' and 'delta' samples are stored in, must match the loader's COORDINATE_BLOCK_SECONDS
+const COORDINATE_BLOCK_SECONDS = parseInt(process.env.COORDINATE_BLOCK_SECONDS || 25)
+// Length of the exported coordinate windows, must match the loader's EXPORT_WINDOW_SECONDS
+const EXPORT_WINDOW_SECONDS = parseInt(process.env.EXPORT_WINDOW_SECONDS || 25)
+
+// Coordinates are stored in one of coordinates (numeric[]), coordinates_real (real[]) or coordinates_packed (bytea)
+const normalizeCoordinates = function(row) {
+  if (row.coordinates === null) {
+    row.coordinates = row.coordinates_packed !== null ? unpackCoordinates(row.coordinates_packed) : row.coordinates_real
+  }
+  delete row.coordinates_real
+  delete row.coordinates_packed
+  return row
+}
+
 exports.fetchSample = async function(environmentId, date) {
   try {
     const sql = `
@@ -21,7 +37,9 @@ exports.fetchSample = async function(environmentId, date) {
         s.frame_width,
         s.frame_height,
         s.source_type,
-        s.source_name
+        s.source_name,
+        s.coordinates_format,
+        s.sparse
       FROM
         samples s
         JOIN max_sample_id m ON s.id = m.id`
@@ -64,6 +82,11 @@ exports.fetchCoordinatesForSampleAndDeviceWithTime = async function(
   seconds
 ) {
   try {
+    const formats = await pool.query(`SELECT coordinates_format FROM samples WHERE id = ${sample_id}`)
+    if (formats.rows.length > 0 && ["blocks", "delta"].includes(formats.rows[0].coordinates_format)) {
+      return await exports.fetchCoordinateBlocksForSampleAndDeviceWithTime(sample_id, device_id, from, seconds)
+    }
+
     const sql = `
       WITH inputs AS (
         SELECT
@@ -75,7 +98,9 @@ exports.fetchCoordinatesForSampleAndDeviceWithTime = async function(
       SELECT
         c.geom_id,
         EXTRACT(epoch FROM c.time) * 1000 as time,
-        c.coordinates
+        c.coordinates,
+        c.coordinates_real,
+        c.coordinates_packed
       FROM
         inputs,
         coordinates c JOIN geoms g ON c.geom_id = g.id
@@ -87,13 +112,115 @@ exports.fetchCoordinatesForSampleAndDeviceWithTime = async function(
         c.geom_id, c.time ASC`
 
     const { rows } = await pool.query(sql)
-    return rows
+    return rows.map(normalizeCoordinates)
   } catch (e) {
     console.error("Handle - fetchCoordinatesForSampleAndDeviceWithTime failed")
     throw e
   }
 }
 
+// Expands a 'blocks' or 'delta' sample's coordinate_blocks rows into the rows fetchCoordinatesForSampleAndDeviceWithTime returns
+exports.fetchCoordinateBlocksForSampleAndDeviceWithTime = async function(
+  sample_id,
+  device_id,
+  from,
+  seconds
+) {
+  try {
+    const sql = `
+      WITH inputs AS (
+        SELECT
+          ${sample_id} as sample_id,
+          '${device_id}' as device_id,
+          '${from}'::TIMESTAMP as from,
+          ('${from}'::TIMESTAMP + interval '${seconds} seconds') as to
+      )
+      SELECT
+        c.geom_id,
+        EXTRACT(epoch FROM c.start_time) * 1000 as start_time,
+        EXTRACT(epoch FROM inputs.from) * 1000 as from_time,
+        EXTRACT(epoch FROM inputs.to) * 1000 as to_time,
+        c.frames_per_second,
+        c.coordinates,
+        c.coordinates_encoded
+      FROM
+        inputs,
+        coordinate_blocks c JOIN geoms g ON c.geom_id = g.id
+      WHERE
+        g.sample_id = inputs.sample_id
+        AND c.device_id = inputs.device_id
+        AND c.start_time > inputs.from - interval '${COORDINATE_BLOCK_SECONDS} seconds'
+        AND c.start_time <= inputs.to
+      ORDER BY
+        c.geom_id, c.start_time ASC`
+
+    const { rows } = await pool.query(sql)
+    const coordinates = []
+    rows.forEach(block => {
+      const startTime = Number(block.start_time)
+      const blockCoordinates = block.coordinates !== null ? block.coordinates : decodeBlock(block.coordinates_encoded)
+      blockCoordinates.forEach((frameCoordinates, idx) => {
+        const time = startTime + (idx * 1000) / block.frames_per_second
+        if (time >= Number(block.from_time) && time <= Number(block.to_time)) {
+          coordinates.push({
+            geom_id: block.geom_id,
+            time: time,
+            coordinates: frameCoordinates
+          })
+        }
+      })
+    })
+    return coordinates
+  } catch (e) {
+    console.error("Handle - fetchCoordinateBlocksForSampleAndDeviceWithTime failed")
+    throw e
+  }
+}
+
+// Exported windows of a level of detail overlapping [from, from + seconds], a range of the
+// (sample_id, device_id, level, window_start) primary key. Level n windows last n * EXPORT_WINDOW_SECONDS
+exports.fetchCoordinateWindowsForSampleAndDeviceWithTime = async function(
+  sample_id,
+  device_id,
+  from,
+  seconds,
+  level = 1
+) {
+  try {
+    const sql = `
+      WITH inputs AS (
+        SELECT
+          ${sample_id} as sample_id,
+          '${device_id}' as device_id,
+          '${from}'::TIMESTAMP as from,
+          ('${from}'::TIMESTAMP + interval '${seconds} seconds') as to
+      )
+      SELECT
+        EXTRACT(epoch FROM w.window_start) * 1000 as window_start,
+        w.level,
+        w.frames_per_second,
+        w.num_frames,
+        w.data
+      FROM
+        inputs,
+        coordinate_windows w
+      WHERE
+        w.sample_id = inputs.sample_id
+        AND w.device_id = inputs.device_id
+        AND w.level = ${parseInt(level)}
+        AND w.window_start > inputs.from - interval '${EXPORT_WINDOW_SECONDS * parseInt(level)} seconds'
+        AND w.window_start <= inputs.to
+      ORDER BY
+        w.window_start ASC`
+
+    const { rows } = await pool.query(sql)
+    return rows
+  } catch (e) {
+    console.error("Handle - fetchCoordinateWindowsForSampleAndDeviceWithTime failed")
+    throw e
+  }
+}
+
 exports.fetchCoordinatesForGeomAndDeviceWithTime = async function(
   geom_id,
   device_id,
@@ -112,7 +239,9 @@ exports.fetchCoordinatesForGeomAndDeviceWithTime = async function(
       SELECT
         c.geom_id,
         EXTRACT(epoch FROM c.time) * 1000,
-        c.coordinates
+        c.coordinates,
+        c.coordinates_real,
+        c.coordinates_packed
       FROM
         time_inputs,
         coordinates c
@@ -124,7 +253,7 @@ exports.fetchCoordinatesForGeomAndDeviceWithTime = async function(
         c.time ASC`
 
     const { rows } = await pool.query(sql)
-    return rows
+    return rows.map(normalizeCoordinates)
   } catch (e) {
     console.error("Handle - fetchCoordinatesForGeomAndDeviceWithTime failed")
     throw e
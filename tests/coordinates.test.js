@@ -0,0 +1,19 @@
+// Decodes the blocks in fixtures/hcd1_blocks.json (encoded by honeycomb_tools/codec.py, see tests/test_codec.py),
+// run with `npm test`
+const assert = require("assert")
+const path = require("path")
+const { decodeBlock, unpackCoordinates } = require("../src/coordinates")
+
+const blocks = require(path.join(__dirname, "fixtures", "hcd1_blocks.json"))
+
+blocks.forEach(block => {
+  assert.deepStrictEqual(decodeBlock(Buffer.from(block.hex, "hex")), block.values, block.name)
+})
+
+assert.throws(() => decodeBlock(Buffer.from("HCD0" + "00".repeat(16), "latin1")), /Not a delta encoded block/)
+
+// count 3, bitmap 0b010, then float32 1.5 and -2
+const packed = Buffer.from("0300020000c03f000000c0", "hex")
+assert.deepStrictEqual(unpackCoordinates(packed), [1.5, null, -2])
+
+console.log("%d blocks decoded", blocks.length)
@@ -0,0 +1,53 @@
+import honeycomb_tools.cache as cache
+from honeycomb_tools.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_ttl_cache_entries_expire(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', clock)
+    ttl_cache = TTLCache(ttl=10, max_size=10)
+    ttl_cache.set('a', 1)
+
+    clock.now += 10
+    assert ttl_cache.get('a') == 1
+    clock.now += 1
+    assert ttl_cache.get('a', 'expired') == 'expired'
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    ttl_cache = TTLCache(ttl=60, max_size=2)
+    ttl_cache.set('a', 1)
+    ttl_cache.set('b', 2)
+    assert ttl_cache.get('a') == 1
+    ttl_cache.set('c', 3)
+    assert ttl_cache.get('b') is None
+    assert ttl_cache.get('a') == 1
+    assert ttl_cache.get('c') == 3
+
+
+def test_ttl_cache_persists_across_instances(tmp_path, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', clock)
+    path = str(tmp_path / "cache.sqlite")
+    TTLCache(ttl=10, max_size=10, path=path).set('a', {'environment_id': 'e-1'})
+
+    assert TTLCache(ttl=10, max_size=10, path=path).get('a') == {'environment_id': 'e-1'}
+    clock.now += 11
+    assert TTLCache(ttl=10, max_size=10, path=path).get('a') is None
+
+
+def test_ttl_cache_clear(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    ttl_cache = TTLCache(ttl=60, max_size=10, path=path)
+    ttl_cache.set('a', 1)
+    ttl_cache.clear()
+    assert ttl_cache.get('a') is None
+    assert TTLCache(ttl=60, max_size=10, path=path).get('a') is None
@@ -0,0 +1,71 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from honeycomb_tools.codec import decode_block, encode_block
+
+# Blocks decoded by both this test and tests/coordinates.test.js (src/coordinates.js decodeBlock)
+FIXTURE = os.path.join(os.path.dirname(__file__), 'fixtures', 'hcd1_blocks.json')
+
+
+def fixture_blocks():
+    with open(FIXTURE) as fp:
+        return json.load(fp)
+
+
+def as_values(decoded):
+    return [[None if np.isnan(value) else float(value) for value in frame] for frame in decoded]
+
+
+def as_array(values):
+    return np.array([[np.nan if value is None else value for value in frame] for frame in values])
+
+
+@pytest.mark.parametrize('block', fixture_blocks(), ids=lambda block: block['name'])
+def test_decode_fixture_block(block):
+    assert as_values(decode_block(bytes.fromhex(block['hex']))) == block['values']
+
+
+@pytest.mark.parametrize('block', fixture_blocks(), ids=lambda block: block['name'])
+def test_encode_fixture_block(block):
+    # Pins the byte layout the JS decoder reads
+    assert encode_block(as_array(block['values']), block['quantum']).hex() == block['hex']
+
+
+def random_values(num_frames=200, num_values=6):
+    rng = np.random.default_rng(0)
+    values = np.cumsum(rng.normal(0, 5, size=(num_frames, num_values)), axis=0) + 1000
+    values[rng.random(size=values.shape) < 0.1] = np.nan
+    values[50:60] = np.nan
+    return values
+
+
+def test_lossless_round_trip_is_exact_float32():
+    values = random_values()
+    decoded = decode_block(encode_block(values))
+    assert decoded.shape == values.shape
+    np.testing.assert_array_equal(decoded, values.astype(np.float32))
+
+
+@pytest.mark.parametrize('quantum', [0.01, 0.5, 1.0])
+def test_quantized_round_trip_is_within_half_a_quantum(quantum):
+    values = random_values()
+    decoded = decode_block(encode_block(values, quantum))
+    np.testing.assert_array_equal(np.isnan(decoded), np.isnan(values))
+    valid = ~np.isnan(values)
+    assert np.max(np.abs(decoded[valid] - values[valid])) <= float(np.float32(quantum)) / 2 + 1e-9
+
+
+@pytest.mark.parametrize('quantum', [0, 1.0])
+def test_round_trip_without_valid_values(quantum):
+    values = np.full((5, 3), np.nan)
+    decoded = decode_block(encode_block(values, quantum))
+    assert decoded.shape == (5, 3)
+    assert np.isnan(decoded).all()
+
+
+def test_decode_rejects_other_data():
+    with pytest.raises(ValueError):
+        decode_block(b"HCD0" + bytes(16))
@@ -0,0 +1,10 @@
+import honeycomb_tools.collection_store as collection_store
+from honeycomb_tools.collection_store import CollectionCache
+
+
+def test_collection_cache_get_survives_a_concurrent_eviction(tmp_path, monkeypatch):
+    cache = CollectionCache(str(tmp_path), max_bytes=1024)
+    sample_collection = {'device-1': object()}
+    # The store is evicted by another process right after it's loaded
+    monkeypatch.setattr(collection_store, 'load_collections', lambda path: sample_collection)
+    assert cache.get(['cuwb', 'environment-1']) is sample_collection
@@ -0,0 +1,86 @@
+import threading
+
+import psycopg2
+
+import honeycomb_tools.connections as connections
+from honeycomb_tools.connections import CopyThrottle
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def perf_counter(self):
+        return self.now
+
+
+def record_window(throttle, clock, seconds, rows=100):
+    clock.now += seconds
+    for _ in range(throttle.limit):
+        throttle.record(rows)
+
+
+def test_copy_throttle_slots_limit_concurrent_copies():
+    throttle = CopyThrottle(max_limit=2, initial_limit=2)
+    release = threading.Event()
+    active = []
+    peak = []
+    lock = threading.Lock()
+
+    def copy():
+        with throttle.slot():
+            with lock:
+                active.append(1)
+                peak.append(len(active))
+            release.wait()
+            with lock:
+                active.pop()
+
+    threads = [threading.Thread(target=copy) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while throttle.waiting < 2:
+        threading.Event().wait(0.01)
+
+    assert len(active) == 2
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert max(peak) == 2
+    assert throttle.waiting == 0
+
+
+def test_copy_throttle_steps_down_while_throughput_drops(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(connections, 'time', clock)
+    throttle = CopyThrottle(max_limit=8, initial_limit=7)
+
+    record_window(throttle, clock, 1)
+    assert throttle.limit == 8  # the first window probes upwards
+    record_window(throttle, clock, 1)
+    assert throttle.limit == 8  # probing upwards is capped at max_limit
+    record_window(throttle, clock, 2)
+    assert throttle.limit == 7
+    record_window(throttle, clock, 0.5)
+    assert throttle.limit == 6  # improving after a step down keeps stepping down
+    record_window(throttle, clock, 6 * 100 / 1400)
+    assert throttle.limit == 6  # the same throughput, the limit holds
+    record_window(throttle, clock, 1)
+    assert throttle.limit == 5
+
+
+def test_copy_throttle_starts_at_half_of_max_limit():
+    assert CopyThrottle(max_limit=5).limit == 3
+    assert CopyThrottle(max_limit=1).limit == 1
+    assert CopyThrottle(max_limit=8, min_limit=6).limit == 6
+
+
+def test_copy_throttle_halves_on_server_errors_only():
+    throttle = CopyThrottle(max_limit=8, min_limit=2, initial_limit=8)
+    throttle.record_error(ValueError("bad data"))
+    assert throttle.limit == 8
+    throttle.record_error(psycopg2.OperationalError("server closed the connection"))
+    assert throttle.limit == 4
+    throttle.record_error(psycopg2.OperationalError("server closed the connection"))
+    throttle.record_error(psycopg2.OperationalError("server closed the connection"))
+    assert throttle.limit == 2
@@ -0,0 +1,127 @@
+import datetime
+
+import numpy as np
+import pytest
+
+import honeycomb_tools.config as config
+from honeycomb_tools.export import build_device_windows, coordinate_window_path, decimate_coordinates, delete_coordinate_windows_from_time, discard_coordinate_window_files, \
+    export_device_windows, fetch_coordinate_windows, fetch_straddling_coordinate_windows, merge_coordinate_windows, promote_coordinate_window_files, restore_coordinate_windows
+
+
+@pytest.fixture
+def export_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'EXPORT_DIR', str(tmp_path))
+    return tmp_path
+
+
+def device_frames(num_frames=20, frames_per_second=10, value=0.0):
+    coordinates = np.full((num_frames, 2, 2), value)
+    times = np.datetime64('2020-01-01T12:00:00', 'us') + np.arange(num_frames) * np.timedelta64(1000000 // frames_per_second, 'us')
+    return coordinates, times
+
+
+def test_build_device_windows_aligns_windows_to_the_epoch():
+    # 24 frames at 10 fps from 12:00:00.5 to 12:00:02.8, windows of 1 second
+    coordinates = np.arange(24 * 3 * 2, dtype=np.float64).reshape((24, 3, 2))
+    times = np.datetime64('2020-01-01T12:00:00.5', 'us') + np.arange(24) * np.timedelta64(100000, 'us')
+    windows = list(build_device_windows(coordinates, times, 10, [(7, [0, 1]), (8, [2])], window_seconds=1))
+
+    assert [window_start for window_start, _, _ in windows] == [np.datetime64('2020-01-01T12:00:00', 'us') + np.timedelta64(s, 's') for s in range(3)]
+    assert [complete for _, _, complete in windows] == [False, True, False]
+
+    first_geoms = windows[0][1]
+    assert first_geoms[7].shape == (10, 4)
+    assert first_geoms[8].shape == (10, 2)
+    assert np.isnan(first_geoms[7][:5]).all()
+    np.testing.assert_array_equal(first_geoms[7][5], coordinates[0, [0, 1]].reshape(-1))
+    np.testing.assert_array_equal(windows[2][1][8][8], coordinates[23, 2])
+    assert np.isnan(windows[2][1][8][9:]).all()
+
+
+def test_build_device_windows_of_a_frame_range():
+    coordinates, times = device_frames(num_frames=30)
+    windows = list(build_device_windows(coordinates, times, 10, [(7, [0])], start_frame=10, end_frame=20, window_seconds=1))
+    assert [(window_start, complete) for window_start, _, complete in windows] == [(np.datetime64('2020-01-01T12:00:01', 'us'), True)]
+    assert list(build_device_windows(coordinates, times, 10, [(7, [0])], start_frame=20, end_frame=20, window_seconds=1)) == []
+
+
+def test_decimate_coordinates_is_a_nan_aware_mean():
+    values = np.array([[1.0, np.nan], [3.0, np.nan], [np.nan, 4.0], [np.nan, np.nan]], dtype=np.float32)
+    decimated = decimate_coordinates(values, 2)
+    np.testing.assert_array_equal(decimated, np.array([[2.0, np.nan], [np.nan, 4.0]], dtype=np.float32))
+    assert decimate_coordinates(values, 1) is values
+
+
+def test_merge_coordinate_windows_fills_missing_frames():
+    stored = [{'geoms': {7: np.array([[1.0], [2.0]], dtype=np.float32), 8: np.array([[5.0], [6.0]], dtype=np.float32)}},
+              None]
+    geoms = {7: np.array([[np.nan], [9.0], [np.nan], [np.nan]], dtype=np.float32)}
+    merged = merge_coordinate_windows(stored, geoms)
+
+    np.testing.assert_array_equal(merged[7], np.array([[1.0], [9.0], [np.nan], [np.nan]], dtype=np.float32))
+    # Geoms only in the stored windows are kept, frames of windows that weren't stored are NaN
+    np.testing.assert_array_equal(merged[8], np.array([[5.0], [6.0], [np.nan], [np.nan]], dtype=np.float32))
+
+
+def export(pending, value):
+    coordinates, times = device_frames(value=value)
+    return export_device_windows(None, 1, 'device-1', coordinates, times, 10, [(7, [0, 1])], target='files', window_seconds=1, levels=[1], pending=pending)
+
+
+def stored_values(export_dir):
+    _, times = device_frames()
+    windows = fetch_coordinate_windows(None, 1, 'device-1', [times[0]], target='files', directory=str(export_dir))
+    return {float(window['geoms'][7][0, 0]) for window in windows.values()}
+
+
+def test_pending_window_files_are_promoted(export_dir):
+    pending = dict()
+    assert export(pending, 1.0) == 2
+    assert stored_values(export_dir) == set()
+    assert len(pending) == 2
+
+    promote_coordinate_window_files(pending)
+    assert pending == {}
+    assert stored_values(export_dir) == {1.0}
+
+
+def test_pending_window_files_are_discarded(export_dir):
+    export(None, 1.0)
+    pending = dict()
+    export(pending, 2.0)
+
+    discard_coordinate_window_files(pending)
+    assert pending == {}
+    assert stored_values(export_dir) == {1.0}
+    assert [p.name for p in export_dir.rglob('*.part')] == []
+
+
+def test_pending_window_files_are_read_back_before_promotion(export_dir):
+    pending = dict()
+    export(pending, 3.0)
+    _, times = device_frames()
+    path = coordinate_window_path(str(export_dir), 1, 'device-1', times[0])
+    windows = fetch_coordinate_windows(None, 1, 'device-1', [times[0]], target='files', pending=pending)
+    assert path in pending
+    assert float(next(iter(windows.values()))['geoms'][7][0, 0]) == 3.0
+
+
+def test_failed_append_restores_the_window_it_straddles(export_dir):
+    coordinates, times = device_frames()
+    coordinates[15:] = 2.0
+    geoms = [(7, [0, 1])]
+    export_device_windows(None, 1, 'device-1', coordinates, times, 10, geoms, end_frame=15, target='files', window_seconds=1, levels=[1])
+    from_time = datetime.datetime(2020, 1, 1, 12, 0, 1, 500000)
+
+    straddling = fetch_straddling_coordinate_windows(None, 1, from_time, target='files', window_seconds=1)
+    assert len(straddling) == 1
+    export_device_windows(None, 1, 'device-1', coordinates, times, 10, geoms, start_frame=15, target='files', window_seconds=1, levels=[1])
+
+    assert delete_coordinate_windows_from_time(None, 1, from_time, target='files', window_seconds=1)
+    assert restore_coordinate_windows(None, straddling, target='files')
+
+    windows = fetch_coordinate_windows(None, 1, 'device-1', times[[0, 10]], target='files')
+    assert sorted(windows) == [times[0], times[10]]
+    restored = windows[times[10]]['geoms'][7]
+    assert (restored[:5] == 0.0).all()
+    assert np.isnan(restored[5:]).all()
@@ -0,0 +1,118 @@
+import struct
+
+import numpy as np
+import pytest
+
+from honeycomb_tools.handle_utils import IteratorFile, drop_empty_frames, encode_numerics_binary, format_coordinates_binary
+
+
+def test_iterator_file_read_to_eof():
+    reader = IteratorFile(iter(["ab", b"cd", "", "efg"]), chunk_size=2)
+    assert reader.read() == b"abcdefg"
+    assert reader.read() == b""
+    assert reader.bytes_read == 7
+
+
+def test_iterator_file_read_size():
+    reader = IteratorFile(iter(["abcde", "f"]))
+    assert reader.read(2) == b"ab"
+    assert reader.read(10) == b"cde"
+    assert reader.read(10) == b"f"
+    assert reader.read(10) == b""
+
+
+def test_iterator_file_readinto():
+    reader = IteratorFile(iter(["abc", "de"]))
+    buffer = bytearray(2)
+    chunks = []
+    while True:
+        size = reader.readinto(buffer)
+        if size == 0:
+            break
+        chunks.append(bytes(buffer[:size]))
+    assert b"".join(chunks) == b"abcde"
+
+
+def test_iterator_file_propagates_errors():
+    def chunks():
+        yield "abc"
+        raise RuntimeError("formatting failed")
+
+    reader = IteratorFile(chunks())
+    assert reader.read(3) == b"abc"
+    with pytest.raises(RuntimeError):
+        reader.read()
+
+
+def wire_row(device_id, geom_id, time_us, array):
+    """
+    A binary COPY tuple of (device_id, assignment_id NULL, geom_id, time, coordinates) built field by field
+    """
+    return b"".join([
+        struct.pack('>h', 5),
+        struct.pack('>i', len(device_id)) + device_id,
+        struct.pack('>i', -1),
+        struct.pack('>ii', 4, geom_id),
+        struct.pack('>iq', 8, time_us),
+        struct.pack('>i', len(array)) + array
+    ])
+
+
+def test_format_coordinates_binary_numeric_wire_bytes():
+    coordinates = {
+        'device_id': 'd',
+        'assignment_id': None,
+        'geom_id': 7,
+        'time': np.array(['2000-01-01T00:00:01'], dtype='datetime64[us]'),
+        'coordinates': np.array([[1.5, -2.25, np.nan]])
+    }
+    # numeric_send layout: ndigits, weight, sign, dscale, then base 10000 digits, most significant first
+    array = b"".join([
+        struct.pack('>iiiii', 1, 1, 1700, 3, 1),
+        struct.pack('>i', 16) + struct.pack('>hhhh', 4, 1, 0x0000, 1) + struct.pack('>hhhh', 0, 1, 5000, 0),
+        struct.pack('>i', 16) + struct.pack('>hhhh', 4, 1, 0x4000, 2) + struct.pack('>hhhh', 0, 2, 2500, 0),
+        struct.pack('>i', -1)
+    ])
+    assert format_coordinates_binary(coordinates, 'numeric') == wire_row(b'd', 7, 1000000, array)
+
+
+def test_format_coordinates_binary_real_wire_bytes():
+    coordinates = {
+        'device_id': 'd',
+        'assignment_id': None,
+        'geom_id': 7,
+        'time': np.array(['2000-01-01T00:00:01'], dtype='datetime64[us]'),
+        'coordinates': np.array([[1.5, np.nan]])
+    }
+    array = b"".join([
+        struct.pack('>iiiii', 1, 1, 700, 2, 1),
+        struct.pack('>if', 4, 1.5),
+        struct.pack('>i', -1)
+    ])
+    assert format_coordinates_binary(coordinates, 'real') == wire_row(b'd', 7, 1000000, array)
+
+
+def test_encode_numerics_binary_carries_rounding():
+    sign, dscale, digits = encode_numerics_binary(np.array([9999.999999999, 12345678.12345678]))
+    assert digits.tolist() == [[1, 0, 0, 0], [1234, 5678, 1234, 5678]]
+    assert dscale.tolist() == [0, 8]
+
+
+@pytest.mark.parametrize('value', [1e8, -1e8, np.inf, -np.inf])
+def test_encode_numerics_binary_out_of_range(value):
+    with pytest.raises(ValueError):
+        encode_numerics_binary(np.array([[0.5, value]]))
+
+
+def test_drop_empty_frames_drops_all_nan_frames_and_keeps_partial_ones():
+    coordinates = {
+        'device_id': 'd',
+        'assignment_id': np.array(['a', 'b', 'c']),
+        'geom_id': 7,
+        'time': np.array(['2000-01-01T00:00:01', '2000-01-01T00:00:02', '2000-01-01T00:00:03'], dtype='datetime64[us]'),
+        'coordinates': np.array([[1.0, np.nan], [np.nan, np.nan], [np.nan, 2.0]])
+    }
+    dropped = drop_empty_frames(coordinates)
+    assert dropped['assignment_id'].tolist() == ['a', 'c']
+    assert dropped['time'].tolist() == coordinates['time'][[0, 2]].tolist()
+    np.testing.assert_array_equal(dropped['coordinates'], [[1.0, np.nan], [np.nan, 2.0]])
@@ -0,0 +1,69 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+from honeycomb_tools.introspection import AssignmentIndex, is_cc_assignment
+
+
+def assignment(assignment_id, device_id, start, end, assigned_type='Person', name=None):
+    return {
+        'assignment_id': assignment_id,
+        'start': start,
+        'end': end,
+        'assigned': dict({'device_id': device_id}, **({'name': name} if name is not None else {})),
+        'assigned_type': assigned_type
+    }
+
+
+def frame_times(*times):
+    return np.array(times, dtype='datetime64[us]')
+
+
+def test_assignment_ids_at_times():
+    index = AssignmentIndex([
+        assignment('a-1', 'device-1', '2020-01-01T12:00:00.000Z', '2020-01-01T12:00:10.000Z'),
+        assignment('a-2', 'device-1', '2020-01-01T12:00:20.000Z', None),
+        assignment('a-3', 'device-2', '2020-01-01T12:00:00.000Z', None)
+    ])
+    times = frame_times('2020-01-01T11:59:59', '2020-01-01T12:00:00', '2020-01-01T12:00:10', '2020-01-01T12:00:10.000001', '2020-01-01T12:00:20', '2020-01-02T00:00:00')
+    # Starts and ends are inclusive, the gap between assignments and times before the first are unassigned
+    assert index.assignment_ids_at_times('device-1', times).tolist() == [None, 'a-1', 'a-1', None, 'a-2', 'a-2']
+
+
+def test_assignment_ids_at_times_of_a_reassigned_device_follow_the_latest_start():
+    index = AssignmentIndex([
+        assignment('a-1', 'device-1', '2020-01-01T12:00:00.000Z', None),
+        assignment('a-2', 'device-1', '2020-01-01T12:00:10.000Z', '2020-01-01T12:00:20.000Z')
+    ])
+    times = frame_times('2020-01-01T12:00:05', '2020-01-01T12:00:15', '2020-01-01T12:00:25')
+    assert index.assignment_ids_at_times('device-1', times).tolist() == ['a-1', 'a-2', 'a-1']
+
+
+def test_assignment_ids_at_times_filters_assignments():
+    index = AssignmentIndex([
+        assignment('a-1', 'device-1', '2020-01-01T12:00:00.000Z', '2020-01-01T12:00:10.000Z', assigned_type='Tray'),
+        assignment('a-2', 'device-1', '2020-01-01T12:00:10.001Z', None)
+    ])
+    times = frame_times('2020-01-01T12:00:05', '2020-01-01T12:00:15')
+    assignment_ids = index.assignment_ids_at_times('device-1', times, assignment_filter=lambda a: a['assigned_type'] == 'Person')
+    assert assignment_ids.tolist() == [None, 'a-2']
+
+
+def test_assignment_ids_at_times_of_an_unknown_device():
+    index = AssignmentIndex([assignment('a-1', 'device-1', '2020-01-01T12:00:00.000Z', None)])
+    assert index.assignment_ids_at_times('device-2', frame_times('2020-01-01T12:00:05')).tolist() == [None]
+
+
+def test_filtered_assignment_of_overlapping_intervals():
+    # A regular assignment starts while the device's cc assignment is still active
+    index = AssignmentIndex([
+        assignment('cc-1', 'device-1', '2020-01-01T12:00:00.000Z', None, name='cc-tag-1'),
+        assignment('a-1', 'device-1', '2020-01-01T12:00:10.000Z', '2020-01-01T12:00:20.000Z', name='tray-1')
+    ])
+    times = frame_times('2020-01-01T12:00:05', '2020-01-01T12:00:15', '2020-01-01T12:00:25')
+    assert index.assignment_ids_at_times('device-1', times, assignment_filter=is_cc_assignment).tolist() == ['cc-1', 'cc-1', 'cc-1']
+    assert index.assignment_ids_at_times('device-1', times).tolist() == ['cc-1', 'a-1', 'cc-1']
+
+    time = datetime(2020, 1, 1, 12, 0, 15, tzinfo=timezone.utc)
+    assert index.assignment_at('device-1', time)['assignment_id'] == 'a-1'
+    assert [a['assignment_id'] for a in index.assignments_at(time, assignment_filter=is_cc_assignment)] == ['cc-1']
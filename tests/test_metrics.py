@@ -0,0 +1,24 @@
+import honeycomb_tools.metrics as metrics
+from honeycomb_tools.metrics import LoadMetrics
+
+
+def series(path, name):
+    with open(path) as fp:
+        return [line for line in fp.read().splitlines() if line.startswith("%s_%s" % (metrics.PROMETHEUS_PREFIX, name))]
+
+
+def test_prometheus_textfile_keeps_every_label_set(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics, '_prometheus_reports', dict())
+    prometheus_file = str(tmp_path / "geom_processor.prom")
+
+    for environment, status in [('env-a', 'success'), ('env-b', 'failed'), ('env-a', 'failed')]:
+        sample_metrics = LoadMetrics(environment=environment, source_type='pose')
+        sample_metrics.stop(status)
+        assert sample_metrics.write(report_dir="", prometheus_file=prometheus_file)
+
+    assert series(prometheus_file, "sample_success") == [
+        'geom_processor_sample_success{environment="env-a",source_type="pose"} 0.0',
+        'geom_processor_sample_success{environment="env-b",source_type="pose"} 0.0'
+    ]
+    with open(prometheus_file) as fp:
+        assert fp.read().count("# TYPE geom_processor_sample_success gauge") == 1
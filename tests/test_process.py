@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import threading
+
+import numpy as np
+import pytest
+
+import honeycomb_tools.config as config
+import honeycomb_tools.process as process
+from honeycomb_tools.collection_store import StoredGeom, StoredGeomCollection
+from honeycomb_tools.process import ProcessingError, SampleHeartbeat, cuwb_shard_ranges, device_geom_uuids, fetch_cuwb_shard, geom_uuid, serialize_geom_attributes, stream_device_coordinates, undo_failed_load, \
+    valid_coordinate_indices
+
+
+def make_device(geoms, num_frames=20, num_points=4, frames_per_second=10):
+    coordinates = np.arange(num_frames * num_points * 2, dtype=np.float64).reshape((num_frames, num_points, 2))
+    return StoredGeomCollection(coordinates=coordinates,
+                                geom_list=geoms,
+                                start_time=datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc),
+                                frames_per_second=frames_per_second,
+                                num_frames=num_frames)
+
+
+def make_geom(geom_id, coordinate_indices, geom_type='Line2D', **attributes):
+    return StoredGeom(geom_type, coordinate_indices, dict(attributes, id=geom_id, object_id='person-1'))
+
+
+@pytest.fixture(autouse=True)
+def text_copy_format(monkeypatch):
+    monkeypatch.setattr(config, 'COPY_FORMAT', 'text')
+
+
+def stream(device, geom_id_to_geom_db_id_map, **kwargs):
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        return list(stream_device_coordinates(pool=pool,
+                                              device_id='device-1',
+                                              device=device,
+                                              assignment_id='assignment-1',
+                                              geom_id_to_geom_db_id_map=geom_id_to_geom_db_id_map,
+                                              window_frames=5,
+                                              **kwargs))
+
+
+def test_stream_device_coordinates_is_cancelled():
+    device = make_device([make_geom('a', [0, 1])])
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(ProcessingError):
+        stream(device, {'a': 1}, cancelled=cancelled)
+
+
+def streamed_geom_rows(chunks):
+    rows = dict()
+    for data, _ in chunks:
+        for line in data.splitlines():
+            geom_db_id = int(line.split("\t")[2])
+            rows[geom_db_id] = rows.get(geom_db_id, 0) + 1
+    return rows
+
+
+def test_sharded_geoms_that_only_differ_by_indices_are_both_loaded():
+    # Two limbs of the same person, alike except for which points they join
+    device = make_device([make_geom('a', [0, 1]), make_geom('b', [2, 3])])
+    geom_uuids = device_geom_uuids(device)
+    assert geom_uuids[0][2] != geom_uuids[1][2]
+
+    geom_id_to_geom_db_id_map = {geom.id: db_id for db_id, (geom, _, _) in enumerate(geom_uuids, start=1)}
+    assert streamed_geom_rows(stream(device, geom_id_to_geom_db_id_map)) == {1: 20, 2: 20}
+
+
+def test_sparse_stream_drops_all_nan_frames_and_keeps_partial_ones():
+    device = make_device([make_geom('a', [0, 1]), make_geom('b', [2, 3])])
+    device.coordinates[3] = np.nan  # every point absent, dropped for both geoms
+    device.coordinates[5, 0] = np.nan  # geom a keeps the frame on its remaining point
+    device.coordinates[7, 2:] = np.nan  # geom b's points absent, only geom b drops the frame
+    assert streamed_geom_rows(stream(device, {'a': 1, 'b': 2}, sparse=True)) == {1: 19, 2: 18}
+    assert streamed_geom_rows(stream(device, {'a': 1, 'b': 2})) == {1: 20, 2: 20}
+
+
+def test_empty_geoms_are_skipped():
+    device = make_device([make_geom('a', [0, 1]), make_geom('b', [2, 3])])
+    device.coordinates[:, 2:] = np.nan
+    assert valid_coordinate_indices(device.coordinates).tolist() == [True, True, False, False]
+    # A sparse sample leaves empty geoms out of the geom map, their coordinates aren't streamed
+    assert streamed_geom_rows(stream(device, {'a': 1}, sparse=True)) == {1: 20}
+
+
+def test_fetch_stable_geom_uuids_survive_reindexing():
+    first_shard = make_device([make_geom('a', [0, 1]), make_geom('b', [2, 3])])
+    second_shard = make_device([make_geom('c', [3, 2]), make_geom('d', [1, 0])])
+    assert [u for _, _, u in device_geom_uuids(first_shard)] == [u for _, _, u in device_geom_uuids(second_shard)]
+
+
+def test_geom_uuids_are_positioned_per_identity():
+    device = make_device([make_geom('a', [0, 1]), StoredGeom('Line2D', [2, 3], dict(id='b', object_id='person-2'))])
+    other_device = make_device([StoredGeom('Line2D', [1, 2], dict(id='c', object_id='person-2'))])
+    uuids = [u for _, _, u in device_geom_uuids(device)]
+    assert uuids[0] != uuids[1]
+    assert uuids[1] == device_geom_uuids(other_device)[0][2]
+
+
+def test_serialize_geom_attributes_keeps_equal_values_of_other_types_apart():
+    assert serialize_geom_attributes(StoredGeom('Line2D', [0, 1], {'a': True})) == '{"a": true}'
+    assert serialize_geom_attributes(StoredGeom('Line2D', [0, 1], {'a': 1})) == '{"a": 1}'
+    assert serialize_geom_attributes(StoredGeom('Line2D', [0, 1], {'a': 1.0})) == '{"a": 1.0}'
+
+
+def test_geom_uuid_ignores_the_geom_id():
+    geom = make_geom('a', [0, 1])
+    assert geom_uuid(geom, '{"id": "a", "object_id": "person-1"}') == geom_uuid(geom, '{"object_id": "person-1", "id": "b"}')
+    assert geom_uuid(geom, '{"id": "a", "object_id": "person-1"}') != geom_uuid(geom, '{"id": "a", "object_id": "person-2"}')
+    assert geom_uuid(geom, '{"object_id": "person-1"}') != geom_uuid(make_geom('a', [0, 1], geom_type='Point2D'), '{"object_id": "person-1"}')
+    assert geom_uuid(geom, '{"object_id": "person-1"}') != geom_uuid(geom, '{"object_id": "person-1"}', position=1)
+
+
+def test_cuwb_shard_ranges():
+    start_time = datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc)
+
+    def minutes(m):
+        return start_time + datetime.timedelta(minutes=m)
+
+    assert cuwb_shard_ranges(start_time, minutes(60), shard_minutes=30) == [(minutes(0), minutes(30)), (minutes(30), minutes(60))]
+    assert cuwb_shard_ranges(start_time, minutes(45), shard_minutes=30) == [(minutes(0), minutes(30)), (minutes(30), minutes(45))]
+    assert cuwb_shard_ranges(start_time, minutes(45), shard_minutes=0) == [(minutes(0), minutes(45))]
+    assert cuwb_shard_ranges(None, None, shard_minutes=30) == [(None, None)]
+    assert cuwb_shard_ranges(start_time, start_time, shard_minutes=30) == []
+
+
+@pytest.mark.parametrize('hours_from_now, cached', [(-1, True), (1, False)])
+def test_fetch_cuwb_shard_only_caches_ended_shards(monkeypatch, hours_from_now, cached):
+    end_time = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=hours_from_now)
+    start_time = end_time - datetime.timedelta(minutes=30)
+    fetches = []
+    cached_keys = []
+    monkeypatch.setattr(process, 'fetch_cuwb_geoms_2d', lambda *args: fetches.append(args) or dict())
+    monkeypatch.setattr(process, 'fetch_collections_cached', lambda key, fetch: cached_keys.append(key) or fetch())
+
+    assert fetch_cuwb_shard('environment-1', start_time, end_time, 'shard.npz') is None
+    assert fetches == [('environment-1', start_time, end_time)]
+    assert len(cached_keys) == int(cached)
+
+
+def test_geom_uuid_collision_raises(monkeypatch):
+    device = make_device([make_geom('a', [0, 1]), make_geom('b', [2, 3])])
+    monkeypatch.setattr(process, 'geom_uuid', lambda *args, **kwargs: 'collision')
+    with pytest.raises(ProcessingError):
+        device_geom_uuids(device)
+
+
+class FakeCursor:
+    def __init__(self):
+        self.executed = []
+        self.rowcount = 1
+
+    def execute(self, query, params=None):
+        self.executed.append(params)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self):
+        self.cursors = []
+        self.commits = 0
+
+    def cursor(self):
+        self.cursors.append(FakeCursor())
+        return self.cursors[-1]
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeConnectionPool:
+    def __init__(self):
+        self.conn = FakeConnection()
+        self.checked_out = 0
+
+    def getconn(self):
+        self.checked_out += 1
+        return self.conn
+
+    def putconn(self, conn, close=False):
+        self.checked_out -= 1
+
+
+def test_sample_heartbeat_renews_the_claim():
+    pg_client = FakeConnectionPool()
+    heartbeat = SampleHeartbeat(pg_client, sample_id=7, loader_id='loader-1', interval=0.01)
+    heartbeat.start()
+    threading.Event().wait(0.1)
+    heartbeat.stop()
+
+    assert pg_client.conn.commits > 0
+    assert pg_client.conn.cursors[0].executed == [{'sample_id': 7, 'loader_id': 'loader-1'}]
+    assert pg_client.checked_out == 0
+
+
+@pytest.fixture
+def cleanup_calls(monkeypatch):
+    calls = []
+    for name in ['drop_coordinates_staging', 'delete_sample_coordinates_from_time', 'delete_geoms', 'delete_coordinate_windows_from_time',
+                 'restore_coordinate_windows', 'delete_sample_device_statuses', 'release_sample']:
+        monkeypatch.setattr(process, name, lambda *args, _name=name, **kwargs: calls.append(_name) or True)
+    monkeypatch.setattr(config, 'EXPORT_TARGET', 'table')
+    return calls
+
+
+class FakeRollbackConnection(FakeConnection):
+    def __init__(self):
+        super().__init__()
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_failed_staged_append_removes_its_geoms_and_windows(cleanup_calls):
+    conn = FakeRollbackConnection()
+    appended_sample = {'id': 7, 'end_time': datetime.datetime(2020, 1, 1, 12)}
+    undo_failed_load(conn, conn.cursor(), 7, 'loader-1', staging_table='coordinates_staging_7', appended_sample=appended_sample, inserted_geom_ids={3, 4}, straddling_windows=[])
+
+    # The appended sample's coordinates never left the staging table and its device statuses are kept
+    assert cleanup_calls == ['drop_coordinates_staging', 'delete_geoms', 'delete_coordinate_windows_from_time', 'restore_coordinate_windows']
+    assert (conn.rollbacks, conn.commits) == (1, 1)
+
+
+def test_failed_staged_load_restarts_from_scratch(cleanup_calls):
+    conn = FakeRollbackConnection()
+    undo_failed_load(conn, conn.cursor(), 7, 'loader-1', staging_table='coordinates_staging_7', inserted_geom_ids={3})
+    assert cleanup_calls == ['drop_coordinates_staging', 'delete_sample_device_statuses', 'release_sample']
+
+
+def test_failed_append_removes_what_it_added(cleanup_calls):
+    conn = FakeRollbackConnection()
+    appended_sample = {'id': 7, 'end_time': datetime.datetime(2020, 1, 1, 12)}
+    undo_failed_load(conn, conn.cursor(), 7, 'loader-1', appended_sample=appended_sample, inserted_geom_ids=set(), straddling_windows=[])
+    assert cleanup_calls == ['delete_sample_coordinates_from_time', 'delete_coordinate_windows_from_time', 'restore_coordinate_windows']
@@ -0,0 +1,110 @@
+import pytest
+
+import honeycomb_tools.util as util
+
+
+class FakeResponse:
+    def __init__(self, content, headers, status_code=200):
+        self.content = content
+        self.headers = headers
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size=1):
+        for idx in range(0, len(self.content), chunk_size):
+            yield self.content[idx:idx + chunk_size]
+
+
+def fake_get(responses, requests_made):
+    def get(url, headers=None, **kwargs):
+        requests_made.append(headers or dict())
+        return responses.pop(0)
+    return get
+
+
+def test_download_is_cached_by_etag(tmp_path, monkeypatch):
+    requests_made = []
+    monkeypatch.setattr(util.requests, 'get', fake_get([
+        FakeResponse(b"first", {'ETag': '"a"', 'Content-Length': '5'}),
+        FakeResponse(b"", {'ETag': '"a"'}, status_code=304)
+    ], requests_made))
+
+    first = util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    second = util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    assert first == second
+    with open(second, 'rb') as fp:
+        assert fp.read() == b"first"
+    assert requests_made == [{}, {'If-None-Match': '"a"'}]
+
+
+def test_download_is_revalidated_by_last_modified(tmp_path, monkeypatch):
+    requests_made = []
+    last_modified = 'Wed, 01 Jan 2020 12:00:00 GMT'
+    monkeypatch.setattr(util.requests, 'get', fake_get([
+        FakeResponse(b"first", {'Last-Modified': last_modified}),
+        FakeResponse(b"second", {'Last-Modified': 'Thu, 02 Jan 2020 12:00:00 GMT'})
+    ], requests_made))
+
+    util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    path = util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    with open(path, 'rb') as fp:
+        assert fp.read() == b"second"
+    assert requests_made == [{}, {'If-Modified-Since': last_modified}]
+
+
+def test_failed_download_leaves_no_part_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(util.requests, 'get', fake_get([
+        FakeResponse(b"trunc", {'ETag': '"c"', 'Content-Length': '10'})
+    ], []))
+
+    with pytest.raises(IOError):
+        util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith('.part')] == []
+
+
+def test_retried_download_resumes_its_part_file(tmp_path, monkeypatch):
+    requests_made = []
+    monkeypatch.setattr(util.requests, 'get', fake_get([
+        FakeResponse(b"fir", {'ETag': '"d"', 'Content-Length': '5'}),
+        FakeResponse(b"", {'ETag': '"d"'}),
+        FakeResponse(b"st", {'ETag': '"d"', 'Content-Length': '2'}, status_code=206)
+    ], requests_made))
+    monkeypatch.setattr(util.time, 'sleep', lambda seconds: None)
+
+    path = util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=1)
+    with open(path, 'rb') as fp:
+        assert fp.read() == b"first"
+    assert requests_made[2] == {'Range': 'bytes=3-', 'If-Range': '"d"'}
+
+
+def test_download_without_validator_is_not_cached(tmp_path, monkeypatch):
+    requests_made = []
+    monkeypatch.setattr(util.requests, 'get', fake_get([
+        FakeResponse(b"first", {}),
+        FakeResponse(b"second", {})
+    ], requests_made))
+
+    util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    path = util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    with open(path, 'rb') as fp:
+        assert fp.read() == b"second"
+    assert [p.name for p in tmp_path.iterdir() if p.name.endswith('.part')] == []
+
+
+def test_download_with_content_encoding_skips_length_check(tmp_path, monkeypatch):
+    # Content-Length is of the gzipped body, the decoded content is longer
+    monkeypatch.setattr(util.requests, 'get', fake_get([
+        FakeResponse(b"decoded content", {'ETag': '"b"', 'Content-Length': '7', 'Content-Encoding': 'gzip'})
+    ], []))
+
+    path = util.download_to_cache("https://example.com/sample.pickle", cache_dir=str(tmp_path), retries=0)
+    with open(path, 'rb') as fp:
+        assert fp.read() == b"decoded content"